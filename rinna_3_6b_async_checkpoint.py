@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B LoRA学習用 非同期チェックポイント（アダプターのみ）
+save_steps ごとの保存で、LoRAの重み・オプティマイザー・スケジューラー・乱数の状態をホストメモリに
+コピーするところまでを学習スレッドで行い、ファイルへの書き込みはバックグラウンドスレッドで行う。
+書き込みは一時ディレクトリに対して行い、完了後に checkpoint-N へリネームする（途中で落ちても
+不完全なチェックポイントが残らない）。トークナイザーはチェックポイントごとではなく出力ディレクトリに1回だけ保存する。
+ファイル形式は Trainer の保存と同じなので、train(resume_from_checkpoint=...) でそのまま再開できる。
+
+    class MyTrainer(AsyncCheckpointMixin, Trainer): ...
+    trainer.train(resume_from_checkpoint=latest_checkpoint(output_dir))
+
+使い方:
+    python rinna_3_6b_async_checkpoint.py --tiny   # 保存前後のステップ時間と、中断・再開後の重みの一致を確認（CPU）
+"""
+
+import argparse
+import copy
+import json
+import os
+import queue
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import torch
+from safetensors.torch import save_file
+from transformers import TrainerCallback
+from transformers.trainer_callback import ExportableState
+from transformers.trainer import (
+    OPTIMIZER_NAME,
+    SCALER_NAME,
+    SCHEDULER_NAME,
+    TRAINER_STATE_NAME,
+    TRAINING_ARGS_NAME,
+)
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+# パラメータ
+ADAPTER_WEIGHTS_NAME = "adapter_model.safetensors"
+RNG_STATE_NAME = "rng_state.pth"
+TMP_SUFFIX = ".tmp"  # 書き込み中のチェックポイントのディレクトリ名の末尾
+
+_re_checkpoint = re.compile(r"^" + PREFIX_CHECKPOINT_DIR + r"-(\d+)$")
+
+
+def list_checkpoints(output_dir):
+    """完成したチェックポイントのディレクトリ（ステップ順）"""
+    if not os.path.isdir(output_dir):
+        return []
+    checkpoints = []
+    for name in os.listdir(output_dir):
+        match = _re_checkpoint.match(name)
+        path = os.path.join(output_dir, name)
+        if match and os.path.isfile(os.path.join(path, TRAINER_STATE_NAME)):
+            checkpoints.append((int(match.group(1)), path))
+    return [path for _, path in sorted(checkpoints)]
+
+
+def latest_checkpoint(output_dir):
+    """最新の完成したチェックポイント（なければ None）"""
+    checkpoints = list_checkpoints(output_dir)
+    return checkpoints[-1] if checkpoints else None
+
+
+def remove_incomplete_checkpoints(output_dir):
+    """書き込み途中で中断したチェックポイントの一時ディレクトリを削除"""
+    if not os.path.isdir(output_dir):
+        return
+    for name in os.listdir(output_dir):
+        if name.startswith(PREFIX_CHECKPOINT_DIR + "-") and name.endswith(TMP_SUFFIX):
+            shutil.rmtree(os.path.join(output_dir, name), ignore_errors=True)
+
+
+def _fsync_dir(path):
+    """ディレクトリ内のファイルとディレクトリ自体をディスクに書き出す"""
+    for name in os.listdir(path):
+        file_path = os.path.join(path, name)
+        if os.path.isfile(file_path):
+            with open(file_path, "rb") as f:
+                os.fsync(f.fileno())
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class HostSnapshot:
+    """テンソルをホストメモリにコピー（GPUではピン留めしたバッファを使い回して非同期にコピー）"""
+
+    def __init__(self):
+        self.buffers = {}
+        self.event = None
+
+    def copy(self, obj, key=""):
+        """obj（dict / list / tuple / テンソルの入れ子）のテンソルをホストメモリのコピーに置き換える"""
+        if isinstance(obj, torch.Tensor):
+            tensor = obj.detach()
+            if tensor.device.type != "cuda":
+                return tensor.clone()
+            buffer = self.buffers.get(key)
+            if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+                buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+                self.buffers[key] = buffer
+            buffer.copy_(tensor, non_blocking=True)
+            return buffer
+        if isinstance(obj, dict):
+            return {k: self.copy(v, f"{key}/{k}") for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.copy(v, f"{key}/{i}") for i, v in enumerate(obj))
+        return copy.deepcopy(obj)
+
+    def record(self):
+        """ここまでのコピーの完了を待つためのイベントを記録"""
+        if torch.cuda.is_available() and self.buffers:
+            self.event = torch.cuda.Event()
+            self.event.record()
+
+    def wait(self):
+        if self.event is not None:
+            self.event.synchronize()
+            self.event = None
+
+
+class AsyncCheckpointWriter:
+    """チェックポイントを1つずつ書き込むバックグラウンドスレッド
+
+    書き込み中に次の保存が来た場合は前の書き込みの完了を待つ（ホストメモリのバッファを使い回すため）。
+    書き込みで発生した例外は次の submit / wait で学習スレッドに送出する。
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.write_seconds = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                start = time.perf_counter()
+                job()
+                self.write_seconds += time.perf_counter() - start
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def submit(self, job):
+        self.wait()
+        self.queue.put(job)
+
+    def wait(self):
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("チェックポイントの書き込みに失敗しました") from error
+
+
+class AsyncCheckpointMixin:
+    """Trainer の _save_checkpoint を非同期のアダプターのみの保存に置き換える Mixin
+
+    async_checkpoint を False にした場合や、PEFTモデル以外・save_only_model など未対応の設定では
+    通常の保存を行う。学習の終了時（train() から戻る前）に書き込みの完了を待つ。
+    """
+
+    async_checkpoint = True
+    checkpoint_snapshot_seconds = 0.0  # 学習スレッドでの停止時間（ホストメモリへのコピー）の合計
+
+    def _save_checkpoint(self, model, trial):
+        from peft import PeftModel, get_peft_model_state_dict
+
+        if not self.async_checkpoint or not isinstance(self.model, PeftModel) or self.args.save_only_model or trial is not None \
+                or self.args.world_size > 1 or self.args.push_to_hub:
+            return super()._save_checkpoint(model, trial)
+
+        if not hasattr(self, "_checkpoint_writer"):
+            self._checkpoint_writer = AsyncCheckpointWriter()
+            self._checkpoint_snapshot = HostSnapshot()
+        writer = self._checkpoint_writer
+        snapshot = self._checkpoint_snapshot
+        # 前の書き込みが終わるまでバッファを上書きしない（通常は待ち時間なし）
+        writer.wait()
+
+        start = time.perf_counter()
+        self.store_flos()
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}")
+        adapter_name = self.model.active_adapter
+        adapter = snapshot.copy(get_peft_model_state_dict(self.model, adapter_name=adapter_name), "adapter")
+        optimizer = snapshot.copy(self.optimizer.state_dict(), "optimizer")
+        scheduler = copy.deepcopy(self.lr_scheduler.state_dict())
+        scaler = getattr(self.accelerator, "scaler", None)
+        scaler = copy.deepcopy(scaler.state_dict()) if scaler is not None else None
+        rng_states = {
+            "python": random.getstate(),
+            "numpy": np.random.get_state(),
+            "cpu": torch.random.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            rng_states["cuda"] = torch.cuda.random.get_rng_state()
+        snapshot.record()
+        peft_config = copy.deepcopy(self.model.peft_config[adapter_name])
+        # Trainer と同様に状態を持つコールバック（EarlyStopping など）の状態を trainer_state に含める
+        for callback in self.callback_handler.callbacks + [self.control]:
+            if isinstance(callback, ExportableState):
+                name = callback.__class__.__name__
+                if isinstance(self.state.stateful_callbacks[name], list):
+                    self.state.stateful_callbacks[name].append(callback.state())
+                else:
+                    self.state.stateful_callbacks[name] = callback.state()
+        trainer_state = copy.deepcopy(self.state)
+        tokenizer = None
+        if self.processing_class is not None and not getattr(self, "_tokenizer_saved", False):
+            tokenizer = self.processing_class
+            self._tokenizer_saved = True
+        training_args = copy.deepcopy(self.args)
+        save_total_limit = self.args.save_total_limit
+        self.checkpoint_snapshot_seconds += time.perf_counter() - start
+
+        def write():
+            snapshot.wait()
+            os.makedirs(run_dir, exist_ok=True)
+            if tokenizer is not None:
+                # トークナイザーは出力ディレクトリに1回だけ保存
+                tokenizer.save_pretrained(run_dir)
+            tmp_dir = output_dir + TMP_SUFFIX
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            save_file(adapter, os.path.join(tmp_dir, ADAPTER_WEIGHTS_NAME), metadata={"format": "pt"})
+            peft_config.save_pretrained(tmp_dir)
+            torch.save(optimizer, os.path.join(tmp_dir, OPTIMIZER_NAME))
+            torch.save(scheduler, os.path.join(tmp_dir, SCHEDULER_NAME))
+            if scaler is not None:
+                torch.save(scaler, os.path.join(tmp_dir, SCALER_NAME))
+            torch.save(rng_states, os.path.join(tmp_dir, RNG_STATE_NAME))
+            trainer_state.save_to_json(os.path.join(tmp_dir, TRAINER_STATE_NAME))
+            torch.save(training_args, os.path.join(tmp_dir, TRAINING_ARGS_NAME))
+            _fsync_dir(tmp_dir)
+
+            # 同じステップのチェックポイントがあれば置き換える
+            if os.path.exists(output_dir):
+                shutil.rmtree(output_dir)
+            os.rename(tmp_dir, output_dir)
+            _fsync_dir(run_dir)
+            if save_total_limit:
+                for old in list_checkpoints(run_dir)[:-save_total_limit]:
+                    shutil.rmtree(old, ignore_errors=True)
+
+        writer.submit(write)
+
+    def train(self, *args, **kwargs):
+        try:
+            return super().train(*args, **kwargs)
+        finally:
+            if hasattr(self, "_checkpoint_writer"):
+                self._checkpoint_writer.wait()
+
+
+class StepTimeCallback(TrainerCallback):
+    """ステップごとの所要時間（保存を含む）を記録"""
+
+    def __init__(self):
+        self.times = []
+        self._last = None
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        if self._last is None:
+            self._last = time.perf_counter()
+
+    def on_save(self, args, state, control, **kwargs):
+        # on_save は保存の直後に呼ばれるため、保存時間をこのステップに含める
+        now = time.perf_counter()
+        self.times[-1] = (self.times[-1][0], self.times[-1][1] + now - self._last)
+        self._last = now
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = time.perf_counter()
+        self.times.append((state.global_step, now - self._last))
+        self._last = now
+
+
+def self_check(args):
+    """小型モデルで同期保存と非同期保存のステップ時間を比較し、中断・再開した学習の重みが一致するかを確認"""
+    from datasets import Dataset
+    from peft import LoraConfig, get_peft_model
+    from transformers import DataCollatorForLanguageModeling, Trainer, TrainingArguments
+    from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer, tokenizer_name
+
+    tokenizer_path = args.tokenizer or tokenizer_name
+    rng = random.Random(0)
+    _, tokenizer = prepare_tiny_model_and_tokenizer(tokenizer_path)
+    rows = [{"input_ids": [rng.randrange(10, len(tokenizer)) for _ in range(rng.randint(16, 64))]}
+            for _ in range(args.max_steps * 4)]
+
+    class AsyncTrainer(AsyncCheckpointMixin, Trainer):
+        pass
+
+    class StopAt(TrainerCallback):
+        """指定ステップで学習を打ち切る（クラッシュの代わり）"""
+
+        def __init__(self, step):
+            self.step = step
+
+        def on_step_end(self, args, state, control, **kwargs):
+            if state.global_step == self.step:
+                control.should_training_stop = True
+
+    def run(trainer_class, output_dir, resume=None, stop_at=None):
+        model, _ = prepare_tiny_model_and_tokenizer(tokenizer_path, hidden_size=args.hidden_size,
+                                                    intermediate_size=args.hidden_size * 4, num_hidden_layers=4)
+        model = get_peft_model(model, LoraConfig(
+            r=args.lora_r, lora_alpha=32, lora_dropout=0.1,
+            target_modules=["query_key_value", "dense", "dense_h_to_4h", "dense_4h_to_h"]))
+        model.train()
+        model.config.use_cache = False
+        step_times = StepTimeCallback()
+        callbacks = [step_times] + ([StopAt(stop_at)] if stop_at else [])
+        trainer = trainer_class(
+            model=model,
+            args=TrainingArguments(
+                output_dir=output_dir,
+                max_steps=args.max_steps,
+                per_device_train_batch_size=4,
+                learning_rate=1e-3,
+                save_steps=args.save_steps,
+                save_total_limit=2,
+                logging_steps=args.max_steps,
+                report_to="none",
+                use_cpu=not torch.cuda.is_available(),
+                disable_tqdm=True,
+            ),
+            train_dataset=Dataset.from_list(rows),
+            data_collator=DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False),
+            processing_class=tokenizer,
+            callbacks=callbacks,
+        )
+        trainer.train(resume_from_checkpoint=resume)
+        weights = {name: param.detach().clone() for name, param in model.named_parameters() if param.requires_grad}
+        return trainer, weights, step_times.times
+
+    def summarize(times):
+        save_steps = [t for step, t in times[1:] if step % args.save_steps == 0]
+        other_steps = sorted(t for step, t in times[1:] if step % args.save_steps)
+        return np.median(other_steps) * 1000, np.mean(save_steps) * 1000, max(save_steps) * 1000
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print("=== 保存を含むステップ時間 ===")
+        sync_dir = os.path.join(tmp_dir, "sync")
+        async_dir = os.path.join(tmp_dir, "async")
+        _, _, sync_times = run(Trainer, sync_dir)
+        trainer, expected, async_times = run(AsyncTrainer, async_dir)
+        print(f"{'保存方式':8} {'通常ステップ(中央値)':>20} {'保存ステップ(平均)':>18} {'保存ステップ(最大)':>18}")
+        for label, times in (("同期", sync_times), ("非同期", async_times)):
+            median, mean, worst = summarize(times)
+            print(f"{label:8} {median:>18.1f}ms {mean:>16.1f}ms {worst:>16.1f}ms")
+        print(f"非同期: 学習スレッドの停止 {trainer.checkpoint_snapshot_seconds * 1000:.1f}ms, "
+              f"バックグラウンドの書き込み {trainer._checkpoint_writer.write_seconds * 1000:.1f}ms（合計）")
+
+        def listing(path):
+            return sorted(os.listdir(path))
+        last_sync = latest_checkpoint(sync_dir)
+        last_async = latest_checkpoint(async_dir)
+        print(f"\n同期のチェックポイント: {listing(last_sync)}")
+        print(f"非同期のチェックポイント: {listing(last_async)}")
+        print(f"非同期の出力ディレクトリ: {listing(async_dir)}")
+        leftovers = [name for name in os.listdir(async_dir) if name.endswith(TMP_SUFFIX)]
+        print(f"一時ディレクトリの残り: {'なし ✅' if not leftovers else leftovers}")
+
+        print("\n=== 中断と最新のチェックポイントからの再開 ===")
+        resume_dir = os.path.join(tmp_dir, "resume")
+        stop_at = args.save_steps * 2 + args.save_steps // 2
+        run(AsyncTrainer, resume_dir, stop_at=stop_at)
+        # 書き込み途中で落ちた一時ディレクトリを模擬
+        os.makedirs(os.path.join(resume_dir, f"{PREFIX_CHECKPOINT_DIR}-{stop_at}{TMP_SUFFIX}"))
+        remove_incomplete_checkpoints(resume_dir)
+        checkpoint = latest_checkpoint(resume_dir)
+        with open(os.path.join(checkpoint, TRAINER_STATE_NAME), encoding="utf-8") as f:
+            step = json.load(f)["global_step"]
+        print(f"{stop_at}ステップで中断 → {os.path.basename(checkpoint)} から再開（global_step={step}）")
+        _, resumed, _ = run(AsyncTrainer, resume_dir, resume=checkpoint)
+        diff = max((resumed[name] - expected[name]).abs().max().item() for name in expected)
+        print(f"中断なしの学習との重みの最大差: {diff:.2e} {'✅' if diff < 1e-6 else '❌'}")
+    if leftovers or not diff < 1e-6:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="非同期チェックポイントの動作確認")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    parser.add_argument("--max-steps", type=int, default=40)
+    parser.add_argument("--save-steps", type=int, default=10)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--lora-r", type=int, default=64)
+    args = parser.parse_args()
+    self_check(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B オフライン一括推論（JSONL → JSONL）
+入力のJSONL（1行1件、"instruction" と省略可能な "input"）を少しずつ読み込み、チャンク内で
+プロンプト長の順に並べてバッチを作り、複数のワーカープロセス（それぞれモデルを1つ読み込む。
+GPUが複数あれば1デバイスに1ワーカー）でバッチ生成する。
+
+- 結果は入力と同じ順番で出力のJSONLに逐次追記する（元のレコードに "response" 等を追加）
+- 完了したレコードは順番に関係なくジャーナル（<出力>.journal）にも即座に追記し、
+  クラッシュ後に同じコマンドを再実行すると完了済みのレコードを飛ばして再開する
+- 全体のスループットとワーカーごとの稼働率を表示する
+
+使い方:
+    python rinna_3_6b_batch_inference.py --input questions.jsonl --output answers.jsonl --workers 2
+    python rinna_3_6b_batch_inference.py --tiny   # 小型モデルで中断・再開後の出力一致を確認（CPU）
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# パラメータ
+BATCH_SIZE = 8  # 1回の生成にまとめるレコード数
+CHUNK_RECORDS = 1024  # 長さ順に並べ替える単位（メモリ使用量と出力の遅れの上限）
+MAX_NEW_TOKENS = 256
+NUM_WORKERS = None  # ワーカー数（None でGPU数、GPUがなければ1）
+SEED = 0  # バッチごとの乱数シード（先頭レコードの番号を足す。ワーカー数や再開に関係なく同じバッチは同じ乱数）
+
+
+def read_records(path):
+    """入力のJSONLを1件ずつ読み込む（空行は飛ばす）"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def recover_output(output_path):
+    """出力ファイルの完了済みの行数を返す（書きかけの最終行は切り詰める）"""
+    if not os.path.exists(output_path):
+        return 0
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    return data[:end].count(b"\n")
+
+
+def load_journal(journal_path, next_index):
+    """ジャーナルから出力ファイルにまだ書いていない完了済みレコードを読み込む"""
+    pending = {}
+    if not os.path.exists(journal_path):
+        return pending
+    with open(journal_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 書きかけの最終行
+                continue
+            if record["index"] >= next_index:
+                pending[record["index"]] = record
+    return pending
+
+
+def worker_main(worker_id, device, model_args, params, max_new_tokens, task_queue, result_queue):
+    """ワーカープロセス: モデルを読み込み、タスク（バッチ）を取り出して生成する"""
+    parent = os.getppid()
+    if device.startswith("cuda:"):
+        # このワーカーからは割り当てたGPUだけが見えるようにする
+        os.environ["CUDA_VISIBLE_DEVICES"] = device.split(":", 1)[1]
+    try:
+        import torch
+
+        import rinna_3_6b_inference as inference
+
+        start = time.perf_counter()
+        if model_args.get("tiny"):
+            from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer
+
+            model, tokenizer = prepare_tiny_model_and_tokenizer(model_args["tokenizer"])
+        else:
+            from rinna_3_6b_startup import load_model_and_tokenizer
+
+            model, tokenizer = load_model_and_tokenizer(
+                model_args["base"], model_args["adapter"], merged_name=model_args["merged"],
+                device="cuda" if device.startswith("cuda") else "cpu")
+        if model_args.get("threads"):
+            torch.set_num_threads(model_args["threads"])
+        if params is not None:
+            inference.GENERATION_PARAMS = params
+        result_queue.put(("ready", worker_id, time.perf_counter() - start))
+
+        while True:
+            try:
+                task = task_queue.get(timeout=1.0)
+            except queue.Empty:
+                # 親プロセスが強制終了された場合は自分も終了する
+                if os.getppid() != parent:
+                    return
+                continue
+            if task is None:
+                break
+            indices, requests = task
+            torch.manual_seed(model_args["seed"] + indices[0])
+            start = time.perf_counter()
+            results, stats = inference.generate_batch(model, tokenizer, requests, max_new_tokens, return_stats=True)
+            result_queue.put(("done", worker_id, indices, results, stats["request_tokens"],
+                              time.perf_counter() - start))
+    except BaseException as e:
+        result_queue.put(("error", worker_id, repr(e)))
+        raise
+    result_queue.put(("exit", worker_id, None))
+
+
+def worker_devices(num_workers):
+    """ワーカーごとのデバイス（GPUがあれば順番に割り当てる）"""
+    import torch
+
+    gpus = torch.cuda.device_count()
+    if num_workers is None:
+        num_workers = max(gpus, 1)
+    if gpus:
+        return [f"cuda:{i % gpus}" for i in range(num_workers)]
+    return ["cpu"] * num_workers
+
+
+def feed_tasks(input_path, tokenizer, skip, in_flight, task_queue, num_workers, batch_size, chunk_records, counts):
+    """入力を読み込み、チャンクごとに長さ順のバッチを作ってタスクキューに入れる（別スレッドで実行）"""
+    from rinna_3_6b_inference import generate_prompt
+
+    def flush(chunk):
+        if not chunk:
+            return
+        prompts = [generate_prompt({'instruction': r.get("instruction", ""), 'input': r.get("input")})
+                   for _, r in chunk]
+        lengths = [len(ids) for ids in tokenizer(prompts, add_special_tokens=False).input_ids]
+        # 長いバッチから処理して最後に長いバッチが残らないようにする
+        order = sorted(range(len(chunk)), key=lambda i: -lengths[i])
+        for start in range(0, len(order), batch_size):
+            batch = [chunk[i] for i in order[start:start + batch_size]]
+            indices = [index for index, _ in batch]
+            for index, record in batch:
+                in_flight[index] = record
+            requests = [(record.get("instruction", ""), record.get("input")) for _, record in batch]
+            task_queue.put((indices, requests))
+            counts["submitted"] += len(batch)
+
+    chunk = []
+    for index, record in enumerate(read_records(input_path)):
+        counts["total"] = index + 1
+        if skip(index):
+            continue
+        chunk.append((index, record))
+        if len(chunk) >= chunk_records:
+            flush(chunk)
+            chunk = []
+    flush(chunk)
+    counts["input_done"] = True
+    for _ in range(num_workers):
+        task_queue.put(None)
+
+
+def run_batch_inference(input_path, output_path, model_args, num_workers=NUM_WORKERS, batch_size=BATCH_SIZE,
+                        chunk_records=CHUNK_RECORDS, max_new_tokens=MAX_NEW_TOKENS, params=None):
+    """入力のJSONLを一括推論して出力のJSONLに書き込む（中断した場合は再実行で再開）"""
+    from transformers import AutoTokenizer
+
+    journal_path = output_path + ".journal"
+    next_index = recover_output(output_path)
+    pending = load_journal(journal_path, next_index)
+    done_before = next_index + len(pending)
+    if done_before:
+        print(f"再開: 出力済み {next_index}件, ジャーナルのみ {len(pending)}件")
+
+    tokenizer_path = model_args["tokenizer"] if model_args.get("tiny") else (model_args["merged"] or model_args["base"])
+    # Rinnaのトークナイザーでは use_fast=False が必要
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_fast=False)
+
+    devices = worker_devices(num_workers)
+    if devices[0] == "cpu":
+        from rinna_3_6b_cpu_backend import available_cpus
+
+        model_args = dict(model_args, threads=max(1, available_cpus() // len(devices)))
+    print(f"ワーカー: {len(devices)} ({', '.join(devices)})")
+
+    # CUDAを初期化したプロセスから fork しないよう spawn で起動
+    ctx = multiprocessing.get_context("spawn")
+    task_queue = ctx.Queue(maxsize=len(devices) * 2)
+    result_queue = ctx.Queue()
+    workers = [
+        ctx.Process(target=worker_main, daemon=True,
+                    args=(i, device, model_args, params, max_new_tokens, task_queue, result_queue))
+        for i, device in enumerate(devices)
+    ]
+    for worker in workers:
+        worker.start()
+
+    in_flight = {}
+    counts = {"total": 0, "submitted": 0, "input_done": False}
+    start = time.perf_counter()
+    # 完了済みのレコードは起動時点の状態で判定する（next_index と pending は書き込み中に変わるため共有しない）
+    resumed_index, resumed = next_index, frozenset(pending)
+    feeder = threading.Thread(
+        target=feed_tasks, daemon=True,
+        args=(input_path, tokenizer, lambda index: index < resumed_index or index in resumed,
+              in_flight, task_queue, len(workers), batch_size, chunk_records, counts))
+    feeder.start()
+
+    worker_stats = [{"device": device, "load_seconds": 0.0, "ready_at": None, "busy_seconds": 0.0,
+                     "batches": 0, "records": 0, "generated_tokens": 0} for device in devices]
+    completed = 0
+    generated_tokens = 0
+    running = len(workers)
+    last_report = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as output, open(journal_path, "a", encoding="utf-8") as journal:
+        def write_ordered():
+            nonlocal next_index
+            while next_index in pending:
+                output.write(json.dumps(pending.pop(next_index), ensure_ascii=False) + "\n")
+                next_index += 1
+            output.flush()
+
+        write_ordered()
+        while running:
+            try:
+                message = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                dead = [i for i, w in enumerate(workers) if not w.is_alive() and w.exitcode not in (0, None)]
+                if dead:
+                    raise RuntimeError(f"ワーカー {dead} が異常終了しました（再実行すると続きから再開します）")
+                continue
+
+            kind, worker_id = message[0], message[1]
+            stats = worker_stats[worker_id]
+            if kind == "ready":
+                stats["load_seconds"] = message[2]
+                stats["ready_at"] = time.perf_counter()
+            elif kind == "done":
+                _, _, indices, results, request_tokens, busy = message
+                for index, response, tokens in zip(indices, results, request_tokens):
+                    record = dict(in_flight.pop(index), index=index, response=response, generated_tokens=tokens)
+                    journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    pending[index] = record
+                journal.flush()
+                write_ordered()
+                stats["busy_seconds"] += busy
+                stats["batches"] += 1
+                stats["records"] += len(indices)
+                stats["generated_tokens"] += sum(request_tokens)
+                completed += len(indices)
+                generated_tokens += sum(request_tokens)
+                if time.perf_counter() - last_report >= 10:
+                    last_report = time.perf_counter()
+                    print(f"進捗: {completed + done_before}件完了 / 読み込み済み {counts['total']}件, "
+                          f"{generated_tokens / (last_report - start):.1f} tokens/sec")
+            elif kind == "error":
+                raise RuntimeError(f"ワーカー {worker_id} でエラーが発生しました: {message[2]}")
+            elif kind == "exit":
+                running -= 1
+
+    feeder.join()
+    for worker in workers:
+        worker.join()
+    if pending:
+        raise RuntimeError(f"出力できなかったレコードがあります: {sorted(pending)[:10]}")
+    os.remove(journal_path)
+
+    elapsed = time.perf_counter() - start
+    end = time.perf_counter()
+    print("\n=== 一括推論の結果 ===")
+    print(f"レコード: {counts['total']}件（今回 {completed}件、前回までに完了 {done_before}件）")
+    print(f"経過時間: {elapsed:.1f}秒, {completed / elapsed:.2f} records/sec, {generated_tokens / elapsed:.1f} tokens/sec")
+    print(f"{'ワーカー':>8} {'デバイス':>8} {'読み込み':>10} {'バッチ':>6} {'レコード':>8} {'tokens/sec':>11} {'稼働率':>7}")
+    for i, stats in enumerate(worker_stats):
+        # 稼働率: モデルの読み込み完了から終了までのうち生成していた時間の割合
+        active = end - stats["ready_at"] if stats["ready_at"] else 0.0
+        utilization = stats["busy_seconds"] / active if active > 0 else 0.0
+        tokens_per_sec = stats["generated_tokens"] / stats["busy_seconds"] if stats["busy_seconds"] else 0.0
+        print(f"{i:>8} {stats['device']:>8} {stats['load_seconds']:>8.1f}秒 {stats['batches']:>6} "
+              f"{stats['records']:>8} {tokens_per_sec:>11.1f} {utilization:>7.0%}")
+    return {
+        "records": counts["total"],
+        "completed": completed,
+        "elapsed": elapsed,
+        "generated_tokens": generated_tokens,
+        "workers": worker_stats,
+    }
+
+
+def read_output(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def self_check(args):
+    """小型モデルで、途中で強制終了して再開した出力が一度に実行した出力と一致するかを確認"""
+    from rinna_3_6b_tiny_model import tokenizer_name
+
+    tokenizer_path = args.tokenizer or tokenizer_name
+    words = ["日本", "首都", "自然言語処理", "機械学習", "Python", "特徴", "歴史", "東京", "説明", "教えて"]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = os.path.join(tmp_dir, "questions.jsonl")
+        with open(input_path, "w", encoding="utf-8") as f:
+            for i in range(args.records):
+                instruction = "".join(words[(i * 7 + j) % len(words)] for j in range(1 + i % 23))
+                f.write(json.dumps({"id": f"q{i}", "instruction": instruction}, ensure_ascii=False) + "\n")
+
+        common = [sys.executable, os.path.abspath(__file__), "--tiny", "--tokenizer", tokenizer_path,
+                  "--input", input_path, "--workers", str(args.workers), "--batch-size", str(args.batch_size),
+                  "--chunk-size", str(args.chunk_size), "--max-new-tokens", str(args.max_new_tokens), "--greedy"]
+
+        print("=== 中断なしで実行 ===")
+        expected_path = os.path.join(tmp_dir, "expected.jsonl")
+        subprocess.run(common + ["--output", expected_path], check=True)
+
+        print("\n=== 途中で強制終了して再開 ===")
+        output_path = os.path.join(tmp_dir, "answers.jsonl")
+        process = subprocess.Popen(common + ["--output", output_path])
+        journal_path = output_path + ".journal"
+        while process.poll() is None:
+            if os.path.exists(journal_path):
+                with open(journal_path, encoding="utf-8") as f:
+                    if sum(1 for _ in f) >= args.records // 3:
+                        process.send_signal(signal.SIGKILL)
+                        break
+            time.sleep(0.05)
+        process.wait()
+        print(f"強制終了: 出力 {recover_output(output_path)}件")
+        subprocess.run(common + ["--output", output_path], check=True)
+
+        expected = read_output(expected_path)
+        actual = read_output(output_path)
+        ordered = [r["index"] for r in actual] == list(range(args.records))
+        same = [(r["id"], r["response"], r["generated_tokens"]) for r in actual] == \
+               [(r["id"], r["response"], r["generated_tokens"]) for r in expected]
+        journal_removed = not os.path.exists(journal_path)
+        print(f"\n入力順: {'✅' if ordered else '❌'}, 中断なしの出力と一致: {'✅' if same else '❌'}, "
+              f"ジャーナル削除: {'✅' if journal_removed else '❌'}")
+    if not (ordered and same and journal_removed):
+        sys.exit(1)
+
+
+def main():
+    import rinna_3_6b_inference as inference
+
+    parser = argparse.ArgumentParser(description="JSONLの一括推論（並べ替え・複数ワーカー・中断からの再開）")
+    parser.add_argument("--input", help="入力のJSONL（instruction / input）")
+    parser.add_argument("--output", help="出力のJSONL（入力と同じ順番）")
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS, help="ワーカー数（省略時はGPU数）")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_RECORDS, help="長さ順に並べ替えるレコード数")
+    parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--greedy", action="store_true", help="貪欲生成（出力を再現可能にする）")
+    parser.add_argument("--base", default=inference.model_name)
+    parser.add_argument("--adapter", default=inference.peft_name)
+    parser.add_argument("--merged", default=inference.merged_name)
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    parser.add_argument("--records", type=int, default=300, help="自己チェックのレコード数（--tiny で入出力省略時）")
+    args = parser.parse_args()
+
+    if args.tiny and not args.input:
+        if args.workers is None:
+            args.workers = 2
+        if args.max_new_tokens == MAX_NEW_TOKENS:
+            args.max_new_tokens = 16
+        if args.chunk_size == CHUNK_RECORDS:
+            args.chunk_size = 64
+        self_check(args)
+        return
+    if not args.input or not args.output:
+        parser.error("--input と --output を指定してください")
+
+    if args.tiny:
+        from rinna_3_6b_tiny_model import tokenizer_name
+
+        args.tokenizer = args.tokenizer or tokenizer_name
+    model_args = dict(tiny=args.tiny, tokenizer=args.tokenizer, base=args.base, adapter=args.adapter,
+                      merged=args.merged, seed=args.seed)
+    params = dict(inference.GENERATION_PARAMS, do_sample=False) if args.greedy else None
+    run_batch_inference(args.input, args.output, model_args, args.workers, args.batch_size, args.chunk_size,
+                        args.max_new_tokens, params)
+
+
+if __name__ == "__main__":
+    main()
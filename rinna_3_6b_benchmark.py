@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B 推論ベンチマーク
+プロンプト長 × 生成トークン数 × バッチサイズの組み合わせごとに、generate() と同じ生成設定で
+TTFT（最初のトークンまでの時間）、トークンあたりのレイテンシ、tokens/sec、ピークメモリを計測する。
+結果はJSONで保存し、保存済みのベースラインと比較して閾値を超えて悪化した場合は終了コード1で終了する。
+CPUでは最大RSSがプロセス全体で減らないため、組み合わせごとに別プロセスでモデルを読み込んで計測する
+（親プロセスはモデルを読み込まない）。
+
+使い方:
+    python rinna_3_6b_benchmark.py --output bench.json                      # 3.6Bモデルで計測
+    python rinna_3_6b_benchmark.py --tiny --save-baseline                   # 小型モデル（CPU）でベースラインを保存
+    python rinna_3_6b_benchmark.py --tiny --baseline benchmarks/baseline-tiny.json --threshold 0.1
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+import transformers
+from transformers.generation.streamers import BaseStreamer
+
+import rinna_3_6b_inference as inference
+from rinna_3_6b_inference_server import percentile
+
+# パラメータ
+PROMPT_LENGTHS = [32, 128, 512]  # プロンプトのトークン数
+OUTPUT_LENGTHS = [32, 128]  # 生成トークン数
+BATCH_SIZES = [1, 4]
+REPEATS = 5  # 組み合わせごとの計測回数（ウォームアップを除く）
+WARMUP = 1
+BASELINE_PATH = "benchmarks/baseline.json"
+REGRESSION_THRESHOLD = 0.10  # ベースラインからの悪化の許容割合
+RINNA_VOCAB_SIZE = 32000  # トークナイザーが読み込めない場合に使う語彙サイズ
+
+# ベースラインと比較する指標（True は大きいほど良い）
+GATED_METRICS = {
+    "ttft_ms.p50": False,
+    "token_latency_ms.p50": False,
+    "tokens_per_sec": True,
+    "peak_memory_mb": False,
+}
+
+
+class TokenTimer(BaseStreamer):
+    """model.generate の streamer として各ステップのトークンが出た時刻を記録"""
+
+    def __init__(self):
+        self.start = None
+        self.times = []
+        self.prompt_seen = False
+
+    def put(self, value):
+        # 最初の呼び出しはプロンプト
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        self.times.append(time.perf_counter())
+
+    def end(self):
+        pass
+
+
+def _synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def reset_peak_memory(device):
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device):
+    """ピークメモリ（GPUは割り当て済みメモリ、CPUはプロセスの最大RSS＝モデルの読み込みを含む）"""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 1024 ** 2
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOSはバイト単位、Linuxはキロバイト単位
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def synthetic_prompts(vocab_size, prompt_len, batch_size, seed=0):
+    """指定したトークン数のプロンプト（乱数のトークンID、特殊トークンを避ける）"""
+    generator = torch.Generator().manual_seed(seed + prompt_len)
+    return torch.randint(10, vocab_size, (batch_size, prompt_len), generator=generator)
+
+
+@torch.inference_mode()
+def run_once(model, input_ids, output_len, eos_token_id=None, pad_token_id=None, seed=0):
+    """1回生成し、TTFTと各トークン間の時間を返す（生成トークン数は output_len に固定）"""
+    timer = TokenTimer()
+    torch.manual_seed(seed)
+    _synchronize(input_ids.device)
+    start = time.perf_counter()
+    # EOS・停止文字列で止まると計測条件が揃わないため min_new_tokens で長さを固定する
+    model.generate(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=output_len,
+        min_new_tokens=output_len,
+        eos_token_id=eos_token_id,
+        pad_token_id=pad_token_id,
+        streamer=timer,
+        **inference.sampling_kwargs(),
+    )
+    _synchronize(input_ids.device)
+    end = time.perf_counter()
+    times = [start] + timer.times
+    return {
+        "ttft": times[1] - start,
+        "token_latencies": [b - a for a, b in zip(times[1:], times[2:])],
+        "elapsed": end - start,
+    }
+
+
+def summarize(values_ms):
+    return {
+        "p50": percentile(values_ms, 50),
+        "p95": percentile(values_ms, 95),
+        "p99": percentile(values_ms, 99),
+        "mean": sum(values_ms) / len(values_ms) if values_ms else 0.0,
+    }
+
+
+def benchmark_case(model, vocab_size, prompt_len, output_len, batch_size, repeats=REPEATS, warmup=WARMUP,
+                   eos_token_id=None, pad_token_id=None):
+    """1つの組み合わせを計測"""
+    device = model.device
+    input_ids = synthetic_prompts(vocab_size, prompt_len, batch_size).to(device)
+    for i in range(warmup):
+        run_once(model, input_ids, output_len, eos_token_id, pad_token_id, seed=i)
+
+    reset_peak_memory(device)
+    runs = [run_once(model, input_ids, output_len, eos_token_id, pad_token_id, seed=i) for i in range(repeats)]
+    ttfts = [run["ttft"] * 1000 for run in runs]
+    token_latencies = [latency * 1000 for run in runs for latency in run["token_latencies"]]
+    elapsed = sum(run["elapsed"] for run in runs)
+    return {
+        "prompt_len": prompt_len,
+        "output_len": output_len,
+        "batch_size": batch_size,
+        "ttft_ms": summarize(ttfts),
+        "token_latency_ms": summarize(token_latencies),
+        "tokens_per_sec": batch_size * output_len * repeats / elapsed,
+        "peak_memory_mb": peak_memory_mb(device),
+    }
+
+
+def benchmark_case_subprocess(case_command, prompt_len, output_len, batch_size, repeats=REPEATS, warmup=WARMUP):
+    """1つの組み合わせを別プロセスで計測（前の組み合わせの最大RSSが残らないようにする）
+
+    子プロセスの出力の最後の行は {"result": 計測結果, "meta": 環境とモデルの情報}。
+    """
+    command = case_command + ["--prompt-lengths", str(prompt_len), "--output-lengths", str(output_len),
+                              "--batch-sizes", str(batch_size), "--repeats", str(repeats), "--warmup", str(warmup)]
+    result = subprocess.run(command, check=True, capture_output=True, text=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def benchmark_meta(model, repeats=REPEATS):
+    """計測環境とモデル・生成設定の情報（ベースラインとの比較で条件の違いを表示するため）"""
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "device": str(model.device),
+        "device_name": torch.cuda.get_device_name(model.device) if model.device.type == "cuda" else platform.processor(),
+        "threads": torch.get_num_threads(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "model": {key: getattr(model.config, key) for key in
+                  ("vocab_size", "hidden_size", "num_hidden_layers", "num_attention_heads")},
+        "generation_params": inference.GENERATION_PARAMS,
+        "fused_logits_processor": inference.USE_FUSED_LOGITS_PROCESSOR,
+        "repeats": repeats,
+    }
+
+
+def run_benchmark(model, vocab_size, prompt_lengths=PROMPT_LENGTHS, output_lengths=OUTPUT_LENGTHS,
+                  batch_sizes=BATCH_SIZES, repeats=REPEATS, warmup=WARMUP, eos_token_id=None, pad_token_id=None,
+                  case_command=None):
+    """全組み合わせを計測してJSONに保存できる形で返す
+
+    case_command 指定時は組み合わせごとに別プロセスで計測する（model は None でよい）。
+    """
+    results = []
+    meta = benchmark_meta(model, repeats) if model is not None else None
+    print(f"{'プロンプト':>10} {'生成':>6} {'バッチ':>6} {'TTFT p50':>10} {'p99':>9} "
+          f"{'トークン p50':>12} {'p99':>9} {'tokens/sec':>11} {'ピーク':>9}")
+    for prompt_len in prompt_lengths:
+        for output_len in output_lengths:
+            for batch_size in batch_sizes:
+                if case_command is not None:
+                    case = benchmark_case_subprocess(case_command, prompt_len, output_len, batch_size,
+                                                     repeats, warmup)
+                    result, meta = case["result"], meta or case["meta"]
+                else:
+                    result = benchmark_case(model, vocab_size, prompt_len, output_len, batch_size, repeats,
+                                            warmup, eos_token_id, pad_token_id)
+                results.append(result)
+                print(f"{prompt_len:>10} {output_len:>6} {batch_size:>6} "
+                      f"{result['ttft_ms']['p50']:>8.1f}ms {result['ttft_ms']['p99']:>7.1f}ms "
+                      f"{result['token_latency_ms']['p50']:>10.2f}ms {result['token_latency_ms']['p99']:>7.2f}ms "
+                      f"{result['tokens_per_sec']:>11.1f} {result['peak_memory_mb']:>7.0f}MB")
+    return {"meta": meta, "results": results}
+
+
+def _metric(result, name):
+    value = result
+    for key in name.split("."):
+        value = value[key]
+    return value
+
+
+def compare_with_baseline(report, baseline, threshold=REGRESSION_THRESHOLD):
+    """ベースラインと比較し、閾値を超えて悪化した項目のリストを返す"""
+    for key in ("device", "model", "generation_params"):
+        if report["meta"].get(key) != baseline["meta"].get(key):
+            print(f"⚠️ ベースラインと {key} が異なります: {baseline['meta'].get(key)} → {report['meta'].get(key)}")
+
+    cases = {(r["prompt_len"], r["output_len"], r["batch_size"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\n=== ベースラインとの比較（許容 {threshold:.0%}） ===")
+    for result in report["results"]:
+        case = (result["prompt_len"], result["output_len"], result["batch_size"])
+        if case not in cases:
+            print(f"{case}: ベースラインなし")
+            continue
+        changes = []
+        for name, higher_is_better in GATED_METRICS.items():
+            before, after = _metric(cases[case], name), _metric(result, name)
+            if before <= 0:
+                continue
+            change = after / before - 1
+            worse = -change if higher_is_better else change
+            changes.append(f"{name} {change:+.1%}")
+            if worse > threshold:
+                regressions.append({"case": case, "metric": name, "baseline": before, "value": after,
+                                    "change": change})
+        print(f"{case}: {', '.join(changes)}")
+    return regressions
+
+
+def prepare_tiny_benchmark_model(tokenizer_path):
+    """小型モデルの準備（rinnaのトークナイザーが読み込めなければ同じ語彙サイズで作成し、オフラインでも動かす）"""
+    from rinna_3_6b_tiny_model import TINY_CONFIG, prepare_tiny_model_and_tokenizer
+    from transformers import GPTNeoXConfig, GPTNeoXForCausalLM
+
+    try:
+        model, tokenizer = prepare_tiny_model_and_tokenizer(tokenizer_path)
+        return model, tokenizer.eos_token_id, tokenizer.pad_token_id
+    except (OSError, ValueError) as e:
+        print(f"トークナイザーを読み込めないため語彙サイズ {RINNA_VOCAB_SIZE} で作成します: {e}")
+    torch.manual_seed(0)
+    model = GPTNeoXForCausalLM(GPTNeoXConfig(vocab_size=RINNA_VOCAB_SIZE, **TINY_CONFIG))
+    model.eval()
+    return model, None, None
+
+
+def _int_list(text):
+    return [int(value) for value in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="推論ベンチマーク（ベースラインとの比較付き）")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    parser.add_argument("--prompt-lengths", type=_int_list, default=PROMPT_LENGTHS, help="例: 32,128,512")
+    parser.add_argument("--output-lengths", type=_int_list, default=OUTPUT_LENGTHS, help="例: 32,128")
+    parser.add_argument("--batch-sizes", type=_int_list, default=BATCH_SIZES, help="例: 1,4")
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--warmup", type=int, default=WARMUP)
+    parser.add_argument("--output", default=None, help="結果のJSONの保存先")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="比較するベースラインのJSON")
+    parser.add_argument("--save-baseline", action="store_true", help="結果をベースラインとして保存（比較しない）")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="悪化の許容割合")
+    parser.add_argument("--case", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    print("=== 推論ベンチマーク ===")
+    # CPUでは最大RSSが前の組み合わせの分を含むため、組み合わせごとに別プロセスで計測する
+    # （モデルを読み込む前に判定し、親プロセスではモデルを読み込まない）
+    on_cpu = args.tiny or inference.DEVICE == "cpu" or not torch.cuda.is_available()
+    if on_cpu and not args.case:
+        case_command = [sys.executable, os.path.abspath(__file__), "--case"]
+        if args.tiny:
+            case_command += ["--tiny"] + (["--tokenizer", args.tokenizer] if args.tokenizer else [])
+        report = run_benchmark(None, None, args.prompt_lengths, args.output_lengths, args.batch_sizes,
+                               args.repeats, args.warmup, case_command=case_command)
+    else:
+        if args.tiny:
+            from rinna_3_6b_tiny_model import tokenizer_name
+
+            model, eos_token_id, pad_token_id = prepare_tiny_benchmark_model(args.tokenizer or tokenizer_name)
+        else:
+            model, tokenizer = inference.prepare_model_and_tokenizer()
+            eos_token_id, pad_token_id = tokenizer.eos_token_id, tokenizer.pad_token_id
+
+        if args.case:
+            # 別プロセスでの1つの組み合わせの計測（最後の行にJSONで出力）
+            result = benchmark_case(model, model.config.vocab_size, args.prompt_lengths[0], args.output_lengths[0],
+                                    args.batch_sizes[0], args.repeats, args.warmup, eos_token_id, pad_token_id)
+            print(json.dumps({"result": result, "meta": benchmark_meta(model, args.repeats)}))
+            return
+
+        report = run_benchmark(model, model.config.vocab_size, args.prompt_lengths, args.output_lengths,
+                               args.batch_sizes, args.repeats, args.warmup, eos_token_id, pad_token_id)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を保存しました: {args.output}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"ベースラインを保存しました: {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"\nベースラインがありません: {args.baseline}（--save-baseline で作成）")
+        return
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(report, baseline, args.threshold)
+    if regressions:
+        print(f"\n❌ {len(regressions)} 項目がベースラインから {args.threshold:.0%} 以上悪化しました")
+        for regression in regressions:
+            print(f"  {regression['case']} {regression['metric']}: "
+                  f"{regression['baseline']:.2f} → {regression['value']:.2f} ({regression['change']:+.1%})")
+        sys.exit(1)
+    print("\n✅ ベースラインからの悪化なし")
+
+
+if __name__ == "__main__":
+    main()
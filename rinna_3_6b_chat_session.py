@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B 推論用 マルチターン対話セッション
+会話全体のトークン列と、そのKVキャッシュを保持し、各ターンでは新しく追加された
+トークンだけをプレフィルする。コンテキスト長の上限に達したら古いターンから削除し、
+残った履歴を再プレフィルする。no_repeat_ngram は現在のターン（質問と回答）だけに適用する。
+
+使い方:
+    python rinna_3_6b_chat_session.py --tiny   # 小型モデルでKV再利用の有無の出力一致とレイテンシを確認
+"""
+
+import argparse
+import sys
+import time
+
+import torch
+from transformers import StoppingCriteriaList
+
+import rinna_3_6b_inference as inference
+from rinna_3_6b_kv_cache import from_legacy, seq_length, slice_seq, to_legacy
+
+# パラメータ
+CHAT_MAX_CONTEXT_TOKENS = 2048  # 履歴 + 新しい質問 + 生成トークンの上限（モデルの最大位置数）
+CHAT_TRIM_RATIO = 0.5  # 上限を超えたとき、履歴をこの割合まで減らす（再プレフィルの頻度を抑える）
+
+
+class ChatSession:
+    """会話履歴のKVキャッシュを保持するマルチターン対話セッション
+
+    各ターンは「プロンプト + 回答 + EOS」のトークン列として保持し、履歴はその連結。
+    KVキャッシュは履歴の末尾のEOSを除く部分まで保持しており、次のターンでは
+    EOS と新しいプロンプトだけをモデルに入力する。
+
+    上限を超える場合は古いターンから削除する。GPT-NeoX の rotary 埋め込みはキーに
+    絶対位置を含むため、先頭を削ったKVはそのまま使えず、残りの履歴を再プレフィルする。
+    削除は上限の CHAT_TRIM_RATIO まで一度に行うので、再プレフィルは数ターンに一度で済む。
+    prefix_cache（rinna_3_6b_prefix_cache.PrefixCache）を指定すると、履歴のKVがないターン
+    （最初のターン・リセットや削除の直後）は共通プレフィックスのKVを再利用する。
+    """
+
+    def __init__(self, model, tokenizer, max_context_tokens=CHAT_MAX_CONTEXT_TOKENS,
+                 trim_ratio=CHAT_TRIM_RATIO, reuse_kv=True, prefix_cache=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_context_tokens = max_context_tokens
+        self.trim_ratio = trim_ratio
+        self.reuse_kv = reuse_kv
+        self.prefix_cache = prefix_cache
+        self.stop_criteria = inference.StopSequenceCriteria(tokenizer)
+        self.reset()
+
+    def reset(self):
+        """会話履歴とKVキャッシュを消去"""
+        self.turns = []
+        self.layers = None
+        self.trims = 0
+        self.prefill_tokens = 0
+        self.reused_tokens = 0
+        self.last_turn = None
+
+    @property
+    def token_ids(self):
+        """履歴全体のトークンID列"""
+        return [token_id for turn in self.turns for token_id in turn]
+
+    def _trim(self, prompt_len, maxTokens):
+        """新しいターンが上限に収まるよう古いターンを削除（削除した場合はKVを破棄）"""
+        history_len = sum(len(turn) for turn in self.turns)
+        if history_len + prompt_len + maxTokens <= self.max_context_tokens:
+            return
+        target = int(self.max_context_tokens * self.trim_ratio)
+        while self.turns and history_len + prompt_len + maxTokens > target:
+            history_len -= len(self.turns.pop(0))
+        self.layers = None
+        self.trims += 1
+
+    def chat(self, instruction, input=None, maxTokens=256, stream=True):
+        """質問を履歴に追加して回答を生成（stream=True なら逐次表示）"""
+        prompt = inference.generate_prompt({'instruction': instruction, 'input': input})
+        # Rinnaのtokenizer()は自動でEOSが追加されるため add_special_tokens=False を指定
+        prompt_ids = self.tokenizer(prompt, add_special_tokens=False).input_ids
+        self._trim(len(prompt_ids), maxTokens)
+        if not self.reuse_kv:
+            self.layers = None
+
+        history = self.token_ids
+        input_ids = torch.tensor([history + prompt_ids], device=self.model.device)
+        layers = self.layers
+        if layers is None and self.prefix_cache is not None:
+            _, layers = self.prefix_cache.lookup(history + prompt_ids)
+        cached = seq_length(layers) if layers is not None else 0
+
+        streamer = inference.TokenStreamPrinter(self.tokenizer, input_ids[0].tolist()) if stream else None
+        if stream:
+            print("回答:")
+        start = time.perf_counter()
+        outputs = self.model.generate(
+            input_ids=input_ids,
+            past_key_values=from_legacy(layers),
+            return_dict_in_generate=True,
+            max_new_tokens=maxTokens,
+            eos_token_id=self.tokenizer.eos_token_id,
+            pad_token_id=self.tokenizer.pad_token_id,
+            stopping_criteria=StoppingCriteriaList([self.stop_criteria]),
+            streamer=streamer,
+            # 前のターンのn-gramまで禁止すると会話が進むほど回答が崩れるため、現在のターンだけを対象にする
+            **inference.sampling_kwargs(ngram_start=len(history)),
+        )
+        latency = time.perf_counter() - start
+        if self.layers is None and self.prefix_cache is not None:
+            self.prefix_cache.insert(history + prompt_ids, outputs.past_key_values)
+
+        # 停止文字列で止まった場合・長さで打ち切られた場合もEOSで終わる形に揃える
+        response_ids = self.stop_criteria.truncate(outputs.sequences[0, input_ids.shape[1]:].tolist())
+        if not response_ids or response_ids[-1] != self.tokenizer.eos_token_id:
+            response_ids.append(self.tokenizer.eos_token_id)
+        self.turns.append(prompt_ids + response_ids)
+
+        # 末尾のEOSはまだモデルに入力していないため、その手前までのKVを保持
+        layers = to_legacy(outputs.past_key_values)
+        self.layers = slice_seq(layers, 0, min(len(self.token_ids) - 1, seq_length(layers)))
+
+        self.prefill_tokens += input_ids.shape[1] - cached
+        self.reused_tokens += cached
+        self.last_turn = {
+            "latency": latency,
+            "prefill_tokens": input_ids.shape[1] - cached,
+            "reused_tokens": cached,
+            "context_tokens": len(self.token_ids),
+            "generated_tokens": outputs.sequences.shape[1] - input_ids.shape[1],
+        }
+
+        if stream:
+            streamer.end()
+            print()
+            inference.print_stream_metrics(streamer.metrics())
+            return streamer.text
+        text = self.tokenizer.decode(response_ids[:-1])
+        return text.replace("<NL>", "\n")
+
+    def stats(self):
+        """ターン数・コンテキスト長・再利用したトークン数"""
+        return {
+            "turns": len(self.turns),
+            "context_tokens": len(self.token_ids),
+            "prefill_tokens": self.prefill_tokens,
+            "reused_tokens": self.reused_tokens,
+            "trims": self.trims,
+        }
+
+
+def main():
+    """小型モデルでKV再利用あり・なしの貪欲生成結果とターンごとのレイテンシを比較（不一致なら終了コード1）"""
+    parser = argparse.ArgumentParser(description="マルチターン対話セッションの動作確認")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    parser.add_argument("--turns", type=int, default=12, help="ターン数")
+    parser.add_argument("--max-new-tokens", type=int, default=32, help="1ターンの最大生成トークン数")
+    parser.add_argument("--max-context", type=int, default=CHAT_MAX_CONTEXT_TOKENS, help="コンテキスト長の上限")
+    args = parser.parse_args()
+
+    from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer, tokenizer_name
+
+    print("=== マルチターン対話セッションの動作確認 ===")
+    if args.tiny:
+        model, tokenizer = prepare_tiny_model_and_tokenizer(args.tokenizer or tokenizer_name)
+    else:
+        model, tokenizer = inference.prepare_model_and_tokenizer()
+    # 貪欲生成で比較（no_repeat_ngram はそのまま）
+    inference.GENERATION_PARAMS = dict(inference.GENERATION_PARAMS, do_sample=False)
+
+    questions = ["日本の首都は？", "その都市の人口は？", "有名な観光地を教えてください", "Pythonの特徴は？"]
+    sessions = {
+        reuse_kv: ChatSession(model, tokenizer, max_context_tokens=args.max_context, reuse_kv=reuse_kv)
+        for reuse_kv in (True, False)
+    }
+
+    matched = 0
+    print(f"{'ターン':>6} {'履歴長':>6} {'再利用':>6} {'プレフィル':>10} {'再利用あり':>10} {'再利用なし':>10}")
+    for turn in range(args.turns):
+        question = questions[turn % len(questions)]
+        responses = {}
+        for reuse_kv, session in sessions.items():
+            with torch.inference_mode():
+                session.chat(question, maxTokens=args.max_new_tokens, stream=False)
+            responses[reuse_kv] = session.turns[-1]
+        matched += responses[True] == responses[False]
+
+        with_kv, without_kv = sessions[True].last_turn, sessions[False].last_turn
+        print(f"{turn + 1:>6} {with_kv['context_tokens']:>6} {with_kv['reused_tokens']:>6} "
+              f"{with_kv['prefill_tokens']:>10} {with_kv['latency'] * 1000:>8.1f}ms "
+              f"{without_kv['latency'] * 1000:>8.1f}ms")
+
+    print(f"\n一致: {matched}/{args.turns}")
+    print(f"セッション統計: {sessions[True].stats()}")
+    if matched < args.turns:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
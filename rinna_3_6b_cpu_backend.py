@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B CPU推論バックエンド
+GPUやbitsandbytesがない環境向けに、ベースモデル + LoRA をfloat32で読み込んでマージし、
+Linear層を PyTorch の動的int8量子化に置き換える。スレッド数はCPUのコア数に合わせて設定する。
+
+使い方:
+    python rinna_3_6b_cpu_backend.py            # float32 と int8 の tokens/sec・メモリ使用量を比較
+    python rinna_3_6b_cpu_backend.py --tiny     # 小型モデルで比較
+"""
+
+import argparse
+import contextlib
+import ctypes
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+# パラメータ
+CPU_INT8 = True  # Linear層を動的int8量子化する
+CPU_THREADS = None  # 演算内の並列スレッド数（None で使用可能なコア数）
+CPU_INTEROP_THREADS = 1  # 演算間の並列スレッド数（生成は1系列ずつなので1）
+
+
+def available_cpus():
+    """このプロセスが使えるCPU数"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def configure_threads(num_threads=CPU_THREADS, interop_threads=CPU_INTEROP_THREADS):
+    """PyTorchのスレッド数を設定（演算間スレッド数は最初の並列処理の前にしか変更できない）"""
+    torch.set_num_threads(num_threads or available_cpus())
+    with contextlib.suppress(RuntimeError):
+        torch.set_num_interop_threads(interop_threads)
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def quantize_int8(model):
+    """Linear層を動的int8量子化（重みはint8、活性は実行時に量子化）"""
+    # inplace=True でモデル全体の複製（一時的にメモリが2倍になる）を避ける
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def release_memory():
+    """解放済みのメモリをOSに返す（glibc では free() しただけでは RSS が減らない）"""
+    gc.collect()
+    with contextlib.suppress(OSError, AttributeError):
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+
+
+def prepare_cpu_model(model, quantize=CPU_INT8):
+    """CPU推論用にモデルを変換（LoRAはマージしてから量子化する）"""
+    configure_threads()
+    # LoRAの追加の行列積をなくし、量子化の対象をベースのLinear層だけにする
+    if hasattr(model, "merge_and_unload"):
+        model = model.merge_and_unload()
+    if quantize:
+        # 重みはメモリマップしたチェックポイントを参照している。量子化で置き換わるLinear層の重み以外
+        # （埋め込み・バイアス等）を複製し、マップ全体（float32の重みのページを含む）を解放できるようにする
+        with torch.no_grad():
+            for module in model.modules():
+                tensors = list(module.named_parameters(recurse=False)) + list(module.named_buffers(recurse=False))
+                for name, tensor in tensors:
+                    if not (isinstance(module, torch.nn.Linear) and name == "weight"):
+                        tensor.data = tensor.data.clone()
+        model = quantize_int8(model)
+        release_memory()
+    model.eval()
+    return model
+
+
+def weights_nbytes(model):
+    """重みのメモリ使用量（量子化済みLinear層のパック済み重みを含む）"""
+    total = 0
+    for value in model.state_dict().values():
+        values = value if isinstance(value, tuple) else (value,)
+        for tensor in values:
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.nelement() * tensor.element_size()
+    return total
+
+
+def resident_memory_mb():
+    """プロセスの常駐メモリ（RSS、MB）"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+
+    # /proc がない環境ではピーク値で代用（macOSはバイト単位）
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+@torch.inference_mode()
+def measure_tokens_per_sec(model, tokenizer, questions, maxTokens=64):
+    """貪欲生成で最大トークン数まで生成させたときの tokens/sec"""
+    from rinna_3_6b_inference import generate_prompt
+
+    generated_tokens = 0
+    elapsed = 0.0
+    for question in questions:
+        input_ids = tokenizer(generate_prompt({'instruction': question, 'input': None}),
+                              return_tensors="pt", add_special_tokens=False).input_ids
+        start = time.perf_counter()
+        outputs = model.generate(input_ids=input_ids, max_new_tokens=maxTokens, min_new_tokens=maxTokens,
+                                 do_sample=False, pad_token_id=tokenizer.pad_token_id)
+        elapsed += time.perf_counter() - start
+        generated_tokens += outputs.shape[1] - input_ids.shape[1]
+    return generated_tokens / elapsed
+
+
+def run_variant(variant, base_name, adapter_name, maxTokens):
+    """1つの設定（fp32 / int8）で読み込みと計測を行い、結果をJSONで出力（子プロセス用）"""
+    # ライブラリの読み込み分を除くため、先に読み込んでから計測を始める
+    import peft  # noqa: F401
+    import transformers  # noqa: F401
+    from rinna_3_6b_startup import load_model_and_tokenizer
+
+    before = resident_memory_mb()
+    model, tokenizer = load_model_and_tokenizer(
+        base_name, adapter_name, device="cpu", cpu_quantize=(variant == "int8"))
+    release_memory()
+    questions = ["日本の首都は？", "自然言語処理とは？", "Pythonの特徴は？"]
+    tokens_per_sec = measure_tokens_per_sec(model, tokenizer, questions, maxTokens)
+    print(json.dumps({
+        "variant": variant,
+        "tokens_per_sec": tokens_per_sec,
+        "rss_mb": resident_memory_mb(),
+        "rss_delta_mb": resident_memory_mb() - before,
+        "weights_mb": weights_nbytes(model) / 1024 ** 2,
+        "threads": torch.get_num_threads(),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU推論（float32 / 動的int8量子化）の比較")
+    parser.add_argument("--base", default=None, help="ベースモデル（省略時は推論スクリプトの設定）")
+    parser.add_argument("--adapter", default=None, help="LoRAアダプター（省略時は推論スクリプトの設定）")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="1問あたりの生成トークン数")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    parser.add_argument("--variant", choices=["fp32", "int8"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args.variant, args.base, args.adapter, args.max_new_tokens)
+        return
+
+    print("=== CPU推論の比較（float32 / int8） ===")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.tiny:
+            from rinna_3_6b_merge_lora import prepare_tiny_checkpoint
+            from rinna_3_6b_tiny_model import tokenizer_name
+
+            # 量子化の効果が見えるよう、語彙以外は少し大きめの構成にする
+            base_name, adapter_name = prepare_tiny_checkpoint(
+                tmp_dir, args.tokenizer or tokenizer_name,
+                hidden_size=1024, num_hidden_layers=4, num_attention_heads=8, intermediate_size=4096)
+        else:
+            from rinna_3_6b_inference import model_name, peft_name
+
+            base_name, adapter_name = args.base or model_name, args.adapter or peft_name
+
+        # メモリ使用量を正しく測るため、設定ごとに別プロセスで実行
+        results = []
+        for variant in ("fp32", "int8"):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--variant", variant,
+                 "--base", base_name, "--adapter", adapter_name,
+                 "--max-new-tokens", str(args.max_new_tokens)],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"スレッド数: {results[0]['threads']}")
+    print(f"{'':8} {'生成速度':>16} {'RSS':>10} {'RSS増分':>10} {'重み':>10}")
+    for result in results:
+        print(f"{result['variant']:8} {result['tokens_per_sec']:>10.1f} tokens/sec "
+              f"{result['rss_mb']:>8.0f}MB {result['rss_delta_mb']:>8.0f}MB {result['weights_mb']:>8.0f}MB")
+    fp32, int8 = results
+    print(f"int8/fp32: 生成速度 {int8['tokens_per_sec'] / fp32['tokens_per_sec']:.2f}x, "
+          f"RSS {int8['rss_mb'] / fp32['rss_mb']:.2f}x, 重み {int8['weights_mb'] / fp32['weights_mb']:.2f}x")
+    # safetensors はメモリマップで読み込まれるため、RSSにはチェックポイントのページ（ページキャッシュ）も含まれる
+    print("※ RSSの増分には読み込み時にメモリマップしたチェックポイントのページも含まれる")
+
+
+if __name__ == "__main__":
+    main()
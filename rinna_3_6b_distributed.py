@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B LoRA学習用 マルチプロセスのデータ並列
+N個のプロセスを起動し（GPUがあれば1プロセス1台・nccl、なければCPU・gloo）、各プロセスで同じ学習処理を実行する。
+Trainer（accelerate）がデータをランクごとに分割し、DistributedDataParallel が学習対象のパラメータ
+（LoRAの重み）の勾配だけを all-reduce する（凍結したベースモデルの重みは通信しない）。
+アダプターの保存はランク0だけが行う。torchrun で起動した場合もそのまま動く。
+
+    if NUM_PROCESSES > 1 and not is_distributed():
+        launch(NUM_PROCESSES, main)   # 各プロセスで main() を実行
+        return
+    init_distributed()
+
+使い方:
+    python rinna_3_6b_distributed.py --tiny   # 小型モデルをglooで1/2/4プロセス学習し、スケーリング効率を表示
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+# パラメータ
+MASTER_ADDR = "127.0.0.1"  # 1台のマシン内で起動する場合のランデブー先
+
+
+def is_distributed():
+    """複数プロセスの学習として起動されているか（launch / torchrun が設定する環境変数で判定）"""
+    return int(os.environ.get("WORLD_SIZE", "1")) > 1
+
+
+def local_rank():
+    return int(os.environ.get("LOCAL_RANK", "0"))
+
+
+def backend():
+    """通信バックエンド（GPUなら nccl、CPUなら gloo）"""
+    return "nccl" if torch.cuda.is_available() else "gloo"
+
+
+def check_device_count(num_processes):
+    """GPUがある場合、1プロセス1台を割り当てられるか確認（足りなければ ValueError）"""
+    if torch.cuda.is_available() and num_processes > torch.cuda.device_count():
+        raise ValueError(f"プロセス数 {num_processes} がGPU数 {torch.cuda.device_count()} を超えています"
+                         "（1プロセスに1台のGPUを割り当てます）")
+
+
+def device_map():
+    """from_pretrained の device_map（データ並列では各プロセスが自分のGPUにモデル全体を置く）"""
+    if is_distributed() and torch.cuda.is_available():
+        return {"": local_rank()}
+    return "auto"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((MASTER_ADDR, 0))
+        return s.getsockname()[1]
+
+
+def _entry(rank, fn, args, world_size, port):
+    os.environ.update(
+        MASTER_ADDR=MASTER_ADDR,
+        MASTER_PORT=str(port),
+        RANK=str(rank),
+        LOCAL_RANK=str(rank),
+        WORLD_SIZE=str(world_size),
+        LOCAL_WORLD_SIZE=str(world_size),
+    )
+    fn(*args)
+
+
+def launch(num_processes, fn, *args):
+    """num_processes 個のプロセスを起動して fn(*args) を実行し、全プロセスの終了を待つ
+
+    fn はモジュールのトップレベルの関数（spawn で子プロセスに渡すため）。
+    どれかのプロセスが例外で終了した場合は残りを停止して例外を送出する。
+    """
+    check_device_count(num_processes)
+    mp.start_processes(_entry, args=(fn, args, num_processes, free_port()), nprocs=num_processes,
+                       start_method="spawn", join=True)
+
+
+def init_distributed():
+    """プロセスグループを初期化して (rank, world_size) を返す（単一プロセスでは (0, 1)）
+
+    Trainer より前に初期化しておくと、データセットの準備をランク0から順に行える（main_process_first）。
+    accelerate は初期化済みのプロセスグループをそのまま使う。
+    """
+    if not is_distributed():
+        return 0, 1
+    # torchrun で起動した場合もこのマシンのプロセス数とGPU数を確認する
+    check_device_count(int(os.environ.get("LOCAL_WORLD_SIZE", os.environ["WORLD_SIZE"])))
+    if not dist.is_initialized():
+        if torch.cuda.is_available():
+            torch.cuda.set_device(local_rank())
+        dist.init_process_group(backend())
+    return dist.get_rank(), dist.get_world_size()
+
+
+@contextlib.contextmanager
+def main_process_first():
+    """ランク0が先に処理し（キャッシュやトークンストアの作成）、他のランクはその後に同じ処理を行う"""
+    rank = dist.get_rank() if dist.is_initialized() else 0
+    if rank != 0:
+        dist.barrier()
+    try:
+        yield
+    finally:
+        if rank == 0 and dist.is_initialized():
+            dist.barrier()
+
+
+def quiet_non_main_process():
+    """ランク0以外の標準出力を捨てる（同じ表示が重複しないように。エラーは標準エラーに出る）"""
+    if dist.is_initialized() and dist.get_rank() != 0:
+        sys.stdout = open(os.devnull, "w")
+
+
+class AllReduceCounter:
+    """DDPの通信フックで all-reduce した要素数を数える（LoRAの勾配だけが通信されることの確認用）"""
+
+    def __init__(self):
+        self.elements = 0
+        self.calls = 0
+
+    def hook(self, state, bucket):
+        self.elements += bucket.buffer().numel()
+        self.calls += 1
+        tensor = bucket.buffer().div_(dist.get_world_size())
+        return dist.all_reduce(tensor, async_op=True).get_future().then(lambda fut: fut.value()[0])
+
+
+def _tiny_worker(options, result_path):
+    """自己チェック用: 小型モデルとLoRAを optimized の Trainer で学習し、結果をランク0が書き出す"""
+    from datasets import Dataset
+    from peft import LoraConfig, TaskType, get_peft_model
+    from torch.nn.parallel import DistributedDataParallel
+    from transformers import DataCollatorForLanguageModeling, TrainerCallback, TrainingArguments
+    from rinna_3_6b_cpu_backend import available_cpus
+    from rinna_3_6b_evaluation import build_eval_batches, evaluate_loss
+    from rinna_3_6b_lora_training_optimized import HeldOutEvalTokenBudgetTrainer
+    from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer
+    from rinna_3_6b_training_metrics import ThroughputCallback
+
+    rank, world_size = init_distributed()
+    torch.set_num_threads(max(1, available_cpus() // world_size))
+    model, tokenizer = prepare_tiny_model_and_tokenizer(
+        options["tokenizer"], hidden_size=options["hidden_size"], num_hidden_layers=4,
+        intermediate_size=options["hidden_size"] * 4)
+    model = get_peft_model(model, LoraConfig(task_type=TaskType.CAUSAL_LM, r=8, lora_alpha=32, lora_dropout=0.1,
+                                             target_modules=["query_key_value"]))
+    lora_elements = sum(param.numel() for param in model.parameters() if param.requires_grad)
+
+    # 先頭トークンをサンプル番号にして、各ランクが学習したサンプルを記録（1ステップ = ランクあたり batch_size 件）
+    batch_size = options["batch_size"]
+    num_rows = options["max_steps"] * batch_size * world_size
+    generator = torch.Generator().manual_seed(0)
+    rows = [{"input_ids": [10 + i] + torch.randint(10, len(tokenizer), (options["seq_len"] - 1,),
+                                                   generator=generator).tolist()} for i in range(num_rows)]
+    seen = set()
+    model.register_forward_pre_hook(
+        lambda module, args, kwargs: seen.update((kwargs["input_ids"][:, 0] - 10).tolist()) if module.training
+        else None, with_kwargs=True)
+
+    counter = AllReduceCounter()
+
+    class RegisterCommHook(TrainerCallback):
+        def on_train_begin(self, args, state, control, **kwargs):
+            if isinstance(trainer.model_wrapped, DistributedDataParallel):
+                trainer.model_wrapped.register_comm_hook(None, counter.hook)
+
+    throughput = ThroughputCallback(tokenizer.pad_token_id)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_dir = options.get("output_dir") or tmp_dir
+        trainer = HeldOutEvalTokenBudgetTrainer(
+            model=model,
+            args=TrainingArguments(
+                output_dir=output_dir,
+                max_steps=options["max_steps"],
+                per_device_train_batch_size=batch_size,
+                learning_rate=1e-3,
+                save_strategy="steps",
+                save_steps=options["max_steps"],
+                report_to="none",
+                use_cpu=not torch.cuda.is_available(),
+                ddp_backend=backend() if world_size > 1 else None,
+                ddp_find_unused_parameters=False,
+                disable_tqdm=True,
+            ),
+            train_dataset=Dataset.from_list(rows),
+            data_collator=DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False),
+            pad_token_id=tokenizer.pad_token_id,
+            callbacks=[throughput, RegisterCommHook()],
+        )
+        trainer.train()
+        adapter_dir = os.path.join(output_dir, "adapter")
+        if trainer.is_world_process_zero():
+            trainer.model.save_pretrained(adapter_dir)
+
+        # 評価はランクごとに分担して集計する（全データを1プロセスで評価した結果と比較）
+        eval_rows = [{"input_ids": row["input_ids"][:options["seq_len"] // 2 + i], "response_start": 4}
+                     for i, row in enumerate(rows[:16])]
+        trainer.eval_max_tokens = options["seq_len"] * 2
+        # 学習対象のLoRAがあっても評価では計算グラフを作らない（inference_mode）ことを確認
+        decoder = model.get_base_model().gpt_neox
+        grad_enabled = []
+        handle = decoder.register_forward_hook(
+            lambda module, args, output: grad_enabled.append(output.last_hidden_state.requires_grad))
+        eval_metrics = trainer.evaluate(eval_rows)
+        handle.remove()
+        expected_eval = evaluate_loss(model, build_eval_batches(eval_rows, max_tokens=trainer.eval_max_tokens))
+
+        # 最初のステップ（ウォームアップ）を除いた tokens/sec
+        records = throughput.history[options["warmup_steps"]:]
+        tokens = sum(r["real_tokens"] for r in records)
+        seconds = sum(r["step_ms"] for r in records) / 1000
+        weights = torch.cat([param.detach().flatten() for param in model.parameters() if param.requires_grad])
+        if world_size > 1:
+            stats = torch.tensor([tokens, seconds], dtype=torch.float64)
+            gathered_stats = [torch.zeros_like(stats) for _ in range(world_size)]
+            dist.all_gather(gathered_stats, stats)
+            gathered_weights = [torch.zeros_like(weights) for _ in range(world_size)]
+            dist.all_gather(gathered_weights, weights)
+            gathered_seen = [None] * world_size
+            dist.all_gather_object(gathered_seen, sorted(seen))
+        else:
+            gathered_stats, gathered_weights, gathered_seen = [torch.tensor([tokens, seconds])], [weights], [sorted(seen)]
+
+        if rank == 0:
+            shards = [set(s) for s in gathered_seen]
+            disjoint = sum(len(s) for s in shards) == len(set().union(*shards))
+            result = {
+                "world_size": world_size,
+                # 全ランクの合計トークン数 / 最も遅いランクの時間
+                "tokens_per_sec": sum(float(s[0]) for s in gathered_stats) / max(float(s[1]) for s in gathered_stats),
+                "lora_elements": lora_elements,
+                "allreduce_elements_per_step": counter.elements / options["max_steps"],
+                "weights_equal": all(torch.equal(w, gathered_weights[0]) for w in gathered_weights),
+                "samples_per_rank": [len(s) for s in shards],
+                "shards_disjoint": disjoint,
+                "eval_sharded": eval_metrics["eval_tokens"] == expected_eval["tokens"]
+                and abs(eval_metrics["eval_loss"] - expected_eval["loss"]) < 1e-3
+                and not any(grad_enabled),
+                "saved_files": sorted(os.listdir(adapter_dir)),
+                "checkpoints": sorted(name for name in os.listdir(output_dir) if name.startswith("checkpoint-")),
+            }
+            with open(result_path, "w", encoding="utf-8") as f:
+                json.dump(result, f)
+        if world_size > 1:
+            dist.barrier()
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def self_check(args):
+    """1/2/…プロセスで学習し、重みの一致・データの分割・評価の分担を確認（失敗すれば終了コード1）"""
+    from rinna_3_6b_cpu_backend import available_cpus
+    from rinna_3_6b_tiny_model import tokenizer_name
+
+    options = dict(tokenizer=args.tokenizer or tokenizer_name, hidden_size=args.hidden_size,
+                   batch_size=args.batch_size, seq_len=args.seq_len, max_steps=args.max_steps,
+                   warmup_steps=args.warmup_steps)
+    device = "GPU" if torch.cuda.is_available() else f"CPU {available_cpus()}コア"
+    print(f"=== データ並列のスケーリング（{backend()}, {device}, ランクあたりバッチ {args.batch_size} × {args.seq_len}トークン） ===")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_processes in args.processes:
+            result_path = os.path.join(tmp_dir, f"result-{num_processes}.json")
+            start = time.perf_counter()
+            if num_processes == 1:
+                _tiny_worker(options, result_path)
+            else:
+                launch(num_processes, _tiny_worker, options, result_path)
+            with open(result_path, encoding="utf-8") as f:
+                result = json.load(f)
+            result["wall_seconds"] = time.perf_counter() - start
+            results.append(result)
+
+    base = results[0]["tokens_per_sec"] / results[0]["world_size"]
+    print(f"{'プロセス':>8} {'tokens/sec':>11} {'速度比':>7} {'効率':>6} {'all-reduce要素/step':>20} {'LoRA要素':>9} "
+          f"{'重み一致':>8} {'分割':>5} {'評価分担':>8} {'サンプル/ランク':>16}")
+    for r in results:
+        speedup = r["tokens_per_sec"] / base
+        print(f"{r['world_size']:>8} {r['tokens_per_sec']:>11.1f} {speedup:>6.2f}x {speedup / r['world_size']:>6.0%} "
+              f"{r['allreduce_elements_per_step']:>20.0f} {r['lora_elements']:>9} "
+              f"{'✅' if r['weights_equal'] else '❌':>8} {'✅' if r['shards_disjoint'] else '❌':>5} "
+              f"{'✅' if r['eval_sharded'] else '❌':>8} {str(r['samples_per_rank']):>16}")
+    print(f"ランク0が保存したアダプター: {results[-1]['saved_files']}, チェックポイント: {results[-1]['checkpoints']}")
+    if not torch.cuda.is_available() and available_cpus() < max(args.processes):
+        print(f"注意: CPUコア数（{available_cpus()}）がプロセス数より少ないため計算は並列化されず、"
+              "この環境の効率は通信と同期のオーバーヘッドの確認用の参考値")
+    if not all(r["weights_equal"] and r["shards_disjoint"] and r["eval_sharded"] for r in results):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="データ並列学習の動作確認とスケーリング効率")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--hidden-size", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--seq-len", type=int, default=128)
+    parser.add_argument("--max-steps", type=int, default=12)
+    parser.add_argument("--warmup-steps", type=int, default=2)
+    args = parser.parse_args()
+    self_check(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B LoRA 評価データでの loss / perplexity
+学習データから一定数を評価用に分割し、回答部分のトークンだけで loss と perplexity を計算する。
+評価データは長さ順に並べてトークン数上限のバッチにまとめ（パディング最小）、
+torch.inference_mode で lm head も回答位置だけに適用するため、学習中に数百ステップごとに実行できる。
+
+    train_split, eval_split = split_eval_data(data["train"], EVAL_SIZE)
+    eval_data = tokenize_eval_data(eval_split, tokenizer, generate_prompt, CUTOFF_LEN)
+    trainer = HeldOutEvalTrainer(..., eval_dataset=eval_data)   # eval_steps ごとに eval_loss / eval_perplexity
+
+使い方:
+    python rinna_3_6b_evaluation.py --adapters lora-rinna-3.6b-optimized lora-rinna-3.6b-results/checkpoint-200 --base
+    python rinna_3_6b_evaluation.py --tiny   # 小型モデルで素朴な計算との一致・速度・複数アダプター・学習中の評価を確認
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+import torch
+import torch.nn.functional as F
+from transformers import Trainer
+
+# パラメータ
+EVAL_SEED = 42  # 評価データ分割のシード（学習と評価コマンドで同じ分割になるよう固定）
+EVAL_BATCH_TOKENS = 8192  # 評価バッチあたりのトークン数上限（パディング込み）
+BASE_ADAPTER = "__base__"  # アダプターなし（ベースモデルのみ）を表す名前
+
+
+def split_eval_data(data, eval_size, seed=EVAL_SEED):
+    """学習データから評価用データを分割（シードが同じなら毎回同じ分割）"""
+    if not eval_size:
+        return data, None
+    split = data.train_test_split(test_size=eval_size, seed=seed)
+    return split["train"], split["test"]
+
+
+def tokenize_eval_data(data, tokenizer, prompt_fn, cutoff_len):
+    """評価データをトークナイズし、回答の開始位置を記録
+
+    回答の開始位置は回答を空にしたプロンプト（"### 回答:<NL>" まで）のトークン数。
+    <NL> は1トークンなので、回答の有無でプロンプト部分の分割は変わらない。
+    切り詰めで回答が残らなかったサンプルは除く。
+    """
+    data_points = list(data)
+    prompts = [prompt_fn(data_point) for data_point in data_points]
+    prefixes = [prompt_fn(dict(data_point, output="")) for data_point in data_points]
+    input_ids = tokenizer(prompts, truncation=True, max_length=cutoff_len, padding=False)["input_ids"]
+    prefix_lengths = [len(ids) for ids in tokenizer(prefixes, add_special_tokens=False)["input_ids"]]
+    examples = [
+        {"input_ids": ids, "response_start": start}
+        for ids, start in zip(input_ids, prefix_lengths)
+        if start < len(ids)
+    ]
+    if len(examples) < len(data_points):
+        print(f"評価データ: 回答が切り詰められた {len(data_points) - len(examples)}件を除外")
+    return examples
+
+
+def build_eval_batches(examples, pad_token_id=0, max_tokens=EVAL_BATCH_TOKENS, sort=True):
+    """長さ順（長い順）にトークン数上限のバッチを作成（テンソルは作成時に1回だけ用意して使い回す）
+
+    各バッチは (input_ids, attention_mask, labels)。labels はプロンプトとパディングを -100 にする。
+    """
+    order = sorted(range(len(examples)), key=lambda i: -len(examples[i]["input_ids"])) if sort \
+        else list(range(len(examples)))
+    batches = []
+    batch = []
+    batch_len = 0
+    for index in order:
+        length = len(examples[index]["input_ids"])
+        if batch and max(batch_len, length) * (len(batch) + 1) > max_tokens:
+            batches.append(batch)
+            batch, batch_len = [], 0
+        batch.append(examples[index])
+        batch_len = max(batch_len, length)
+    if batch:
+        batches.append(batch)
+
+    tensors = []
+    for batch in batches:
+        width = max(len(example["input_ids"]) for example in batch)
+        input_ids = torch.full((len(batch), width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+        labels = torch.full((len(batch), width), -100, dtype=torch.long)
+        for row, example in enumerate(batch):
+            ids = torch.tensor(example["input_ids"], dtype=torch.long)
+            input_ids[row, :len(ids)] = ids
+            attention_mask[row, :len(ids)] = 1
+            labels[row, example["response_start"]:len(ids)] = ids[example["response_start"]:]
+        tensors.append((input_ids, attention_mask, labels))
+    return tensors
+
+
+def loss_metrics(loss_sum, tokens):
+    """loss の合計とトークン数から平均 loss と perplexity を計算"""
+    loss = loss_sum / max(tokens, 1)
+    return {"loss": loss, "perplexity": math.exp(min(loss, 100)), "tokens": tokens}
+
+
+@torch.inference_mode()
+def evaluate_loss(model, batches):
+    """回答部分のトークンの平均 loss と perplexity
+
+    デコーダーの出力のうち次が回答トークンになる位置だけに lm head を適用し、
+    語彙サイズのロジットをパディングやプロンプトの位置で作らない。
+    """
+    was_training = model.training
+    model.eval()
+    base = model.get_base_model() if hasattr(model, "get_base_model") else model
+    decoder = getattr(base, base.base_model_prefix)
+    head = base.get_output_embeddings()
+    device = head.weight.device
+
+    total_loss = torch.zeros((), dtype=torch.float64, device=device)
+    total_tokens = 0
+    try:
+        for input_ids, attention_mask, labels in batches:
+            hidden = decoder(
+                input_ids=input_ids.to(device, non_blocking=True),
+                attention_mask=attention_mask.to(device, non_blocking=True),
+                use_cache=False,
+            ).last_hidden_state
+            targets = labels[:, 1:].to(device, non_blocking=True)
+            mask = targets.ne(-100)
+            logits = head(hidden[:, :-1][mask]).float()
+            total_loss += F.cross_entropy(logits, targets[mask], reduction="sum")
+            total_tokens += int(mask.sum())
+    finally:
+        model.train(was_training)
+
+    return dict(loss_metrics(total_loss.item(), total_tokens), loss_sum=total_loss.item())
+
+
+class HeldOutEvalMixin:
+    """Trainer の評価を evaluate_loss（回答部分のみ・長さ順バッチ）に置き換える Mixin
+
+    eval_dataset には tokenize_eval_data の結果を渡す。eval_strategy / eval_steps の設定どおりに
+    Trainer から呼ばれ、eval_loss / eval_perplexity / eval_tokens / eval_runtime を記録する。
+    バッチは評価データごとに1回だけ作成して使い回す。
+    データ並列ではバッチをランクごとに分担し、loss の合計とトークン数を all-reduce して集計する。
+    """
+
+    eval_max_tokens = EVAL_BATCH_TOKENS
+    eval_seconds = 0.0  # 学習中の評価にかかった時間の合計
+
+    def evaluate(self, eval_dataset=None, ignore_keys=None, metric_key_prefix="eval"):
+        eval_dataset = self.eval_dataset if eval_dataset is None else eval_dataset
+        if getattr(self, "_eval_batches", (None,))[0] is not eval_dataset:
+            # パディングの値は attention_mask と labels で無視されるため任意のトークンでよい
+            pad_token_id = getattr(self.model.config, "pad_token_id", None) or 0
+            self._eval_batches = (eval_dataset, build_eval_batches(eval_dataset, pad_token_id, self.eval_max_tokens))
+
+        batches = self._eval_batches[1]
+        world_size = self.args.world_size
+        if world_size > 1:
+            # 長さ順のバッチを交互に割り当て、ランク間の計算量を揃える
+            batches = batches[self.args.process_index::world_size]
+
+        start = time.perf_counter()
+        with self.accelerator.autocast():
+            result = evaluate_loss(self.model, batches)
+        if world_size > 1:
+            totals = torch.tensor([result["loss_sum"], result["tokens"]], dtype=torch.float64, device=self.args.device)
+            torch.distributed.all_reduce(totals)
+            result = loss_metrics(totals[0].item(), int(totals[1].item()))
+        runtime = time.perf_counter() - start
+        self.eval_seconds += runtime
+
+        metrics = {
+            f"{metric_key_prefix}_loss": round(result["loss"], 4),
+            f"{metric_key_prefix}_perplexity": round(result["perplexity"], 3),
+            f"{metric_key_prefix}_tokens": result["tokens"],
+            f"{metric_key_prefix}_runtime": round(runtime, 3),
+        }
+        self.log(metrics)
+        self.control = self.callback_handler.on_evaluate(self.args, self.state, self.control, metrics)
+        return metrics
+
+
+class HeldOutEvalTrainer(HeldOutEvalMixin, Trainer):
+    """評価データの loss / perplexity を記録する Trainer"""
+
+
+def evaluate_adapters(model, adapters, batches):
+    """1つのベースモデルで複数のアダプターを順に評価（model は PeftModel、adapters は {名前: パス}）
+
+    名前が BASE_ADAPTER のものはアダプターを無効にして評価する。評価したアダプターは解放する。
+    """
+    results = {}
+    for name, path in adapters.items():
+        start = time.perf_counter()
+        if name == BASE_ADAPTER:
+            with model.disable_adapter():
+                result = evaluate_loss(model, batches)
+        else:
+            if name not in model.peft_config:
+                model.load_adapter(path, adapter_name=name)
+            model.set_adapter(name)
+            result = evaluate_loss(model, batches)
+            if len(model.peft_config) > 1:
+                model.delete_adapter(name)
+        results[name] = dict(result, seconds=time.perf_counter() - start)
+        print(f"{name:40} loss {result['loss']:.4f}  perplexity {result['perplexity']:9.3f}  "
+              f"({result['tokens']} tokens, {results[name]['seconds']:.1f}秒)")
+    return results
+
+
+def prepare_adapter_model(base_model, adapters):
+    """評価するアダプターのうち最初のものでPEFTのラッパーを作成（残りは evaluate_adapters で読み込む）"""
+    from peft import LoraConfig, PeftModel, get_peft_model
+
+    paths = {name: path for name, path in adapters.items() if name != BASE_ADAPTER}
+    if paths:
+        name, path = next(iter(paths.items()))
+        return PeftModel.from_pretrained(base_model, path, adapter_name=name)
+    # ベースモデルのみ: disable_adapter() を使えるよう空のLoRAで包む
+    return get_peft_model(base_model, LoraConfig(r=1, target_modules=["query_key_value"]))
+
+
+def naive_eval_loss(model, examples):
+    """比較用: 1件ずつ通常の forward で回答部分の loss を計算"""
+    total_loss = 0.0
+    total_tokens = 0
+    with torch.no_grad():
+        for example in examples:
+            input_ids = torch.tensor([example["input_ids"]])
+            labels = input_ids.clone()
+            labels[:, :example["response_start"]] = -100
+            logits = model(input_ids=input_ids).logits
+            shift_labels = labels[:, 1:]
+            total_loss += F.cross_entropy(logits[:, :-1].flatten(0, 1).float(), shift_labels.flatten(),
+                                          reduction="sum").item()
+            total_tokens += int(shift_labels.ne(-100).sum())
+    return total_loss / total_tokens
+
+
+def synthetic_rows(count, seed=0):
+    """自己チェック用の dolly 形式のデータ（長さがばらばら）"""
+    rng = random.Random(seed)
+    words = ["日本", "首都", "東京", "自然言語処理", "機械学習", "Python", "特徴", "歴史", "説明", "教えて", "です", "。"]
+    rows = []
+    for index in range(count):
+        def text(low, high):
+            return "".join(rng.choice(words) for _ in range(rng.randint(low, high)))
+        rows.append({"id": index, "instruction": text(2, 20), "input": text(0, 30) if rng.random() < 0.3 else "",
+                     "output": text(1, 60)})
+    return rows
+
+
+def self_check(args):
+    from datasets import Dataset
+    from peft import LoraConfig, PeftModel, get_peft_model
+    from transformers import DataCollatorForLanguageModeling, TrainingArguments
+    from rinna_3_6b_lora_training_optimized import CUTOFF_LEN, generate_prompt
+    from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer, tokenizer_name
+
+    tokenizer_path = args.tokenizer or tokenizer_name
+    model, tokenizer = prepare_tiny_model_and_tokenizer(tokenizer_path, num_hidden_layers=4, hidden_size=128)
+    data = Dataset.from_list(synthetic_rows(args.rows))
+    train_split, eval_split = split_eval_data(data, args.eval_size)
+    _, again_eval = split_eval_data(data, args.eval_size)
+    stable = again_eval["id"] == eval_split["id"]
+    disjoint = not set(eval_split["id"]) & set(train_split["id"])
+    checks = [stable, disjoint]
+    print("=== 評価データの分割 ===")
+    print(f"学習 {len(train_split)}件, 評価 {len(eval_split)}件, "
+          f"再分割で同じ: {'✅' if stable else '❌'}, 重複なし: {'✅' if disjoint else '❌'}")
+
+    eval_data = tokenize_eval_data(eval_split, tokenizer, generate_prompt, CUTOFF_LEN)
+    sample = eval_data[0]
+    print(f"回答部分: {tokenizer.decode(sample['input_ids'][sample['response_start']:])!r}")
+    print(f"（元の回答: {eval_split[0]['output'].replace(chr(10), '<NL>')!r}）")
+
+    print("\n=== 素朴な計算との一致と速度 ===")
+    start = time.perf_counter()
+    expected = naive_eval_loss(model, eval_data)
+    naive_seconds = time.perf_counter() - start
+    print(f"{'方式':28} {'loss':>10} {'バッチ':>6} {'パディング率':>12} {'時間':>9}")
+    print(f"{'1件ずつ（全位置のロジット）':28} {expected:>10.6f} {len(eval_data):>6} {0:>12.3f} {naive_seconds:>8.2f}s")
+    for label, sort in (("入力順バッチ", False), ("長さ順バッチ", True)):
+        batches = build_eval_batches(eval_data, tokenizer.pad_token_id, args.max_tokens, sort=sort)
+        padded = sum(ids.numel() for ids, _, _ in batches)
+        real = sum(int(mask.sum()) for _, mask, _ in batches)
+        evaluate_loss(model, batches[:1])
+        start = time.perf_counter()
+        result = evaluate_loss(model, batches)
+        seconds = time.perf_counter() - start
+        same = abs(result["loss"] - expected) < 1e-4
+        checks.append(same)
+        print(f"{label:28} {result['loss']:>10.6f} {len(batches):>6} {1 - real / padded:>12.3f} {seconds:>8.2f}s "
+              f"{'✅' if same else '❌'}")
+    print(f"perplexity: {result['perplexity']:.2f}（回答 {result['tokens']} トークン、語彙 {len(tokenizer)}）")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print("\n=== 複数アダプターの評価（ベースモデルは1回だけ読み込み） ===")
+        adapters = {}
+        for seed in range(2):
+            peft_model = get_peft_model(
+                prepare_tiny_model_and_tokenizer(tokenizer_path, num_hidden_layers=4, hidden_size=128)[0],
+                LoraConfig(r=8, target_modules=["query_key_value"]))
+            torch.manual_seed(seed)
+            with torch.no_grad():
+                for name, param in peft_model.named_parameters():
+                    if "lora_B" in name:
+                        param.normal_(std=0.2)
+            adapters[f"adapter-{seed}"] = os.path.join(tmp_dir, f"adapter-{seed}")
+            peft_model.save_pretrained(adapters[f"adapter-{seed}"])
+        adapters[BASE_ADAPTER] = None
+        base_model = prepare_tiny_model_and_tokenizer(tokenizer_path, num_hidden_layers=4, hidden_size=128)[0]
+        batches = build_eval_batches(eval_data, tokenizer.pad_token_id, args.max_tokens)
+        results = evaluate_adapters(prepare_adapter_model(base_model, adapters), adapters, batches)
+        for name, path in adapters.items():
+            single = prepare_tiny_model_and_tokenizer(tokenizer_path, num_hidden_layers=4, hidden_size=128)[0]
+            if path is not None:
+                single = PeftModel.from_pretrained(single, path)
+            same = abs(naive_eval_loss(single, eval_data) - results[name]["loss"]) < 1e-4
+            checks.append(same)
+            print(f"{name}: 単独で読み込んだモデルと一致 {'✅' if same else '❌'}")
+
+        print(f"\n=== 学習中の評価（{args.eval_steps}ステップごと） ===")
+        train_model = get_peft_model(model, LoraConfig(r=8, lora_alpha=32, target_modules=["query_key_value"]))
+        train_data = train_split.map(lambda row: tokenizer(generate_prompt(row), truncation=True,
+                                                            max_length=CUTOFF_LEN),
+                                     remove_columns=train_split.column_names)
+        training_args = TrainingArguments(
+            output_dir=tmp_dir,
+            max_steps=args.max_steps,
+            per_device_train_batch_size=8,
+            logging_steps=args.eval_steps,
+            eval_strategy="steps",
+            eval_steps=args.eval_steps,
+            learning_rate=1e-3,
+            save_strategy="no",
+            report_to="none",
+            use_cpu=not torch.cuda.is_available(),
+        )
+        trainer = HeldOutEvalTrainer(
+            model=train_model,
+            args=training_args,
+            train_dataset=train_data,
+            eval_dataset=eval_data,
+            data_collator=DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False),
+        )
+        train_model.config.use_cache = False
+        start = time.perf_counter()
+        trainer.train()
+        total = time.perf_counter() - start
+        for logs in trainer.state.log_history:
+            if "eval_loss" in logs:
+                print({key: logs[key] for key in ("step", "eval_loss", "eval_perplexity", "eval_tokens",
+                                                  "eval_runtime")})
+        evals = args.max_steps // args.eval_steps
+        step_seconds = (total - trainer.eval_seconds) / args.max_steps
+        print(f"評価時間: {trainer.eval_seconds:.2f}秒 / 学習全体 {total:.2f}秒 ({trainer.eval_seconds / total:.0%}), "
+              f"1回の評価は学習 {trainer.eval_seconds / evals / step_seconds:.1f}ステップ分")
+    if not all(checks):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="評価データでの loss / perplexity（回答部分のみ）")
+    parser.add_argument("--adapters", nargs="*", default=[], help="評価するアダプター（チェックポイント）のパス")
+    parser.add_argument("--base", action="store_true", help="アダプターなしのベースモデルも評価")
+    parser.add_argument("--max-tokens", type=int, default=EVAL_BATCH_TOKENS, help="評価バッチあたりのトークン数上限")
+    parser.add_argument("--eval-size", type=int, default=None, help="評価データの件数（省略時は学習スクリプトと同じ）")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    parser.add_argument("--rows", type=int, default=1200, help="--tiny 時のデータ件数")
+    parser.add_argument("--eval-steps", type=int, default=10, help="--tiny 時の評価間隔")
+    parser.add_argument("--max-steps", type=int, default=30, help="--tiny 時の学習ステップ数")
+    args = parser.parse_args()
+
+    if args.tiny:
+        if args.eval_size is None:
+            args.eval_size = 200
+        self_check(args)
+        return
+
+    from datasets import load_dataset
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    import rinna_3_6b_lora_training_optimized as training
+
+    adapters = {os.path.normpath(path): path for path in args.adapters}
+    if args.base:
+        adapters[BASE_ADAPTER] = None
+    if not adapters:
+        parser.error("--adapters または --base を指定してください")
+
+    print("=== 評価データの準備 ===")
+    # Rinnaのトークナイザーでは use_fast=False が必要
+    tokenizer = AutoTokenizer.from_pretrained(training.model_name, use_fast=False)
+    data = load_dataset(training.dataset)
+    _, eval_split = split_eval_data(data["train"], args.eval_size or training.EVAL_SIZE)
+    eval_data = tokenize_eval_data(eval_split, tokenizer, training.generate_prompt, training.CUTOFF_LEN)
+    batches = build_eval_batches(eval_data, tokenizer.pad_token_id, args.max_tokens)
+    print(f"評価データ: {len(eval_data)}件, {len(batches)}バッチ")
+
+    print("\n=== モデルの読み込み ===")
+    start = time.perf_counter()
+    base_model = AutoModelForCausalLM.from_pretrained(
+        training.model_name, device_map="auto", torch_dtype=torch.float16)
+    model = prepare_adapter_model(base_model, adapters)
+    print(f"読み込み時間: {time.perf_counter() - start:.1f}秒")
+
+    print("\n=== 評価 ===")
+    evaluate_adapters(model, adapters, batches)
+
+
+if __name__ == "__main__":
+    main()
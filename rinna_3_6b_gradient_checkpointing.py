@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B LoRA学習用 勾配チェックポイント（選択的）
+GPT-NeoXの k 層ごとに forward の中間値を保存せず、backward で再計算して活性化メモリを削減する。
+k=1 で全層、k=2 で1層おきに適用し、メモリと学習時間のバランスを選べる。
+
+4bit量子化のベースモデル + LoRA（query_key_value）では、埋め込みが凍結されていて
+チェックポイント区間の入力が requires_grad を持たないため、従来の reentrant 方式では
+「element 0 of tensors does not require grad」となり勾配が流れない。
+ここでは non-reentrant 方式（torch.utils.checkpoint の use_reentrant=False）を使い、
+入力に requires_grad を付けずに LoRA の勾配を計算する。再計算時の dropout は同じ乱数を使う。
+
+    enable_gradient_checkpointing(model, every_k=2)   # get_peft_model の後、学習前に呼ぶ
+
+使い方:
+    python rinna_3_6b_gradient_checkpointing.py --tiny   # 勾配の一致とメモリ・ステップ時間の比較（CPU）
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+# パラメータ
+CHECKPOINT_EVERY_K = 1  # k層ごとにチェックポイント（1で全層）
+
+
+def decoder_layers(model):
+    """Transformer の層のリスト（PeftModel の場合はベースモデルの層）"""
+    base = model.get_base_model() if hasattr(model, "get_base_model") else model
+    return getattr(base, base.base_model_prefix).layers
+
+
+def enable_gradient_checkpointing(model, every_k=CHECKPOINT_EVERY_K):
+    """k層ごとに勾配チェックポイントを有効化し、チェックポイントを適用した層の番号を返す
+
+    各層の forward を差し替えるため、パラメータ名（LoRAの保存形式）は変わらない。
+    学習モードかつ勾配計算中だけ再計算を行い、推論・評価時は通常の forward のまま。
+    """
+    if every_k < 1:
+        raise ValueError("every_k は1以上を指定してください")
+    # チェックポイント中は KV キャッシュを作らない（再計算と両立しないため）
+    model.config.use_cache = False
+    layers = decoder_layers(model)
+    checkpointed = []
+    for index, layer in enumerate(layers):
+        if "forward" in vars(layer):
+            del layer.forward
+        if index % every_k != 0:
+            continue
+        layer.forward = _checkpointed_forward(layer, layer.forward)
+        checkpointed.append(index)
+    return checkpointed
+
+
+def disable_gradient_checkpointing(model):
+    """enable_gradient_checkpointing で差し替えた forward を元に戻す"""
+    for layer in decoder_layers(model):
+        if "forward" in vars(layer):
+            del layer.forward
+
+
+def _checkpointed_forward(layer, forward):
+    def checkpointed_forward(*args, **kwargs):
+        if not (layer.training and torch.is_grad_enabled()):
+            return forward(*args, **kwargs)
+        if "use_cache" in kwargs:
+            kwargs["use_cache"] = False
+        return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+    return checkpointed_forward
+
+
+def build_tiny_lora_model(tokenizer_path, num_layers, lora_dropout=0.1):
+    """小型モデルに学習スクリプトと同じ構成のLoRA（query_key_value）を適用"""
+    from peft import LoraConfig, TaskType, get_peft_model
+    from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer
+
+    model, tokenizer = prepare_tiny_model_and_tokenizer(
+        tokenizer_path, hidden_size=128, num_attention_heads=4, intermediate_size=512,
+        num_hidden_layers=num_layers, attn_implementation="eager")
+    model = get_peft_model(model, LoraConfig(task_type=TaskType.CAUSAL_LM, r=8, lora_alpha=32,
+                                             lora_dropout=lora_dropout, target_modules=["query_key_value"]))
+    model.train()
+    return model, tokenizer
+
+
+def lora_gradients(model, input_ids, seed=0):
+    """1ステップ分の forward / backward を行い、LoRAパラメータの勾配を返す"""
+    model.zero_grad()
+    torch.manual_seed(seed)
+    loss = model(input_ids=input_ids, labels=input_ids).loss
+    loss.backward()
+    return loss.item(), {name: param.grad.clone() for name, param in model.named_parameters() if param.requires_grad}
+
+
+def current_memory_mb():
+    """計測用のメモリ使用量（GPUは割り当て済みメモリ、CPUはプロセスの最大RSS）"""
+    if torch.cuda.is_available():
+        return torch.cuda.memory_allocated() / 1024 ** 2
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def measure(args):
+    """1つの設定（チェックポイント間隔・系列長）で学習ステップのピークメモリと時間を計測（別プロセスで実行）
+
+    CPUでは最大RSSが減らないため、最初のステップでのピークの増分を活性化メモリとみなす
+    （self_check では解放済みの領域が再利用されてピークが揺れないよう、大きな確保を mmap にして別に実行する）。
+    """
+    model, _ = build_tiny_lora_model(args.tokenizer_path, args.num_layers)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model.to(device)
+    if args.every_k:
+        enable_gradient_checkpointing(model, args.every_k)
+    optimizer = torch.optim.AdamW([param for param in model.parameters() if param.requires_grad], lr=1e-4)
+    input_ids = torch.randint(10, model.config.vocab_size, (args.batch_size, args.seq_len), device=device)
+
+    def step():
+        loss = model(input_ids=input_ids, labels=input_ids).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+    before = current_memory_mb()
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    step()
+    if torch.cuda.is_available():
+        peak = torch.cuda.max_memory_allocated() / 1024 ** 2 - before
+    else:
+        peak = current_memory_mb() - before
+
+    times = []
+    for _ in range(args.steps):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        step()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    print(json.dumps({"peak_mb": peak, "step_ms": sorted(times)[len(times) // 2] * 1000 if times else None}))
+
+
+def self_check(args):
+    """勾配の一致を確認し、チェックポイント間隔・系列長ごとのメモリとステップ時間を表示"""
+    from rinna_3_6b_tiny_model import tokenizer_name
+
+    tokenizer_path = args.tokenizer or tokenizer_name
+    print("=== 勾配の一致（dropout あり） ===")
+    model, _ = build_tiny_lora_model(tokenizer_path, args.num_layers)
+    input_ids = torch.randint(10, model.config.vocab_size, (2, 64))
+    expected_loss, expected = lora_gradients(model, input_ids)
+    checks = []
+    for every_k in (1, 2, 4):
+        layers = enable_gradient_checkpointing(model, every_k)
+        loss, grads = lora_gradients(model, input_ids)
+        diff = max((grads[name] - expected[name]).abs().max().item() for name in expected)
+        same = len(grads) == len(expected) and abs(loss - expected_loss) < 1e-6 and diff < 1e-6
+        checks.append(same)
+        print(f"k={every_k} 層 {layers}: 勾配の最大差 {diff:.2e} {'✅' if same else '❌'}")
+    disable_gradient_checkpointing(model)
+    model.eval()
+    with torch.inference_mode():
+        model(input_ids=input_ids)
+    print(f"推論（inference_mode）: ✅, use_cache={model.config.use_cache}")
+
+    print("\n=== メモリとステップ時間（LoRAのみ学習） ===")
+    modes = [0, 4, 2, 1]
+    device = "GPU" if torch.cuda.is_available() else "CPU（最大RSSの増分）"
+    print(f"{args.num_layers}層, バッチ {args.batch_size}, {device}")
+    print(f"{'系列長':>6} {'チェックポイント':>16} {'ピークメモリ':>12} {'削減':>6} {'ステップ時間':>12} {'増加':>6}")
+    for seq_len in args.seq_lens:
+        baseline = None
+        for every_k in modes:
+            command = [sys.executable, os.path.abspath(__file__), "--measure", "--tokenizer", tokenizer_path,
+                       "--every-k", str(every_k), "--seq-len", str(seq_len), "--batch-size", str(args.batch_size),
+                       "--num-layers", str(args.num_layers)]
+
+            def run(steps, env=None):
+                result = subprocess.run(command + ["--steps", str(steps)], check=True, capture_output=True,
+                                        text=True, env=env)
+                return json.loads(result.stdout.strip().splitlines()[-1])
+
+            measured = run(args.steps)
+            if not torch.cuda.is_available():
+                measured["peak_mb"] = run(0, dict(os.environ, MALLOC_MMAP_THRESHOLD_="65536"))["peak_mb"]
+            baseline = baseline or measured
+            label = "なし" if every_k == 0 else ("全層" if every_k == 1 else f"{every_k}層ごと")
+            print(f"{seq_len:>6} {label:>16} {measured['peak_mb']:>10.1f}MB "
+                  f"{1 - measured['peak_mb'] / baseline['peak_mb']:>6.0%} {measured['step_ms']:>10.1f}ms "
+                  f"{measured['step_ms'] / baseline['step_ms'] - 1:>+6.0%}")
+    if not all(checks):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="選択的な勾配チェックポイントの動作確認")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    parser.add_argument("--num-layers", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--seq-lens", type=int, nargs="+", default=[256, 512, 1024])
+    parser.add_argument("--steps", type=int, default=3)
+    parser.add_argument("--measure", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--every-k", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--seq-len", type=int, default=256, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        args.tokenizer_path = args.tokenizer
+        measure(args)
+        return
+    self_check(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,38 +4,50 @@ Rinna-3.6B LoRAモデル推論実装
 参考: https://note.com/npaka/n/nc387b639e50e
 """
 
-import torch
-from peft import PeftModel, PeftConfig
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import time
+from rinna_3_6b_response_cache import BASE_MODEL_ADAPTER, ResponseCache, is_cacheable
+from rinna_3_6b_startup import StartupProfiler, load_model_and_tokenizer
+
+# torch / transformers（とそれらを使うモジュール）は起動を速くするため、使う関数の中で読み込む
 
 # パラメータ
 model_name = "rinna/japanese-gpt-neox-3.6b"
 peft_name = "lora-rinna-3.6b-optimized"  # 最適化版のパスに修正
+merged_name = None  # LoRAをマージ済みのチェックポイント（rinna_3_6b_merge_lora.py で作成、例: "rinna-3.6b-merged"）
+DEVICE = "auto"  # "auto"（GPUがなければCPU）/ "cuda" / "cpu"（CPUではLoRAをマージして動的int8量子化）
+
+# 生成パラメータ
+GENERATION_PARAMS = dict(
+    do_sample=True,
+    temperature=0.7,
+    top_p=0.75,
+    top_k=40,
+    no_repeat_ngram_size=2,
+)
+USE_FUSED_LOGITS_PROCESSOR = True  # no_repeat_ngram・temperature・top-k・top-p をまとめた高速なロジット処理を使う
+STOP_STRINGS = ["<NL>### 指示:"]  # 生成を打ち切る文字列（テンプレートの次ブロックの開始）
+USE_PREFIX_CACHE = True  # 対話モードで共通プレフィックス（テンプレート等）のKVキャッシュを再利用
+CHAT_HISTORY = True  # 対話モードで会話履歴を保持し、前のターンまでのKVキャッシュを再利用
+USE_RESPONSE_CACHE = False  # 同一リクエストの生成結果を再利用（有効時はシード指定のない生成を貪欲生成にする）
+RESPONSE_CACHE_DIR = None  # レスポンスキャッシュのディスク層（例: "cache/responses"、None でメモリのみ）
+DRAFT_MODEL_NAME = None  # 投機的デコーディングのドラフトモデル（同じトークナイザーの小型モデル、None で使わない）
+SPECULATIVE_K = 4  # 投機的デコーディングで1回の検証あたりにドラフトが生成するトークン数
+MEASURE_THROUGHPUT = False  # テスト質問でバッチサイズ1..Nのtokens/secを計測
 
 def prepare_model_and_tokenizer():
-    """モデルとトークナイザーの準備"""
+    """モデルとトークナイザーの準備（トークナイザーは重みと並行して読み込む）"""
     print("=== モデルとトークナイザーの準備 ===")
     
-    # モデルの準備
-    model = AutoModelForCausalLM.from_pretrained(
-        model_name,
-        load_in_8bit=True,
-        device_map="auto",
-    )
-    
-    # トークナイザーの準備
-    # Rinnaのトークナイザーでは use_fast=False が必要
-    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=False)
-    
-    # LoRAモデルの準備
-    model = PeftModel.from_pretrained(
-        model, 
+    # マージ済みチェックポイントがあればLoRAのラッパーなしで読み込む
+    profiler = StartupProfiler()
+    model, tokenizer = load_model_and_tokenizer(
+        model_name, 
         peft_name, 
-        device_map="auto"
+        merged_name=merged_name, 
+        profiler=profiler, 
+        device=DEVICE
     )
-    
-    # 評価モード
-    model.eval()
+    profiler.report()
     
     print("モデルとトークナイザーの準備完了")
     return model, tokenizer
@@ -62,32 +74,78 @@ def generate_prompt(data_point):
     result = result.replace('\n', '<NL>')
     return result
 
-def generate(model, tokenizer, instruction, input=None, maxTokens=256):
-    """テキスト生成関数"""
-    # 推論
-    prompt = generate_prompt({'instruction': instruction, 'input': input})
-    
-    # Rinnaのtokenizer()は自動でEOSが追加されるため add_special_tokens=False を指定
-    input_ids = tokenizer(prompt, 
-        return_tensors="pt", 
-        truncation=True, 
-        add_special_tokens=False).input_ids.cuda()
-    
-    outputs = model.generate(
-        input_ids=input_ids, 
-        max_new_tokens=maxTokens, 
-        do_sample=True,
-        temperature=0.7, 
-        top_p=0.75, 
-        top_k=40,         
-        no_repeat_ngram_size=2,
-    )
-    outputs = outputs[0].tolist()
-    
-    print("生成された全体:")
-    print(tokenizer.decode(outputs))
-    print("-" * 50)
+class StopSequenceCriteria:
+    """EOSと停止文字列で生成を打ち切る StoppingCriteria（行ごとに判定）
+
+    停止文字列はあらかじめトークンID列に変換しておき、各ステップでは末尾のトークンIDを
+    比較するだけで判定する（全体の再デコードは行わない）。sentencepiece では文脈によって
+    分割が変わるため、単独・文中の両方の分割を候補として登録する。
+    行ごとの判定（bool テンソル）を返すため、transformers 4.39 以降が必要。
+    StoppingCriteriaList は呼び出すだけなので、transformers を読み込まないよう基底クラスは継承しない。
+    """
+
+    def __init__(self, tokenizer, stop_strings=STOP_STRINGS):
+        self.eos_token_id = tokenizer.eos_token_id
+        self.stop_sequences = []
+        space_id = tokenizer.convert_tokens_to_ids("▁")
+        for stop in stop_strings:
+            for context in ("", "a", "。"):
+                context_ids = tokenizer(context, add_special_tokens=False).input_ids if context else []
+                ids = tokenizer(context + stop, add_special_tokens=False).input_ids
+                if ids[:len(context_ids)] != context_ids:
+                    continue
+                ids = ids[len(context_ids):]
+                # 先頭の単独の "▁" は文頭でのみ付くため除外
+                if len(ids) > 1 and ids[0] == space_id:
+                    ids = ids[1:]
+                if ids and ids not in self.stop_sequences:
+                    self.stop_sequences.append(ids)
+        self._tensors = {}
+
+    def _stop_tensor(self, ids, device):
+        key = (tuple(ids), device)
+        if key not in self._tensors:
+            import torch
+
+            self._tensors[key] = torch.tensor(ids, device=device)
+        return self._tensors[key]
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = input_ids[:, -1] == self.eos_token_id
+        for ids in self.stop_sequences:
+            if input_ids.shape[1] >= len(ids):
+                stop = self._stop_tensor(ids, input_ids.device)
+                done |= (input_ids[:, -len(ids):] == stop).all(dim=1)
+        return done
+
+    def ends_with_stop(self, token_ids):
+        """トークンID列の末尾がEOSまたは停止文字列かどうか"""
+        if token_ids and token_ids[-1] == self.eos_token_id:
+            return True
+        return any(
+            len(token_ids) >= len(ids) and token_ids[-len(ids):] == ids
+            for ids in self.stop_sequences
+        )
+
+    def find_stop(self, token_ids):
+        """トークンID列の中で最初に停止する位置（EOSまたは停止文字列の先頭）を返す"""
+        for end in range(1, len(token_ids) + 1):
+            if token_ids[end - 1] == self.eos_token_id:
+                return end - 1
+            for ids in self.stop_sequences:
+                if end >= len(ids) and token_ids[end - len(ids):end] == ids:
+                    return end - len(ids)
+        return None
+
+    def truncate(self, token_ids):
+        """停止位置で切り詰め、EOSで終わるトークン列にする（停止しなかった場合はそのまま）"""
+        stop = self.find_stop(token_ids)
+        if stop is None:
+            return token_ids
+        return token_ids[:stop] + [self.eos_token_id]
 
+def extract_response(tokenizer, outputs):
+    """生成結果のトークン列から回答部分を抽出"""
     # EOSトークンにヒットしたらデコード完了
     if tokenizer.eos_token_id in outputs:
         eos_index = outputs.index(tokenizer.eos_token_id)
@@ -98,9 +156,7 @@ def generate(model, tokenizer, instruction, input=None, maxTokens=256):
         sentinelLoc = decoded.find(sentinel)
         if sentinelLoc >= 0:
             result = decoded[sentinelLoc+len(sentinel):]
-            print("回答:")
-            print(result.replace("<NL>", "\n"))  # <NL>→改行
-            return result.replace("<NL>", "\n")
+            return result.replace("<NL>", "\n")  # <NL>→改行
         else:
             print('Warning: Expected prompt template to be emitted. Ignoring output.')
             return None
@@ -108,19 +164,471 @@ def generate(model, tokenizer, instruction, input=None, maxTokens=256):
         print('Warning: no <eos> detected ignoring output')
         return None
 
-def interactive_chat(model, tokenizer):
-    """対話モード"""
+def build_logits_processor(params=GENERATION_PARAMS, fused=None, ngram_start=0):
+    """生成パラメータから model.generate と同じ順序のロジット処理を作成（独自のデコードループ用）
+
+    fused（省略時は USE_FUSED_LOGITS_PROCESSOR）なら rinna_3_6b_logits_processor の
+    FusedSamplingLogitsProcessor を使う（結果は transformers の処理と同じ）。
+    ngram_start を指定すると no_repeat_ngram は input_ids の ngram_start 以降だけを対象にする。
+    """
+    from transformers import (
+        LogitsProcessorList,
+        NoRepeatNGramLogitsProcessor,
+        TemperatureLogitsWarper,
+        TopKLogitsWarper,
+        TopPLogitsWarper,
+    )
+    from rinna_3_6b_logits_processor import FusedSamplingLogitsProcessor, SuffixLogitsProcessor
+    
+    if USE_FUSED_LOGITS_PROCESSOR if fused is None else fused:
+        return LogitsProcessorList([FusedSamplingLogitsProcessor(params, ngram_start)])
+    processors = LogitsProcessorList()
+    if params.get("no_repeat_ngram_size"):
+        no_repeat_ngram = NoRepeatNGramLogitsProcessor(params["no_repeat_ngram_size"])
+        processors.append(SuffixLogitsProcessor(no_repeat_ngram, ngram_start) if ngram_start else no_repeat_ngram)
+    if params.get("do_sample"):
+        if params.get("temperature") not in (None, 1.0):
+            processors.append(TemperatureLogitsWarper(params["temperature"]))
+        if params.get("top_k"):
+            processors.append(TopKLogitsWarper(params["top_k"]))
+        if params.get("top_p") not in (None, 1.0):
+            processors.append(TopPLogitsWarper(params["top_p"]))
+    return processors
+
+def sample_next_tokens(logits_processor, input_ids, scores, do_sample=GENERATION_PARAMS["do_sample"]):
+    """ロジット処理を適用して次のトークンを選択（input_ids: [batch, seq], scores: [batch, vocab]）"""
+    import torch
+
+    scores = logits_processor(input_ids, scores.float())
+    if do_sample:
+        probs = torch.softmax(scores, dim=-1)
+        return torch.multinomial(probs, num_samples=1).squeeze(1)
+    return scores.argmax(dim=-1)
+
+def sampling_kwargs(params=None, ngram_start=0):
+    """model.generate に渡す生成パラメータ（USE_FUSED_LOGITS_PROCESSOR なら高速なロジット処理に置き換える）
+
+    ngram_start を指定すると no_repeat_ngram は input_ids の ngram_start 以降（対話の現在のターン）だけを対象にする。
+    """
+    from rinna_3_6b_logits_processor import fused_generate_kwargs, processor_generate_kwargs
+
+    params = GENERATION_PARAMS if params is None else params
+    if USE_FUSED_LOGITS_PROCESSOR:
+        return fused_generate_kwargs(params, ngram_start)
+    if ngram_start and params.get("no_repeat_ngram_size"):
+        return processor_generate_kwargs(build_logits_processor(params, fused=False, ngram_start=ngram_start), params)
+    return dict(params)
+
+def prefix_cache_kwargs(prefix_cache, input_ids, adapter=None):
+    """共有プレフィックスKVキャッシュを使う場合の model.generate の追加引数（KVはアダプターごとに分ける）"""
+    if prefix_cache is None:
+        return {}
+    return {
+        "past_key_values": prefix_cache.past_key_values(input_ids[0].tolist(), namespace=adapter),
+        "return_dict_in_generate": True,
+    }
+
+def adapter_kwargs(model, adapter_names):
+    """アダプター指定時の model.generate の追加引数（rinna_3_6b_multi_adapter.AdapterRegistry を参照）"""
+    if adapter_names is None:
+        return {}
+    registry = getattr(model, "adapter_registry", None)
+    if registry is None:
+        raise ValueError("アダプターを選択するには AdapterRegistry を作成してください")
+    return registry.generate_kwargs(adapter_names)
+
+def active_adapter(model, adapter):
+    """生成に使うアダプター名（AdapterRegistry がなければ None、未指定ならレジストリの default）
+
+    直前のリクエストで切り替えたアダプターが残らないよう、未指定でも明示的に選び直す。
+    """
+    registry = getattr(model, "adapter_registry", None)
+    if registry is None:
+        return adapter
+    return registry.resolve(adapter)
+
+def adapter_path(model, adapter):
+    """アダプター名に対応するディレクトリ（未指定なら None、ベースモデルのみなら BASE_MODEL_ADAPTER）"""
+    if adapter is None:
+        return None
+    path = model.adapter_registry.path(adapter)
+    return BASE_MODEL_ADAPTER if path is None else path
+
+def generation_params(response_cache=None, seed=None):
+    """生成パラメータ（レスポンスキャッシュ使用時、シード指定のないサンプリングは結果が決まらないため貪欲生成にする）"""
+    if response_cache is not None and not is_cacheable(GENERATION_PARAMS, seed):
+        return dict(GENERATION_PARAMS, do_sample=False)
+    return GENERATION_PARAMS
+
+def response_cache_key(response_cache, instruction, input, maxTokens, seed=None, adapter_dir=None, params=None):
+    """レスポンスキャッシュのキー（キャッシュ対象外の呼び出しでは None）"""
+    if response_cache is None:
+        return None
+    params = GENERATION_PARAMS if params is None else params
+    if not is_cacheable(params, seed):
+        response_cache.bypass()
+        return None
+    return response_cache.key(instruction, input, params, maxTokens, seed, STOP_STRINGS, 
+                              adapter_dir=adapter_dir)
+
+def generate(model, tokenizer, instruction, input=None, maxTokens=256, prefix_cache=None, 
+             response_cache=None, seed=None, adapter=None, draft_model=None, num_draft_tokens=SPECULATIVE_K):
+    """テキスト生成関数
+
+    prefix_cache 指定時は共通プレフィックスのKVを再利用し、response_cache 指定時は
+    同一リクエストの生成結果を再利用する。seed を指定するとサンプリングの乱数を固定する
+    （response_cache 指定時に seed がなければ貪欲生成にする）。
+    adapter を指定すると AdapterRegistry に登録したLoRAアダプターで生成する
+    （未指定ならレジストリの default。prefix_cache のKVはアダプターごとに分ける）。
+    draft_model を指定すると投機的デコーディング（rinna_3_6b_speculative.py）で生成する
+    （出力の分布は通常の生成と同じ。prefix_cache と adapter の指定には対応しない）。
+    """
+    import torch
+    from transformers import StoppingCriteriaList
+
+    if draft_model is not None:
+        if adapter is not None:
+            raise ValueError("投機的デコーディングではアダプターの切り替えに対応していません")
+        prefix_cache = None
+    adapter = active_adapter(model, adapter)
+    # 推論
+    prompt = generate_prompt({'instruction': instruction, 'input': input})
+    
+    # Rinnaのtokenizer()は自動でEOSが追加されるため add_special_tokens=False を指定
+    input_ids = tokenizer(prompt, 
+        return_tensors="pt", 
+        truncation=True, 
+        add_special_tokens=False).input_ids.to(model.device)
+    
+    stop_criteria = StopSequenceCriteria(tokenizer)
+    params = generation_params(response_cache, seed)
+    cache_key = response_cache_key(response_cache, instruction, input, maxTokens, seed, 
+                                   adapter_path(model, adapter), params)
+    cached = response_cache.get(cache_key) if cache_key is not None else None
+    if cached is not None:
+        outputs = input_ids[0].tolist() + cached
+    else:
+        # 投機的デコーディングでも default のアダプターに切り替えておく
+        generate_kwargs = adapter_kwargs(model, None if adapter is None else [adapter])
+        if seed is not None:
+            torch.manual_seed(seed)
+        if draft_model is not None:
+            from rinna_3_6b_speculative import speculative_generate
+
+            outputs, stats = speculative_generate(
+                model, 
+                draft_model, 
+                input_ids, 
+                maxTokens, 
+                num_draft_tokens, 
+                params, 
+                eos_token_id=tokenizer.eos_token_id, 
+                stop_criteria=stop_criteria,
+            )
+            print(f"投機的デコーディング: 受理率 {stats['acceptance_rate']:.2f}, "
+                  f"{stats['tokens_per_target_forward']:.2f} トークン/検証")
+        else:
+            outputs = model.generate(
+                input_ids=input_ids, 
+                max_new_tokens=maxTokens, 
+                eos_token_id=tokenizer.eos_token_id, 
+                stopping_criteria=StoppingCriteriaList([stop_criteria]), 
+                **prefix_cache_kwargs(prefix_cache, input_ids, adapter), 
+                **generate_kwargs, 
+                **sampling_kwargs(params),
+            )
+            if prefix_cache is not None:
+                prefix_cache.insert(input_ids[0].tolist(), outputs.past_key_values, namespace=adapter)
+                outputs = outputs.sequences
+        # 停止文字列で止まった場合もEOSで終わる形に揃える（generate_batch と同じくこの形でキャッシュに登録）
+        prompt_len = input_ids.shape[1]
+        outputs = outputs[0].tolist()
+        outputs = outputs[:prompt_len] + stop_criteria.truncate(outputs[prompt_len:])
+        if cache_key is not None:
+            response_cache.put(cache_key, outputs[prompt_len:])
+    
+    print("生成された全体:")
+    print(tokenizer.decode(outputs))
+    print("-" * 50)
+
+    result = extract_response(tokenizer, outputs)
+    if result is not None:
+        print("回答:")
+        print(result)
+    return result
+
+def generate_batch(model, tokenizer, requests, maxTokens=256, return_stats=False, response_cache=None, 
+                   adapters=None):
+    """テキスト生成関数（バッチ版）
+
+    requests は (instruction, input) のリスト。GPT-NeoXは左パディングで生成し、
+    行ごとにEOSで完了を判定して generate() と同じ方法で回答を抽出する。
+    response_cache 指定時はキャッシュにないリクエストだけを生成する（結果が決まるよう貪欲生成にする）。
+    adapters はリクエストごとのアダプター名のリスト（異なるアダプターが混在してもよい。
+    None の要素や adapters 未指定はレジストリの default）。
+    """
+    from transformers import StoppingCriteriaList
+
+    # キャッシュ済みのリクエストは生成しない
+    params = generation_params(response_cache)
+    adapters = [active_adapter(model, adapter) for adapter in (adapters or [None] * len(requests))]
+    if all(adapter is None for adapter in adapters):
+        adapters = None
+    adapter_dirs = [adapter_path(model, adapter) for adapter in adapters] if adapters else [None] * len(requests)
+    cache_keys = [
+        response_cache_key(response_cache, instruction, input, maxTokens, adapter_dir=adapter_dir, params=params)
+        for (instruction, input), adapter_dir in zip(requests, adapter_dirs)
+    ]
+    cached = [response_cache.get(key) if key is not None else None for key in cache_keys]
+    pending = [i for i, tokens in enumerate(cached) if tokens is None]
+    
+    prompts = [
+        generate_prompt({'instruction': instruction, 'input': input})
+        for instruction, input in requests
+    ]
+    results = [None] * len(requests)
+    for i, tokens in enumerate(cached):
+        if tokens is not None:
+            prompt_ids = tokenizer(prompts[i], add_special_tokens=False).input_ids
+            results[i] = extract_response(tokenizer, prompt_ids + tokens)
+    
+    if not pending:
+        if return_stats:
+            stats = {"batch_size": len(requests), "generated_tokens": 0, "request_tokens": [0] * len(requests), 
+                     "elapsed": 0.0, "tokens_per_sec": 0.0}
+            return results, stats
+        return results
+    prompts = [prompts[i] for i in pending]
+    
+    # 左パディングでまとめてトークナイズ
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    try:
+        inputs = tokenizer(prompts, 
+            return_tensors="pt", 
+            padding=True, 
+            truncation=True, 
+            add_special_tokens=False).to(model.device)
+    finally:
+        tokenizer.padding_side = padding_side
+    
+    # 行ごとにEOS・停止文字列で完了を判定
+    stop_criteria = StopSequenceCriteria(tokenizer)
+    start = time.perf_counter()
+    outputs = model.generate(
+        input_ids=inputs.input_ids, 
+        attention_mask=inputs.attention_mask, 
+        max_new_tokens=maxTokens, 
+        pad_token_id=tokenizer.pad_token_id, 
+        eos_token_id=tokenizer.eos_token_id, 
+        stopping_criteria=StoppingCriteriaList([stop_criteria]), 
+        **adapter_kwargs(model, [adapters[i] for i in pending] if adapters else None), 
+        **sampling_kwargs(params),
+    )
+    elapsed = time.perf_counter() - start
+    
+    prompt_len = inputs.input_ids.shape[1]
+    prompt_lengths = inputs.attention_mask.sum(dim=1).tolist()
+    generated_tokens = 0
+    request_tokens = [0] * len(requests)
+    for i, row, length in zip(pending, outputs.tolist(), prompt_lengths):
+        # 停止位置以降は完了済み行のパディングなので除外
+        new_tokens = stop_criteria.truncate(row[prompt_len:])
+        generated_tokens += len(new_tokens)
+        request_tokens[i] = len(new_tokens)
+        results[i] = extract_response(tokenizer, row[prompt_len - length:prompt_len] + new_tokens)
+        if cache_keys[i] is not None:
+            response_cache.put(cache_keys[i], new_tokens)
+    
+    if return_stats:
+        stats = {
+            "batch_size": len(pending),
+            "generated_tokens": generated_tokens,
+            "request_tokens": request_tokens,  # リクエストごとの生成トークン数（キャッシュ済みは0）
+            "elapsed": elapsed,
+            "tokens_per_sec": generated_tokens / elapsed if elapsed > 0 else 0.0,
+        }
+        return results, stats
+    return results
+
+class IncrementalDetokenizer:
+    """生成トークンを1つずつ受け取り、新しく確定した文字列だけを返すデトークナイザー
+
+    sentencepiece の単語境界（先頭の空白）を正しく扱うため直前のトークンを文脈として
+    短い区間だけをデコードし、マルチバイト文字の途中（\ufffd）や "<NL>" の途中では出力を保留する。
+    """
+
+    NL = "<NL>"
+
+    def __init__(self, tokenizer, prompt_ids=(), stop_strings=STOP_STRINGS):
+        self.tokenizer = tokenizer
+        self.stop_strings = [stop.replace(self.NL, "\n") for stop in stop_strings]
+        self.stopped = False
+        # 直前の数トークンのみを文脈として保持
+        self.tokens = list(prompt_ids)[-4:]
+        self.prefix_offset = 0
+        self.read_offset = len(self.tokens)
+        self.pending = ""
+
+    def add(self, token_id):
+        """トークンを追加し、新たに確定した文字列を返す（停止文字列以降は返さない）"""
+        if self.stopped:
+            return ""
+        self.tokens.append(token_id)
+        prefix_text = self.tokenizer.decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self.tokenizer.decode(self.tokens[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.tokens)
+        return self._convert_newlines(delta)
+
+    def flush(self):
+        """保留中の文字列を返す"""
+        text, self.pending = self.pending, ""
+        return "" if self.stopped else text
+
+    def _convert_newlines(self, delta):
+        text = (self.pending + delta).replace(self.NL, "\n")  # <NL>→改行
+        # 停止文字列が現れたらその手前までで打ち切る
+        for stop in self.stop_strings:
+            index = text.find(stop)
+            if index >= 0:
+                self.stopped = True
+                self.pending = ""
+                return text[:index]
+        # 末尾が "<NL>" や停止文字列の途中で終わる場合は次のトークンまで保留
+        hold = 0
+        for marker in [self.NL] + self.stop_strings:
+            for length in range(len(marker) - 1, hold, -1):
+                if text.endswith(marker[:length]):
+                    hold = length
+                    break
+        self.pending = text[len(text) - hold:] if hold else ""
+        return text[:len(text) - hold]
+
+class TokenStreamPrinter:
+    """model.generate の streamer として生成トークンを逐次表示し、レイテンシを計測する"""
+
+    def __init__(self, tokenizer, prompt_ids):
+        self.tokenizer = tokenizer
+        self.detokenizer = IncrementalDetokenizer(tokenizer, prompt_ids)
+        self.text = ""
+        self.token_times = []
+        self.start = time.perf_counter()
+        self.skip_prompt = True
+        self.finished = False
+
+    def put(self, value):
+        # 最初の呼び出しはプロンプトなので表示しない
+        if self.skip_prompt:
+            self.skip_prompt = False
+            return
+        for token_id in value.reshape(-1).tolist():
+            if self.finished:
+                continue
+            self.token_times.append(time.perf_counter())
+            if token_id == self.tokenizer.eos_token_id:
+                self.finished = True
+                continue
+            self._emit(self.detokenizer.add(token_id))
+
+    def end(self):
+        self._emit(self.detokenizer.flush())
+        self.finished = True
+
+    def _emit(self, text):
+        if text:
+            self.text += text
+            print(text, end="", flush=True)
+
+    def metrics(self):
+        """TTFT・トークン間レイテンシ・tokens/secを計算"""
+        if not self.token_times:
+            return {"ttft": None, "inter_token_latency": None, "tokens_per_sec": 0.0, "generated_tokens": 0}
+        total = self.token_times[-1] - self.start
+        gaps = [b - a for a, b in zip(self.token_times, self.token_times[1:])]
+        return {
+            "ttft": self.token_times[0] - self.start,
+            "inter_token_latency": sum(gaps) / len(gaps) if gaps else 0.0,
+            "tokens_per_sec": len(self.token_times) / total if total > 0 else 0.0,
+            "generated_tokens": len(self.token_times),
+        }
+
+def generate_stream(model, tokenizer, instruction, input=None, maxTokens=256, prefix_cache=None):
+    """テキスト生成関数（ストリーミング版：生成されたトークンを逐次表示）"""
+    from transformers import StoppingCriteriaList
+
+    prompt = generate_prompt({'instruction': instruction, 'input': input})
+    
+    # Rinnaのtokenizer()は自動でEOSが追加されるため add_special_tokens=False を指定
+    input_ids = tokenizer(prompt, 
+        return_tensors="pt", 
+        truncation=True, 
+        add_special_tokens=False).input_ids.to(model.device)
+    
+    streamer = TokenStreamPrinter(tokenizer, input_ids[0].tolist())
+    print("回答:")
+    outputs = model.generate(
+        input_ids=input_ids, 
+        max_new_tokens=maxTokens, 
+        eos_token_id=tokenizer.eos_token_id, 
+        pad_token_id=tokenizer.pad_token_id, 
+        stopping_criteria=StoppingCriteriaList([StopSequenceCriteria(tokenizer)]), 
+        streamer=streamer, 
+        **prefix_cache_kwargs(prefix_cache, input_ids), 
+        **sampling_kwargs(),
+    )
+    if prefix_cache is not None:
+        prefix_cache.insert(input_ids[0].tolist(), outputs.past_key_values)
+    streamer.end()
+    print()
+    
+    metrics = streamer.metrics()
+    print_stream_metrics(metrics)
+    return streamer.text, metrics
+
+def print_stream_metrics(metrics):
+    """ストリーミング生成のレイテンシを表示"""
+    if metrics["ttft"] is not None:
+        print(f"[TTFT: {metrics['ttft'] * 1000:.0f}ms, "
+              f"トークン間: {metrics['inter_token_latency'] * 1000:.1f}ms, "
+              f"{metrics['tokens_per_sec']:.1f} tokens/sec, "
+              f"{metrics['generated_tokens']}トークン]")
+
+def interactive_chat(model, tokenizer, draft_model=None):
+    """対話モード（draft_model 指定時は会話履歴・逐次表示なしで投機的デコーディングにより生成）"""
     print("\n=== 対話モード ===")
-    print("質問を入力してください（'quit'で終了）:")
+    print("質問を入力してください（'quit'で終了、'reset'で会話履歴を消去）:")
+    
+    from rinna_3_6b_prefix_cache import PrefixCache
+
+    # 共通プレフィックスのKVキャッシュ（会話履歴ありの場合も、履歴のKVがないターンで使う）
+    prefix_cache = PrefixCache() if USE_PREFIX_CACHE else None
+    # 会話履歴のセッション（循環importを避けるためここで読み込む）
+    session = None
+    if CHAT_HISTORY and draft_model is None:
+        from rinna_3_6b_chat_session import ChatSession
+        session = ChatSession(model, tokenizer, prefix_cache=prefix_cache)
     
     while True:
         try:
             question = input("\n質問: ")
             if question.lower() in ['quit', 'exit', 'q']:
                 break
+            if question.lower() == 'reset' and session is not None:
+                session.reset()
+                print("会話履歴を消去しました")
+                continue
             
             print("\n考え中...")
-            generate(model, tokenizer, question)
+            if draft_model is not None:
+                generate(model, tokenizer, question, draft_model=draft_model)
+            elif session is not None:
+                session.chat(question)
+            else:
+                generate_stream(model, tokenizer, question, prefix_cache=prefix_cache)
             
         except KeyboardInterrupt:
             print("\n対話を終了します")
@@ -128,8 +636,8 @@ def interactive_chat(model, tokenizer):
         except Exception as e:
             print(f"エラーが発生しました: {e}")
 
-def run_test_questions(model, tokenizer):
-    """テスト質問の実行"""
+def run_test_questions(model, tokenizer, response_cache=None, draft_model=None):
+    """テスト質問の実行（バッチ生成、draft_model 指定時は1件ずつ投機的デコーディング）"""
     print("\n=== テスト質問の実行 ===")
     
     test_questions = [
@@ -140,11 +648,51 @@ def run_test_questions(model, tokenizer):
         "Pythonの特徴は？"
     ]
     
-    for i, question in enumerate(test_questions, 1):
+    if draft_model is not None:
+        # 投機的デコーディングは1件ずつ生成する（回答と受理率は generate() が表示）
+        for i, question in enumerate(test_questions, 1):
+            print(f"\n--- テスト {i} ---")
+            print(f"質問: {question}")
+            generate(model, tokenizer, question, response_cache=response_cache, draft_model=draft_model)
+            print("=" * 50)
+        return
+    
+    results, stats = generate_batch(
+        model, 
+        tokenizer, 
+        [(question, None) for question in test_questions], 
+        return_stats=True, 
+        response_cache=response_cache
+    )
+    
+    for i, (question, result) in enumerate(zip(test_questions, results), 1):
         print(f"\n--- テスト {i} ---")
         print(f"質問: {question}")
-        generate(model, tokenizer, question)
+        print("回答:")
+        print(result)
         print("=" * 50)
+    
+    print(f"生成トークン数: {stats['generated_tokens']}, {stats['tokens_per_sec']:.1f} tokens/sec")
+    if response_cache is not None:
+        print(f"レスポンスキャッシュ: {response_cache.stats()}")
+    
+    # バッチサイズごとのスループット計測
+    if MEASURE_THROUGHPUT:
+        measure_batch_throughput(model, tokenizer, test_questions)
+
+def measure_batch_throughput(model, tokenizer, questions, maxTokens=256):
+    """バッチサイズ1..Nでのスループット計測"""
+    print("\n=== バッチサイズ別スループット ===")
+    
+    for batch_size in range(1, len(questions) + 1):
+        generated_tokens = 0
+        elapsed = 0.0
+        for start in range(0, len(questions), batch_size):
+            batch = [(question, None) for question in questions[start:start + batch_size]]
+            _, stats = generate_batch(model, tokenizer, batch, maxTokens, return_stats=True)
+            generated_tokens += stats["generated_tokens"]
+            elapsed += stats["elapsed"]
+        print(f"バッチサイズ {batch_size}: {generated_tokens / elapsed:.1f} tokens/sec")
 
 def main():
     """メイン処理"""
@@ -156,11 +704,22 @@ def main():
         # モデルとトークナイザーの準備
         model, tokenizer = prepare_model_and_tokenizer()
         
+        # レスポンスキャッシュ（アダプターの重みが変わると自動的に無効化）
+        response_cache = None
+        if USE_RESPONSE_CACHE:
+            response_cache = ResponseCache(model_name, merged_name or peft_name, RESPONSE_CACHE_DIR)
+        
+        # 投機的デコーディングのドラフトモデル
+        draft_model = None
+        if DRAFT_MODEL_NAME is not None:
+            from rinna_3_6b_speculative import prepare_draft_model
+            draft_model = prepare_draft_model(DRAFT_MODEL_NAME, model.device)
+        
         # テスト質問の実行
-        run_test_questions(model, tokenizer)
+        run_test_questions(model, tokenizer, response_cache, draft_model)
         
         # 対話モード
-        interactive_chat(model, tokenizer)
+        interactive_chat(model, tokenizer, draft_model)
         
     except Exception as e:
         print(f"エラーが発生しました: {e}")
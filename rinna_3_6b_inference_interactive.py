@@ -4,111 +4,45 @@ Rinna-3.6B LoRAモデル推論実装（対話専用版）
 参考: https://note.com/npaka/n/nc387b639e50e
 """
 
-import torch
-from peft import PeftModel, PeftConfig
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import argparse
+from rinna_3_6b_startup import BackgroundStartup, StartupProfiler, load_model_and_tokenizer
+
+# torch / transformers / peft は起動を速くするため、モデルの読み込み時に読み込む
 
 # パラメータ
 model_name = "rinna/japanese-gpt-neox-3.6b"
 peft_name = "lora-rinna-3.6b-optimized"  # 最適化版のパスに修正
+merged_name = None  # LoRAをマージ済みのチェックポイント（rinna_3_6b_merge_lora.py で作成、例: "rinna-3.6b-merged"）
+DEVICE = "auto"  # "auto"（GPUがなければCPU）/ "cuda" / "cpu"（CPUではLoRAをマージして動的int8量子化）
 
-def prepare_model_and_tokenizer():
-    """モデルとトークナイザーの準備"""
+def prepare_model_and_tokenizer(base=model_name, adapter=peft_name, load_in_8bit=True, profiler=None, 
+                                device=DEVICE):
+    """モデルとトークナイザーの準備（トークナイザーは重みと並行して読み込む）"""
     print("=== モデルとトークナイザーの準備 ===")
     
-    # モデルの準備
-    model = AutoModelForCausalLM.from_pretrained(
-        model_name,
-        load_in_8bit=True,
-        device_map="auto",
-    )
-    
-    # トークナイザーの準備
-    # Rinnaのトークナイザーでは use_fast=False が必要
-    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=False)
-    
-    # LoRAモデルの準備
-    model = PeftModel.from_pretrained(
-        model, 
-        peft_name, 
-        device_map="auto"
+    # マージ済みチェックポイントがあればLoRAのラッパーなしで読み込む
+    model, tokenizer = load_model_and_tokenizer(
+        base, 
+        adapter, 
+        merged_name=merged_name, 
+        load_in_8bit=load_in_8bit, 
+        profiler=profiler, 
+        device=device
     )
     
-    # 評価モード
-    model.eval()
-    
     print("モデルとトークナイザーの準備完了")
     return model, tokenizer
 
-def generate_prompt(data_point):
-    """プロンプトテンプレートの準備（推論用：レスポンス内容なし版）"""
-    if data_point["input"]:
-        result = f"""### 指示:
-{data_point["instruction"]}
-
-### 入力:
-{data_point["input"]}
-
-### 回答:
-"""
-    else:
-        result = f"""### 指示:
-{data_point["instruction"]}
-
-### 回答:
-"""
-
-    # 改行→<NL>
-    result = result.replace('\n', '<NL>')
-    return result
-
-def generate(model, tokenizer, instruction, input=None, maxTokens=256):
-    """テキスト生成関数"""
-    # 推論
-    prompt = generate_prompt({'instruction': instruction, 'input': input})
-    
-    # Rinnaのtokenizer()は自動でEOSが追加されるため add_special_tokens=False を指定
-    input_ids = tokenizer(prompt, 
-        return_tensors="pt", 
-        truncation=True, 
-        add_special_tokens=False).input_ids.cuda()
-    
-    outputs = model.generate(
-        input_ids=input_ids, 
-        max_new_tokens=maxTokens, 
-        do_sample=True,
-        temperature=0.7, 
-        top_p=0.75, 
-        top_k=40,         
-        no_repeat_ngram_size=2,
-    )
-    outputs = outputs[0].tolist()
-
-    # EOSトークンにヒットしたらデコード完了
-    if tokenizer.eos_token_id in outputs:
-        eos_index = outputs.index(tokenizer.eos_token_id)
-        decoded = tokenizer.decode(outputs[:eos_index])
-
-        # レスポンス内容のみ抽出
-        sentinel = "### 回答:"
-        sentinelLoc = decoded.find(sentinel)
-        if sentinelLoc >= 0:
-            result = decoded[sentinelLoc+len(sentinel):]
-            print("\n回答:")
-            print(result.replace("<NL>", "\n"))  # <NL>→改行
-            return result.replace("<NL>", "\n")
-        else:
-            print('Warning: Expected prompt template to be emitted. Ignoring output.')
-            return None
-    else:
-        print('Warning: no <eos> detected ignoring output')
-        return None
-
-def interactive_chat(model, tokenizer):
-    """対話モード"""
+def interactive_chat(model, tokenizer, startup=None, profiler=None):
+    """対話モード（startup 指定時はモデルの読み込み完了を待たずに質問を受け付ける）"""
     print("\n=== 対話モード ===")
     print("質問を入力してください（'quit'で終了）:")
     
+    if profiler is not None:
+        profiler.record("最初のプロンプトまで", profiler.elapsed())
+        if model is not None:
+            profiler.report()
+    
     while True:
         try:
             question = input("\n質問: ")
@@ -117,7 +51,20 @@ def interactive_chat(model, tokenizer):
                 break
             
             print("\n考え中...")
-            generate(model, tokenizer, question)
+        except KeyboardInterrupt:
+            print("\n対話を終了します")
+            break
+        
+        if model is None:
+            # バックグラウンドでの読み込みの完了を待つ（失敗した場合は main() で表示）
+            model, tokenizer = startup.wait()
+            if profiler is not None:
+                profiler.report()
+        
+        try:
+            # torch を読み込むため、モデルの準備ができてから読み込む
+            from rinna_3_6b_inference import generate_stream
+            generate_stream(model, tokenizer, question)
             
         except KeyboardInterrupt:
             print("\n対話を終了します")
@@ -127,16 +74,41 @@ def interactive_chat(model, tokenizer):
 
 def main():
     """メイン処理"""
+    parser = argparse.ArgumentParser(description="Rinna-3.6B LoRAモデル推論（対話専用版）")
+    parser.add_argument("--base", default=model_name, help="ベースモデル")
+    parser.add_argument("--adapter", default=peft_name, help="LoRAアダプター")
+    parser.add_argument("--no-8bit", action="store_true", help="GPUで8bit量子化せずに読み込む")
+    parser.add_argument("--device", default=DEVICE, choices=["auto", "cuda", "cpu"], 
+                        help="推論デバイス（cpu ではLoRAをマージして動的int8量子化）")
+    parser.add_argument("--eager", action="store_true", help="モデルを読み込んでから質問を受け付ける（従来の起動）")
+    args = parser.parse_args()
+    
+    profiler = StartupProfiler()
     print("Rinna-3.6B LoRAモデル推論（対話専用版）")
     print("参考: https://note.com/npaka/n/nc387b639e50e")
     print("=" * 50)
     
     try:
-        # モデルとトークナイザーの準備
-        model, tokenizer = prepare_model_and_tokenizer()
+        if args.eager:
+            # モデルとトークナイザーの準備
+            model, tokenizer = prepare_model_and_tokenizer(
+                args.base, args.adapter, not args.no_8bit, profiler, args.device)
+            startup = None
+        else:
+            # モデルはバックグラウンドで読み込み、その間に最初の質問を受け付ける
+            model = tokenizer = None
+            startup = BackgroundStartup(
+                load_model_and_tokenizer, 
+                args.base, 
+                args.adapter, 
+                merged_name=merged_name, 
+                load_in_8bit=not args.no_8bit, 
+                profiler=profiler, 
+                device=args.device
+            )
         
         # 対話モード（テストをスキップ）
-        interactive_chat(model, tokenizer)
+        interactive_chat(model, tokenizer, startup, profiler)
         
     except Exception as e:
         print(f"エラーが発生しました: {e}")
@@ -144,4 +116,4 @@ def main():
         print("先に rinna_3_6b_lora_training.py を実行してください。")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
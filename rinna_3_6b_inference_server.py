@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B LoRAモデル推論サーバー（連続バッチング）
+asyncio で並行リクエストを受け付け、デコード1ステップごとにバッチを組み替える
+（新しいリクエストは実行中のバッチに途中参加し、完了したリクエストはその場で抜ける）
+
+使い方:
+    python rinna_3_6b_inference_server.py                     # HTTPサーバーとして起動
+    python rinna_3_6b_inference_server.py --tiny --load-test 64  # 小型モデルで負荷試験（貪欲生成で1件ずつの生成結果と照合）
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import math
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from rinna_3_6b_inference import (
+    GENERATION_PARAMS,
+    StopSequenceCriteria,
+    generate_prompt,
+    prepare_model_and_tokenizer,
+    sampling_kwargs,
+)
+from rinna_3_6b_kv_cache import concat_rows, from_legacy, select_rows, slice_seq, to_legacy
+from rinna_3_6b_logits_processor import FusedSamplingLogitsProcessor, IncrementalNoRepeatNGram
+
+# パラメータ
+HOST = "127.0.0.1"
+PORT = 8000
+MAX_BATCH_SIZE = 8  # 同時にデコードするリクエスト数の上限
+MAX_QUEUE = 64  # 待ち行列の上限（超えた場合は503を返す）
+MAX_NEW_TOKENS = 256  # リクエストごとの生成トークン数の上限
+
+LOAD_TEST_QUESTIONS = [
+    "自然言語処理とは？",
+    "日本の首都は？",
+    "まどか☆マギカで一番かわいいのは？",
+    "機械学習について教えて",
+    "Pythonの特徴は？"
+]
+
+
+def percentile(values, q):
+    """パーセンタイル（最近傍順位法）"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, math.ceil(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+class GenerationRequest:
+    """1件の生成リクエストの状態
+
+    トークン列はデバイス上のバッファ（プロンプト + 最大生成トークン数）に追記していき、
+    デコードのたびにテンソルを作り直さない。
+    """
+
+    def __init__(self, prompt_ids, max_new_tokens, future, device, ngram_size=None):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.future = future
+        self.tokens = torch.empty(len(prompt_ids) + max_new_tokens, dtype=torch.long, device=device)
+        self.tokens[:len(prompt_ids)] = torch.tensor(prompt_ids)
+        self.length = len(prompt_ids)
+        # no_repeat_ngram の出現済みn-gramはリクエストごとに増分で保持する
+        self.no_repeat_ngram = IncrementalNoRepeatNGram(ngram_size) if ngram_size else None
+        self.generated = []
+        self.submitted_at = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+        self.finish_reason = None
+
+    def input_ids(self):
+        """これまでのトークン列 [1, length]（バッファのビュー）"""
+        return self.tokens[None, :self.length]
+
+
+class ContinuousBatchingEngine:
+    """反復単位の連続バッチングでリクエストをスケジューリングする生成エンジン
+
+    実行中のバッチのKVキャッシュは左パディングで揃えて保持し、新しいリクエストは
+    単独でプレフィルしてからバッチに連結する。デコードは1ステップずつ全行まとめて行う。
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=MAX_BATCH_SIZE, max_queue=MAX_QUEUE,
+                 max_new_tokens=MAX_NEW_TOKENS, params=GENERATION_PARAMS):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = model.device
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = params.get("do_sample", False)
+        self.ngram_size = params.get("no_repeat_ngram_size")
+        # temperature・top-k・top-p は系列に依存しないため、全行まとめて1回で適用する
+        self.sampler = FusedSamplingLogitsProcessor(dict(params, no_repeat_ngram_size=None))
+        self.stop_criteria = StopSequenceCriteria(tokenizer)
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        # モデルの計算はイベントループを止めないよう専用スレッドで実行
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.waiting = []
+        self.active = []
+        self.cache = None
+        self.attention_mask = None
+
+        self.started_at = time.perf_counter()
+        self.completed = 0
+        self.generated_tokens = 0
+        self.latencies = collections.deque(maxlen=10000)
+        self.ttfts = collections.deque(maxlen=10000)
+
+    async def submit(self, instruction, input=None, max_new_tokens=None):
+        """リクエストを待ち行列に追加し、生成完了まで待つ（満杯なら asyncio.QueueFull）"""
+        prompt = generate_prompt({'instruction': instruction, 'input': input})
+        # Rinnaのtokenizer()は自動でEOSが追加されるため add_special_tokens=False を指定
+        prompt_ids = self.tokenizer(prompt, add_special_tokens=False).input_ids
+        if max_new_tokens is None:
+            max_new_tokens = self.max_new_tokens
+        max_new_tokens = max(1, min(int(max_new_tokens), self.max_new_tokens))
+
+        request = GenerationRequest(prompt_ids, max_new_tokens, asyncio.get_running_loop().create_future(),
+                                    self.device, self.ngram_size)
+        self.queue.put_nowait(request)
+        return await request.future
+
+    async def run(self):
+        """スケジューリングループ"""
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.active and not self.waiting:
+                self.waiting.append(await self.queue.get())
+            # 空きがあれば待ち行列から実行中のバッチに参加させる
+            while len(self.active) + len(self.waiting) < self.max_batch_size and not self.queue.empty():
+                self.waiting.append(self.queue.get_nowait())
+
+            try:
+                finished = await loop.run_in_executor(self.executor, self._step)
+            except Exception as e:
+                print(f"エラーが発生しました: {e}")
+                for request in self.active + self.waiting:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                self.waiting, self.active = [], []
+                self.cache, self.attention_mask = None, None
+                continue
+
+            for request in finished:
+                if not request.future.done():
+                    request.future.set_result(self._result(request))
+
+    def _result(self, request):
+        self.completed += 1
+        self.generated_tokens += len(request.generated)
+        latency = request.finished_at - request.submitted_at
+        ttft = request.first_token_at - request.submitted_at
+        self.latencies.append(latency)
+        self.ttfts.append(ttft)
+
+        tokens = request.generated
+        if request.finish_reason in ("eos", "stop"):
+            # EOS・停止文字列は回答に含めない
+            tokens = self.stop_criteria.truncate(tokens)[:-1]
+        text = self.tokenizer.decode(tokens)
+        return {
+            "response": text.replace("<NL>", "\n"),  # <NL>→改行
+            "finish_reason": request.finish_reason,
+            "generated_tokens": len(request.generated),
+            "latency": latency,
+            "ttft": ttft,
+        }
+
+    def stats(self):
+        """レイテンシとスループットの統計"""
+        elapsed = time.perf_counter() - self.started_at
+        latencies = list(self.latencies)
+        ttfts = list(self.ttfts)
+        return {
+            "completed": self.completed,
+            "active": len(self.active),
+            "queued": self.queue.qsize(),
+            "generated_tokens": self.generated_tokens,
+            "tokens_per_sec": self.generated_tokens / elapsed if elapsed > 0 else 0.0,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p99": percentile(latencies, 99),
+            "ttft_p50": percentile(ttfts, 50),
+            "ttft_p99": percentile(ttfts, 99),
+        }
+
+    def _sample(self, requests, logits):
+        scores = logits.float()
+        if self.ngram_size:
+            # 各リクエストの禁止トークンを集めて1回で -inf にする
+            rows, banned = [], []
+            for row, request in enumerate(requests):
+                _, tokens = request.no_repeat_ngram.banned_tokens(request.input_ids())
+                rows.append(torch.full_like(tokens, row))
+                banned.append(tokens)
+            scores[torch.cat(rows), torch.cat(banned)] = -float("inf")
+        scores = self.sampler.warp(scores)
+        if self.do_sample:
+            next_tokens = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+        else:
+            next_tokens = scores.argmax(dim=-1)
+        # バッファへの追記はデバイス上でコピーする（ホストへの転送は最後の1回だけ）
+        for row, request in enumerate(requests):
+            request.tokens[request.length] = next_tokens[row]
+            request.length += 1
+        return next_tokens.tolist()
+
+    def _append_token(self, request, token):
+        now = time.perf_counter()
+        if request.first_token_at is None:
+            request.first_token_at = now
+        request.generated.append(token)
+        if token == self.tokenizer.eos_token_id:
+            request.finish_reason = "eos"
+        elif self.stop_criteria.ends_with_stop(request.generated):
+            request.finish_reason = "stop"
+        elif len(request.generated) >= request.max_new_tokens:
+            request.finish_reason = "length"
+        if request.finish_reason is not None:
+            request.finished_at = now
+            return True
+        return False
+
+    @torch.inference_mode()
+    def _step(self):
+        finished = []
+
+        # 新しいリクエストのプレフィル（単独で計算してからバッチに連結）
+        waiting, self.waiting = self.waiting, []
+        for request in waiting:
+            input_ids = torch.tensor([request.prompt_ids], device=self.device)
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+            token = self._sample([request], outputs.logits[:, -1, :])[0]
+            if self._append_token(request, token):
+                finished.append(request)
+                continue
+            self._join(request, to_legacy(outputs.past_key_values), len(request.prompt_ids))
+
+        if not self.active:
+            return finished
+
+        # 実行中の全リクエストをまとめて1ステップデコード
+        batch_size = len(self.active)
+        input_ids = torch.stack([request.tokens[request.length - 1] for request in self.active])[:, None]
+        position_ids = torch.tensor(
+            [[len(request.prompt_ids) + len(request.generated) - 1] for request in self.active],
+            device=self.device,
+        )
+        self.attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones((batch_size, 1))], dim=1
+        )
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=from_legacy(self.cache),
+            use_cache=True,
+        )
+        self.cache = to_legacy(outputs.past_key_values)
+        tokens = self._sample(self.active, outputs.logits[:, -1, :])
+
+        keep = []
+        for index, (request, token) in enumerate(zip(self.active, tokens)):
+            if self._append_token(request, token):
+                finished.append(request)
+            else:
+                keep.append(index)
+        if len(keep) < batch_size:
+            self._leave(keep)
+        return finished
+
+    def _join(self, request, cache, length):
+        mask = torch.ones((1, length), dtype=torch.long, device=self.device)
+        if not self.active:
+            self.cache, self.attention_mask = cache, mask
+        else:
+            total = max(self.attention_mask.shape[1], length)
+            self.cache = concat_rows([self.cache, cache])
+            self.attention_mask = torch.cat([
+                torch.nn.functional.pad(self.attention_mask, (total - self.attention_mask.shape[1], 0)),
+                torch.nn.functional.pad(mask, (total - length, 0)),
+            ], dim=0)
+        self.active.append(request)
+
+    def _leave(self, keep):
+        self.active = [self.active[index] for index in keep]
+        if not self.active:
+            self.cache, self.attention_mask = None, None
+            return
+        indices = torch.tensor(keep, device=self.device)
+        self.cache = select_rows(self.cache, indices)
+        self.attention_mask = self.attention_mask.index_select(0, indices)
+        # 全行がパディングの先頭列を削除
+        used = self.attention_mask.any(dim=0).nonzero()
+        start = int(used[0]) if len(used) else 0
+        if start > 0:
+            self.cache = slice_seq(self.cache, start)
+            self.attention_mask = self.attention_mask[:, start:]
+
+
+def http_response(status, body):
+    """HTTPレスポンスの作成"""
+    reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 503: "Service Unavailable"}
+    payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    header = (
+        f"HTTP/1.1 {status} {reasons.get(status, '')}\r\n"
+        "Content-Type: application/json; charset=utf-8\r\n"
+        f"Content-Length: {len(payload)}\r\n"
+        "Connection: close\r\n\r\n"
+    )
+    return header.encode("ascii") + payload
+
+
+async def handle_connection(engine, reader, writer):
+    """HTTPリクエストの処理（POST /generate, GET /stats）"""
+    try:
+        request_line = (await reader.readline()).decode("ascii").split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if len(request_line) < 2:
+            response = http_response(400, {"error": "不正なリクエストです"})
+        elif request_line[0] == "GET" and request_line[1] == "/stats":
+            response = http_response(200, engine.stats())
+        elif request_line[0] == "POST" and request_line[1] == "/generate":
+            try:
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                data = json.loads(body or b"{}")
+                result = await engine.submit(
+                    data["instruction"],
+                    data.get("input"),
+                    data.get("max_new_tokens"),
+                )
+                response = http_response(200, result)
+            except asyncio.QueueFull:
+                response = http_response(503, {"error": "待ち行列が満杯です"})
+            except (KeyError, ValueError) as e:
+                response = http_response(400, {"error": f"不正なリクエストです: {e}"})
+        else:
+            response = http_response(404, {"error": "見つかりません"})
+
+        writer.write(response)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_server(engine, host=HOST, port=PORT, unix_socket=None):
+    """HTTPサーバーの起動（unix_socket 指定時はUnixソケットで待ち受け）"""
+    async def handler(reader, writer):
+        await handle_connection(engine, reader, writer)
+
+    if unix_socket:
+        return await asyncio.start_unix_server(handler, path=unix_socket)
+    return await asyncio.start_server(handler, host, port)
+
+
+async def post_json(path, body, host=HOST, port=PORT, unix_socket=None):
+    """サーバーへJSONをPOSTしてレスポンスを取得"""
+    if unix_socket:
+        reader, writer = await asyncio.open_unix_connection(unix_socket)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("ascii") + payload
+    )
+    await writer.drain()
+    raw = await reader.read()
+    writer.close()
+    header, _, content = raw.partition(b"\r\n\r\n")
+    status = int(header.split()[1])
+    return status, json.loads(content)
+
+
+async def run_load_test(num_requests, concurrency, max_new_tokens, host=HOST, port=PORT, unix_socket=None):
+    """合成負荷をかけてレイテンシ（p50/p99）と全体スループットを計測"""
+    print(f"\n=== 負荷試験: {num_requests}件, 同時実行数 {concurrency} ===")
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    generated_tokens = 0
+    rejected = 0
+    errors = 0
+    responses = collections.defaultdict(list)
+
+    async def one(index):
+        nonlocal generated_tokens, rejected, errors
+        async with semaphore:
+            start = time.perf_counter()
+            question = LOAD_TEST_QUESTIONS[index % len(LOAD_TEST_QUESTIONS)]
+            status, result = await post_json(
+                "/generate",
+                {
+                    "instruction": question,
+                    "max_new_tokens": max_new_tokens,
+                },
+                host, port, unix_socket,
+            )
+            if status == 503:
+                rejected += 1
+                return
+            if status != 200:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+            generated_tokens += result["generated_tokens"]
+            responses[question].append(result["response"])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(num_requests)))
+    elapsed = time.perf_counter() - start
+
+    print(f"完了: {len(latencies)}件, 拒否: {rejected}件, エラー: {errors}件, 経過時間: {elapsed:.2f}秒")
+    print(f"レイテンシ p50: {percentile(latencies, 50) * 1000:.1f}ms, p99: {percentile(latencies, 99) * 1000:.1f}ms")
+    print(f"スループット: {generated_tokens / elapsed:.1f} tokens/sec, {len(latencies) / elapsed:.2f} req/sec")
+    return {
+        "completed": len(latencies),
+        "rejected": rejected,
+        "errors": errors,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+        "tokens_per_sec": generated_tokens / elapsed,
+        "responses": dict(responses),
+    }
+
+
+@torch.inference_mode()
+def reference_response(model, tokenizer, instruction, max_new_tokens, params):
+    """model.generate で1件ずつ生成した回答（負荷試験の結果との照合用）"""
+    from transformers import StoppingCriteriaList
+
+    stop_criteria = StopSequenceCriteria(tokenizer)
+    prompt = generate_prompt({'instruction': instruction, 'input': None})
+    input_ids = tokenizer(prompt, return_tensors="pt", add_special_tokens=False).input_ids.to(model.device)
+    outputs = model.generate(
+        input_ids=input_ids,
+        max_new_tokens=max_new_tokens,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        stopping_criteria=StoppingCriteriaList([stop_criteria]),
+        **sampling_kwargs(params),
+    )
+    tokens = outputs[0, input_ids.shape[1]:].tolist()
+    if stop_criteria.find_stop(tokens) is not None:
+        # EOS・停止文字列は回答に含めない（サーバーの応答と同じ形）
+        tokens = stop_criteria.truncate(tokens)[:-1]
+    return tokenizer.decode(tokens).replace("<NL>", "\n")
+
+
+def check_load_test(model, tokenizer, result, max_new_tokens, params):
+    """負荷試験の全応答が1件ずつの生成結果と一致し、エラーがないかを確認（貪欲生成のみ）"""
+    print("\n=== 応答の照合（1件ずつの model.generate と比較） ===")
+    ok = result["errors"] == 0 and result["completed"] > 0
+    for question, responses in result["responses"].items():
+        expected = reference_response(model, tokenizer, question, max_new_tokens, params)
+        matched = sum(response == expected for response in responses)
+        ok &= matched == len(responses)
+        print(f"{question}: {matched}/{len(responses)} {'✅' if matched == len(responses) else '❌'}")
+    print(f"結果: {'✅' if ok else '❌'}")
+    return ok
+
+
+async def serve(args, model, tokenizer):
+    """サーバーを起動し、負荷試験の指定があれば実行して終了（--tiny では応答を照合し、結果を返す）"""
+    # 小型モデルでの確認は結果を照合できるよう貪欲生成にする
+    params = dict(GENERATION_PARAMS, do_sample=False) if args.tiny else GENERATION_PARAMS
+    engine = ContinuousBatchingEngine(
+        model,
+        tokenizer,
+        max_batch_size=args.max_batch_size,
+        max_queue=args.max_queue,
+        max_new_tokens=args.max_new_tokens,
+        params=params,
+    )
+    engine_task = asyncio.create_task(engine.run())
+    server = await start_server(engine, args.host, args.port, args.unix_socket)
+    print(f"サーバー起動: {args.unix_socket or f'http://{args.host}:{args.port}'}")
+
+    try:
+        if args.load_test:
+            result = await run_load_test(
+                args.load_test,
+                args.concurrency,
+                args.max_new_tokens,
+                args.host, args.port, args.unix_socket,
+            )
+            print(f"サーバー統計: {engine.stats()}")
+            if args.tiny:
+                return check_load_test(model, tokenizer, result, args.max_new_tokens, params)
+        else:
+            await server.serve_forever()
+        return True
+    finally:
+        server.close()
+        engine_task.cancel()
+
+
+def main():
+    """メイン処理"""
+    parser = argparse.ArgumentParser(description="Rinna-3.6B 連続バッチング推論サーバー")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--unix-socket", default=None, help="Unixソケットのパス（指定時はTCPの代わりに使用）")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE)
+    parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    parser.add_argument("--load-test", type=int, default=0, help="合成負荷のリクエスト数（0で通常起動）")
+    parser.add_argument("--concurrency", type=int, default=16, help="負荷試験の同時実行数")
+    args = parser.parse_args()
+
+    print("Rinna-3.6B 推論サーバー（連続バッチング）")
+    print("=" * 50)
+
+    if args.tiny:
+        from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer, tokenizer_name
+        model, tokenizer = prepare_tiny_model_and_tokenizer(args.tokenizer or tokenizer_name)
+    else:
+        model, tokenizer = prepare_model_and_tokenizer()
+
+    if not asyncio.run(serve(args, model, tokenizer)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
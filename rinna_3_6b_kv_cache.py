@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B 推論用 KVキャッシュ操作ユーティリティ
+transformers のバージョンによってキャッシュの形式（タプル / DynamicCache）が異なるため、
+内部ではレイヤーごとの (key, value) タプルとして扱う。
+key / value の形状は (batch, heads, seq, head_dim)。
+"""
+
+import torch
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # 古い transformers はタプル形式のみ
+    DynamicCache = None
+
+
+def to_legacy(past_key_values):
+    """モデルが返したキャッシュをレイヤーごとの (key, value) タプルに変換"""
+    if past_key_values is None:
+        return None
+    if hasattr(past_key_values, "layers"):
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple((key, value) for key, value in past_key_values)
+
+
+def from_legacy(layers):
+    """(key, value) タプルをモデルに渡せるキャッシュ形式に変換"""
+    if layers is None:
+        return None
+    if DynamicCache is None:
+        return tuple(layers)
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(layers):
+        cache.update(key, value, layer_idx)
+    return cache
+
+
+def seq_length(layers):
+    """キャッシュのシーケンス長"""
+    return layers[0][0].shape[-2]
+
+
+def pad_left(layers, length):
+    """シーケンス方向に左パディングして length に揃える"""
+    pad = length - seq_length(layers)
+    if pad <= 0:
+        return layers
+    return tuple(
+        (
+            torch.nn.functional.pad(key, (0, 0, pad, 0)),
+            torch.nn.functional.pad(value, (0, 0, pad, 0)),
+        )
+        for key, value in layers
+    )
+
+
+def concat_rows(caches):
+    """長さの異なるキャッシュを左パディングしてバッチ方向に連結"""
+    length = max(seq_length(layers) for layers in caches)
+    caches = [pad_left(layers, length) for layers in caches]
+    return tuple(
+        (
+            torch.cat([layers[i][0] for layers in caches], dim=0),
+            torch.cat([layers[i][1] for layers in caches], dim=0),
+        )
+        for i in range(len(caches[0]))
+    )
+
+
+def select_rows(layers, indices):
+    """バッチ方向に行を選択"""
+    return tuple(
+        (key.index_select(0, indices), value.index_select(0, indices))
+        for key, value in layers
+    )
+
+
+def slice_seq(layers, start, end=None):
+    """シーケンス方向に切り出す"""
+    return tuple(
+        (key[:, :, start:end], value[:, :, start:end])
+        for key, value in layers
+    )
+
+
+def concat_seq(first, second):
+    """シーケンス方向に連結"""
+    return tuple(
+        (torch.cat([k1, k2], dim=-2), torch.cat([v1, v2], dim=-2))
+        for (k1, v1), (k2, v2) in zip(first, second)
+    )
+
+
+def cache_nbytes(layers):
+    """キャッシュのメモリ使用量（バイト）"""
+    return sum(key.nelement() * key.element_size() + value.nelement() * value.element_size()
+               for key, value in layers)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B 推論用 ロジット処理（no_repeat_ngram + temperature / top-k / top-p）の高速化
+transformers の NoRepeatNGramLogitsProcessor は毎ステップ系列全体のPythonリストから
+禁止n-gramの辞書を作り直すため、生成が長くなるほど・バッチが大きくなるほど遅くなる。
+（新しい transformers ではテンソル化されているが、毎ステップ系列全体を走査する点は同じ）
+ここでは出現済みのn-gramをテンソルに追記していき、禁止トークンの判定を1回の比較で行う。
+さらに禁止マスク・temperature・top-k・top-p を1つの処理にまとめ、語彙全体のソートを
+上位k個のソートに置き換える。固定シードで transformers の処理と同じ生成結果になる。
+
+使い方:
+    python rinna_3_6b_logits_processor.py            # 系列長・バッチサイズごとの1ステップの処理時間を比較
+    python rinna_3_6b_logits_processor.py --tiny     # 小型モデルで model.generate の出力一致も確認
+"""
+
+import argparse
+import time
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList
+
+# 1ステップで追記するn-gramの初期容量（足りなくなったら倍にする）
+NGRAM_INITIAL_CAPACITY = 1024
+
+
+class IncrementalNoRepeatNGram:
+    """出現済みのn-gramをテンソルで保持し、新しく追加されたトークンの分だけ追記する
+
+    前回の呼び出しと系列の先頭が一致しない場合（別のリクエスト、投機的デコーディングの巻き戻し等）は、
+    一致する位置までのn-gramを残して作り直す。
+    """
+
+    def __init__(self, ngram_size):
+        if ngram_size < 1:
+            raise ValueError(f"ngram_size は1以上を指定してください: {ngram_size}")
+        self.ngram_size = ngram_size
+        self.tokens = None  # 前回の input_ids
+        self.ngrams = None  # [batch, capacity, ngram_size]
+        self.count = 0  # 有効なn-gramの数
+
+    def _common_length(self, input_ids):
+        """前回の input_ids と先頭から一致する長さ"""
+        if self.tokens is None or self.tokens.shape[0] != input_ids.shape[0] or self.tokens.device != input_ids.device:
+            return 0
+        length = min(self.tokens.shape[1], input_ids.shape[1])
+        mismatch = (self.tokens[:, :length] != input_ids[:, :length]).any(dim=0)
+        if not mismatch.any():
+            return length
+        return int(mismatch.int().argmax())
+
+    def update(self, input_ids):
+        """input_ids までのn-gramに更新"""
+        n = self.ngram_size
+        common = self._common_length(input_ids)
+        # 一致する位置までに収まるn-gramだけを残す
+        self.count = min(self.count, max(common - n + 1, 0))
+        total = max(input_ids.shape[1] - n + 1, 0)
+        if total > self.count:
+            new = input_ids[:, self.count:].unfold(1, n, 1)  # [batch, total - count, n]
+            if self.ngrams is None or self.ngrams.shape[0] != input_ids.shape[0] or self.ngrams.shape[1] < total:
+                capacity = max(NGRAM_INITIAL_CAPACITY, total * 2)
+                ngrams = input_ids.new_empty((input_ids.shape[0], capacity, n))
+                if self.ngrams is not None and self.ngrams.shape[0] == input_ids.shape[0]:
+                    ngrams[:, :self.count] = self.ngrams[:, :self.count]
+                else:
+                    self.count = 0
+                    new = input_ids.unfold(1, n, 1)
+                self.ngrams = ngrams
+            self.ngrams[:, self.count:total] = new
+            self.count = total
+        self.tokens = input_ids
+
+    def banned_tokens(self, input_ids):
+        """次のトークンとして禁止する (行番号, トークン) の組"""
+        self.update(input_ids)
+        if self.count == 0:
+            empty = input_ids.new_empty((0,))
+            return empty, empty
+        n = self.ngram_size
+        ngrams = self.ngrams[:, :self.count]
+        # 直前の n-1 トークンで始まるn-gramの最後のトークンを禁止
+        prefix = input_ids[:, input_ids.shape[1] - (n - 1):]
+        matched = (ngrams[:, :, :n - 1] == prefix[:, None, :]).all(dim=-1)
+        rows, cols = matched.nonzero(as_tuple=True)
+        return rows, ngrams[rows, cols, n - 1]
+
+    def banned_mask(self, input_ids, vocab_size):
+        """次のトークンとして禁止するトークンのマスク [batch, vocab]"""
+        rows, tokens = self.banned_tokens(input_ids)
+        mask = torch.zeros((input_ids.shape[0], vocab_size), dtype=torch.bool, device=input_ids.device)
+        mask[rows, tokens] = True
+        return mask
+
+
+class FusedSamplingLogitsProcessor(LogitsProcessor):
+    """no_repeat_ngram・temperature・top-k・top-p を1回でまとめて適用するロジット処理
+
+    transformers の NoRepeatNGram → Temperature → TopK → TopP の順の処理と同じ結果になる。
+    貪欲生成（do_sample=False）では no_repeat_ngram のみを適用する。
+    ngram_start を指定すると no_repeat_ngram は input_ids の ngram_start 以降だけを対象にする
+    （対話で前のターンのn-gramまで禁止しないため）。
+    """
+
+    def __init__(self, params, ngram_start=0):
+        self.do_sample = params.get("do_sample", False)
+        self.ngram_start = ngram_start
+        ngram_size = params.get("no_repeat_ngram_size")
+        self.no_repeat_ngram = IncrementalNoRepeatNGram(ngram_size) if ngram_size else None
+        self.temperature = params.get("temperature")
+        self.top_k = params.get("top_k") or None
+        top_p = params.get("top_p")
+        self.top_p = top_p if top_p is not None and top_p < 1.0 else None
+
+    def __call__(self, input_ids, scores):
+        if self.no_repeat_ngram is not None:
+            banned = self.no_repeat_ngram.banned_mask(input_ids[:, self.ngram_start:], scores.shape[-1])
+            scores = scores.masked_fill(banned, -float("inf"))
+        return self.warp(scores)
+
+    def warp(self, scores):
+        """temperature・top-k・top-p だけを適用（系列に依存しないため、長さの異なる行をまとめて処理できる）"""
+        if not self.do_sample:
+            return scores
+        if self.temperature not in (None, 1.0):
+            scores = scores / self.temperature
+        if self.top_k is None and self.top_p is None:
+            return scores
+
+        # 候補（top-k、指定がなければ語彙全体）を降順に取り出す
+        k = min(self.top_k or scores.shape[-1], scores.shape[-1])
+        values, indices = scores.topk(k, dim=-1)
+        if k < scores.shape[-1]:
+            # k番目と同じ値のトークンも残す（TopKLogitsWarper と同じ）
+            num_kept = int((scores >= values[:, -1:]).sum(dim=-1).max())
+            if num_kept > k:
+                values, indices = scores.topk(num_kept, dim=-1)
+                values = values.masked_fill(values < values[:, k - 1:k], -float("inf"))
+
+        if self.top_p is not None:
+            # TopPLogitsWarper と同じく昇順の累積確率が 1 - top_p 以下のトークンを除く（最大の1つは残す）
+            ascending = values.flip(-1)
+            cumulative_probs = ascending.softmax(dim=-1).cumsum(dim=-1)
+            removed = cumulative_probs <= (1 - self.top_p)
+            removed[:, -1] = False
+            values = ascending.masked_fill(removed, -float("inf")).flip(-1)
+
+        return torch.full_like(scores, -float("inf")).scatter(1, indices, values)
+
+
+class SuffixLogitsProcessor(LogitsProcessor):
+    """input_ids の start 以降だけを渡してロジット処理を適用する（標準の no_repeat_ngram をターン内に限定する用）"""
+
+    def __init__(self, processor, start):
+        self.processor = processor
+        self.start = start
+
+    def __call__(self, input_ids, scores):
+        return self.processor(input_ids[:, self.start:], scores)
+
+
+def processor_generate_kwargs(logits_processor, params):
+    """ロジット処理を自前で組み立てた場合の model.generate に渡す引数"""
+    kwargs = dict(
+        do_sample=params.get("do_sample", False),
+        logits_processor=logits_processor,
+    )
+    if kwargs["do_sample"]:
+        # transformers 側の temperature / top-k（既定値50）/ top-p を無効にする
+        kwargs.update(temperature=1.0, top_k=0, top_p=1.0)
+    return kwargs
+
+
+def fused_generate_kwargs(params, ngram_start=0):
+    """model.generate に渡す引数（ロジット処理を FusedSamplingLogitsProcessor に置き換える）"""
+    return processor_generate_kwargs(LogitsProcessorList([FusedSamplingLogitsProcessor(params, ngram_start)]), params)
+
+
+class LegacyNoRepeatNGram(LogitsProcessor):
+    """transformers 4.x の NoRepeatNGramLogitsProcessor と同じ方式（毎ステップPythonの辞書を作り直す、比較用）"""
+
+    def __init__(self, ngram_size):
+        self.ngram_size = ngram_size
+
+    def __call__(self, input_ids, scores):
+        n = self.ngram_size
+        if input_ids.shape[1] + 1 < n:
+            return scores
+        scores = scores.clone()
+        for row, tokens in enumerate(input_ids.tolist()):
+            ngrams = {}
+            for ngram in zip(*[tokens[i:] for i in range(n)]):
+                ngrams[ngram[:-1]] = ngrams.get(ngram[:-1], []) + [ngram[-1]]
+            banned = ngrams.get(tuple(tokens[len(tokens) - n + 1:]), [])
+            scores[row, banned] = -float("inf")
+        return scores
+
+
+def measure_step_ms(logits_processor, input_ids, scores, steps):
+    """input_ids に1トークンずつ追加しながら steps 回呼び出したときの1ステップの平均時間（ms）"""
+    prompt_len = input_ids.shape[1] - steps
+    start = time.perf_counter()
+    for step in range(steps):
+        logits_processor(input_ids[:, :prompt_len + step + 1], scores[step])
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def check_processor_outputs(params, vocab_size, trials=200, generator=None):
+    """ランダムな系列・ロジットで標準の処理と出力が一致するかを確認"""
+    from rinna_3_6b_inference import build_logits_processor
+
+    reference = build_logits_processor(params, fused=False)
+    fused = FusedSamplingLogitsProcessor(params)
+    for trial in range(trials):
+        # 語彙を狭めて同じn-gramが繰り返し現れるようにする
+        input_ids = torch.randint(0, 20, (4, 64), generator=generator)
+        scores = torch.randn(4, vocab_size, generator=generator) * 3
+        for length in range(1, input_ids.shape[1] + 1, 7):
+            expected = reference(input_ids[:, :length], scores)
+            actual = fused(input_ids[:, :length], scores)
+            if not torch.equal(expected, actual):
+                return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ロジット処理の1ステップの処理時間と出力一致の確認")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルで model.generate の出力一致も確認")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    parser.add_argument("--vocab-size", type=int, default=32000, help="処理時間の計測に使う語彙サイズ")
+    parser.add_argument("--steps", type=int, default=32, help="計測するステップ数")
+    args = parser.parse_args()
+
+    from rinna_3_6b_inference import GENERATION_PARAMS, build_logits_processor
+
+    print("=== ロジット処理の高速化 ===")
+    params = dict(GENERATION_PARAMS)
+    generator = torch.Generator().manual_seed(0)
+
+    print("\n--- 出力の一致（ランダムな系列・ロジット） ---")
+    for label, check_params in (("サンプリング", params), ("貪欲生成", dict(params, do_sample=False)),
+                                ("top-pのみ", dict(params, top_k=None)), ("3-gram", dict(params, no_repeat_ngram_size=3))):
+        ok = check_processor_outputs(check_params, 1000, trials=20, generator=generator)
+        print(f"{label}: {'✅' if ok else '❌'}")
+
+    if args.tiny:
+        from rinna_3_6b_inference import generate_prompt
+        from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer, tokenizer_name
+
+        print("\n--- model.generate の出力一致（固定シード） ---")
+        model, tokenizer = prepare_tiny_model_and_tokenizer(args.tokenizer or tokenizer_name)
+        tokenizer.padding_side = "left"
+        prompts = [generate_prompt({'instruction': q, 'input': None})
+                   for q in ["日本の首都は？", "自然言語処理とは？", "Pythonの特徴は？", "機械学習について教えて"]]
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False)
+        matched = 0
+        seeds = range(10)
+        for seed in seeds:
+            outputs = []
+            for kwargs in (params, fused_generate_kwargs(params)):
+                torch.manual_seed(seed)
+                with torch.inference_mode():
+                    outputs.append(model.generate(**inputs, max_new_tokens=128, pad_token_id=tokenizer.pad_token_id,
+                                                  **kwargs))
+            matched += torch.equal(*outputs)
+        print(f"一致: {matched}/{len(seeds)}（バッチ {len(prompts)}、128トークン）")
+
+    print(f"\n--- 1ステップの処理時間（語彙 {args.vocab_size}、{args.steps}ステップの平均） ---")
+    # 4.x相当: no_repeat_ngram をPythonの辞書で処理する旧方式に置き換えたもの
+    legacy = build_logits_processor(params, fused=False)
+    legacy[0] = LegacyNoRepeatNGram(params["no_repeat_ngram_size"])
+    print(f"{'バッチ':>6} {'系列長':>8} {'4.x相当':>10} {'標準':>10} {'高速化':>10} {'速度比(4.x/標準)':>18}")
+    for batch_size in (1, 4, 16):
+        for seq_len in (128, 512, 2048):
+            input_ids = torch.randint(0, args.vocab_size, (batch_size, seq_len + args.steps), generator=generator)
+            scores = torch.randn(args.steps, batch_size, args.vocab_size, generator=generator)
+            legacy_ms = measure_step_ms(legacy, input_ids, scores, args.steps)
+            reference_ms = measure_step_ms(build_logits_processor(params, fused=False), input_ids, scores, args.steps)
+            fused_ms = measure_step_ms(FusedSamplingLogitsProcessor(params), input_ids, scores, args.steps)
+            print(f"{batch_size:>6} {seq_len:>8} {legacy_ms:>8.2f}ms {reference_ms:>8.2f}ms {fused_ms:>8.2f}ms "
+                  f"{legacy_ms / fused_ms:>8.1f}x / {reference_ms / fused_ms:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
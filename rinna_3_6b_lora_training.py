@@ -7,13 +7,13 @@ Rinna-3.6B LoRAファインチューニング実装
 """
 
 import os
+import functools
 import torch
 from datasets import load_dataset
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
     TrainingArguments,
-    Trainer,
     DataCollatorForLanguageModeling
 )
 from peft import (
@@ -21,14 +21,23 @@ from peft import (
     get_peft_model,
     TaskType
 )
+from rinna_3_6b_token_store import dataset_key, store_key, load_or_build_examples, load_or_build_token_store
+from rinna_3_6b_training_metrics import METRICS_FILE, ThroughputCallback
+from rinna_3_6b_evaluation import EVAL_SEED, HeldOutEvalTrainer, split_eval_data, tokenize_eval_data
 
 # 基本パラメータ
 model_name = "rinna/japanese-gpt-neox-3.6b"
 dataset = "kunishou/databricks-dolly-15k-ja"
+dataset_revision = None  # データセットのリビジョン（Noneで main。トークンストアのキーにも使用）
 peft_name = "lora-rinna-3.6b"
 output_dir = "lora-rinna-3.6b-results"
 
 CUTOFF_LEN = 256  # コンテキスト長
+PROMPT_TEMPLATE_VERSION = "v1"  # プロンプトテンプレートの版（generate_prompt を変更したら更新し、トークンストアを作り直す）
+USE_TOKEN_STORE = True  # トークナイズ結果をメモリマップストアに保存して次回以降再利用
+TOKEN_STORE_DIR = "cache/token_store"  # トークンストアの保存先
+THROUGHPUT_METRICS = True  # ステップごとのトークン数・時間の内訳・ピークメモリを記録（output_dir/throughput_metrics.jsonl）
+EVAL_SIZE = 500  # 評価用に学習データから分割するサンプル数（eval_steps ごとに loss / perplexity を計算、0で無効）
 
 def setup_environment():
     """環境セットアップ"""
@@ -99,30 +108,59 @@ def prepare_dataset(tokenizer):
     """データセットの準備"""
     print("\n=== データセットの準備 ===")
     
-    # データセットの読み込み
-    data = load_dataset(dataset)
-    print(f"データセットサイズ: {len(data['train'])}")
-    
-    # データの確認
-    print("\nデータサンプル:")
-    print(data["train"][5])
-    
-    # トークナイズの動作確認
-    test_tokenize = tokenize("hi there", tokenizer)
-    print(f"\nトークナイズテスト: {test_tokenize}")
-    
-    # プロンプト生成の確認
-    test_prompt = generate_prompt(data["train"][0])
-    print(f"\nプロンプトテスト: {test_prompt[:200]}...")
+    # データセットの読み込みと評価用データの分割（トークンストアを再利用する場合は読み込まない）
+    @functools.lru_cache(maxsize=None)
+    def load_splits():
+        data = load_dataset(dataset, revision=dataset_revision)
+        print(f"データセットサイズ: {len(data['train'])}")
+        
+        # 評価用データの分割（学習には使わない）
+        train_split, eval_split = split_eval_data(data["train"], EVAL_SIZE)
+        
+        # データの確認
+        print("\nデータサンプル:")
+        print(train_split[5])
+        
+        # トークナイズの動作確認
+        test_tokenize = tokenize("hi there", tokenizer)
+        print(f"\nトークナイズテスト: {test_tokenize}")
+        
+        # プロンプト生成の確認
+        test_prompt = generate_prompt(train_split[0])
+        print(f"\nプロンプトテスト: {test_prompt[:200]}...")
+        
+        return train_split, eval_split
     
     def generate_and_tokenize_prompt(data_point):
         full_prompt = generate_prompt(data_point)
         return tokenize(full_prompt, tokenizer)
     
+    def tokenize_eval_split(eval_split):
+        return tokenize_eval_data(eval_split, tokenizer, generate_prompt, CUTOFF_LEN)
+    
     # データセットの変換
-    train_data = data["train"].map(generate_and_tokenize_prompt)
+    if USE_TOKEN_STORE:
+        # データセット（名前・リビジョン・評価データの分割）・トークナイザー・テンプレート・CUTOFF_LEN が同じなら前回の結果を再利用
+        key = store_key(tokenizer, PROMPT_TEMPLATE_VERSION, CUTOFF_LEN,
+                        dataset_key(dataset, dataset_revision, "train", eval_size=EVAL_SIZE, eval_seed=EVAL_SEED))
+        train_data = load_or_build_token_store(
+            TOKEN_STORE_DIR,
+            key,
+            lambda: load_splits()[0].map(generate_and_tokenize_prompt)["input_ids"],
+            vocab_size=len(tokenizer),
+        )
+        eval_data = None
+        if EVAL_SIZE:
+            eval_data = load_or_build_examples(TOKEN_STORE_DIR, f"{key}-eval",
+                                               lambda: tokenize_eval_split(load_splits()[1]))
+    else:
+        train_split, eval_split = load_splits()
+        train_data = train_split.map(generate_and_tokenize_prompt)
+        eval_data = tokenize_eval_split(eval_split) if eval_split is not None else None
+    if eval_data is not None:
+        print(f"学習データ: {len(train_data)}件, 評価データ: {len(eval_data)}件")
     
-    return train_data
+    return train_data, eval_data
 
 def prepare_model():
     """モデルの準備"""
@@ -152,7 +190,7 @@ def prepare_model():
     
     return model
 
-def train_model(model, tokenizer, train_data):
+def train_model(model, tokenizer, train_data, eval_data=None):
     """モデルの学習"""
     print("\n=== モデルの学習 ===")
     
@@ -166,6 +204,7 @@ def train_model(model, tokenizer, train_data):
         warmup_steps=100,
         logging_steps=20,
         save_steps=200,
+        eval_strategy="steps" if eval_data is not None else "no",
         eval_steps=200,
         save_total_limit=3,
         learning_rate=1e-4,
@@ -179,13 +218,16 @@ def train_model(model, tokenizer, train_data):
         mlm=False,
     )
     
-    # トレーナーの準備
-    trainer = Trainer(
+    # トレーナーの準備（評価は回答部分の loss / perplexity）
+    trainer = HeldOutEvalTrainer(
         model=model,
         args=training_args,
         train_dataset=train_data,
+        eval_dataset=eval_data,
         data_collator=data_collator,
     )
+    if THROUGHPUT_METRICS:
+        trainer.add_callback(ThroughputCallback(tokenizer.pad_token_id, os.path.join(output_dir, METRICS_FILE)))
     
     # キャッシュを無効化して学習開始
     model.config.use_cache = False
@@ -210,13 +252,13 @@ def main():
     tokenizer = prepare_tokenizer()
     
     # データセットの準備
-    train_data = prepare_dataset(tokenizer)
+    train_data, eval_data = prepare_dataset(tokenizer)
     
     # モデルの準備
     model = prepare_model()
     
     # 学習の実行
-    train_model(model, tokenizer, train_data)
+    train_model(model, tokenizer, train_data, eval_data)
     
     print("\n=== 学習完了 ===")
     print(f"LoRAモデル: {peft_name}")
@@ -5,13 +5,14 @@ Rinna-3.6B LoRAファインチューニング実装 - A100最適化版
 """
 
 import os
+import json
+import functools
 import torch
-from datasets import load_dataset
+from datasets import Dataset, load_dataset
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
     TrainingArguments,
-    Trainer,
     DataCollatorForLanguageModeling,
     BitsAndBytesConfig
 )
@@ -20,14 +21,48 @@ from peft import (
     get_peft_model,
     TaskType
 )
+from rinna_3_6b_packing import pack_examples, report_padding, PackedDataCollator
+from rinna_3_6b_token_batching import TokenBudgetBatchSampler, TokenBudgetTrainer
+from rinna_3_6b_token_store import dataset_key, store_key, load_or_build_examples, load_or_build_token_store
+from rinna_3_6b_streaming_dataset import StreamingPromptDataset
+from rinna_3_6b_training_metrics import METRICS_FILE, ThroughputCallback
+from rinna_3_6b_evaluation import EVAL_SEED, HeldOutEvalMixin, split_eval_data, tokenize_eval_data
+from rinna_3_6b_gradient_checkpointing import enable_gradient_checkpointing
+from rinna_3_6b_async_checkpoint import AsyncCheckpointMixin, latest_checkpoint, remove_incomplete_checkpoints
+from rinna_3_6b_distributed import (
+    backend,
+    device_map,
+    init_distributed,
+    is_distributed,
+    launch,
+    main_process_first,
+    quiet_non_main_process,
+)
 
 # 基本パラメータ（最適化版）
 model_name = "rinna/japanese-gpt-neox-3.6b"
 dataset = "kunishou/databricks-dolly-15k-ja"
+dataset_revision = None  # データセットのリビジョン（Noneで main。トークンストアのキーにも使用）
 peft_name = "lora-rinna-3.6b-optimized"
 output_dir = "lora-rinna-3.6b-results-optimized"
 
 CUTOFF_LEN = 256  # コンテキスト長
+PROMPT_TEMPLATE_VERSION = "v1"  # プロンプトテンプレートの版（generate_prompt / generate_prompts を変更したら更新し、トークンストアを作り直す）
+BATCH_SIZE = 16  # デバイスあたりのバッチサイズ
+PACKING = False  # シーケンスパッキング（複数サンプルをCUTOFF_LEN長の行に詰めてパディングを削減）
+MAX_BATCH_TOKENS = None  # トークン数ベースの動的バッチング（例: 4096、Noneで固定バッチサイズ）
+BATCHED_TOKENIZE = True  # プロンプト生成とトークナイズをバッチ単位で実行
+TOKENIZE_BATCH_SIZE = 1000  # バッチトークナイズ時の1バッチあたりの行数
+USE_TOKEN_STORE = True  # トークナイズ結果をメモリマップストアに保存して次回以降再利用
+TOKEN_STORE_DIR = "cache/token_store"  # トークンストアの保存先
+STREAMING_DATA_FILES = None  # ストリーミングモードで読むローカルシャード（例: ["data/*.jsonl"]、Noneで無効）
+STREAMING_MAX_STEPS = 10000  # ストリーミングモードの学習ステップ数（データ長が不明なため必須）
+GRADIENT_CHECKPOINTING_EVERY_K = 0  # k層ごとに勾配チェックポイント（0で無効、1で全層。CUTOFF_LEN やバッチサイズを増やす場合に使用）
+THROUGHPUT_METRICS = True  # ステップごとのトークン数・時間の内訳・ピークメモリを記録（output_dir/throughput_metrics.jsonl）
+EVAL_SIZE = 500  # 評価用に学習データから分割するサンプル数（eval_steps ごとに loss / perplexity を計算、0で無効）
+ASYNC_CHECKPOINT = True  # チェックポイント（LoRA・オプティマイザーの状態）をバックグラウンドで書き込み、トークナイザーは output_dir に1回だけ保存
+NUM_PROCESSES = 1  # データ並列のプロセス数（2以上で各プロセスにGPUを1台ずつ割り当て、GPUがなければCPU + gloo。torchrun でも起動可）
+RESUME_FROM_CHECKPOINT = None  # 学習を再開するチェックポイント（例: "lora-rinna-3.6b-results-optimized/checkpoint-500"、"latest" で最新）
 
 def setup_environment():
     """環境セットアップ"""
@@ -91,26 +126,117 @@ def generate_prompt(data_point):
     result = result.replace('\n', '<NL>')
     return result
 
+def tokenize_batch(prompts, tokenizer):
+    """トークナイズ関数（バッチ版：プロンプトのリストをまとめてトークナイズ）"""
+    result = tokenizer(
+        prompts,
+        truncation=True,
+        max_length=CUTOFF_LEN,
+        padding=False,
+    )
+    return {
+        "input_ids": result["input_ids"],
+        "attention_mask": result["attention_mask"],
+    }
+
+def generate_prompts(batch):
+    """プロンプトテンプレートの準備（バッチ版：列単位でまとめて生成）
+
+    generate_prompt と同じ文字列を返す。テンプレート部分はあらかじめ <NL> に
+    置換しておき、各列の改行だけを置換する。
+    """
+    instructions = [text.replace('\n', '<NL>') for text in batch["instruction"]]
+    inputs = [text.replace('\n', '<NL>') if text else text for text in batch["input"]]
+    outputs = [text.replace('\n', '<NL>') for text in batch["output"]]
+    
+    return [
+        f"### 指示:<NL>{instruction}<NL><NL>### 入力:<NL>{input_text}<NL><NL>### 回答:<NL>{output}"
+        if input_text else
+        f"### 指示:<NL>{instruction}<NL><NL>### 回答:<NL>{output}"
+        for instruction, input_text, output in zip(instructions, inputs, outputs)
+    ]
+
+def generate_and_tokenize_prompts(batch, tokenizer):
+    """バッチ単位のプロンプト生成とトークナイズ"""
+    return tokenize_batch(generate_prompts(batch), tokenizer)
+
 def prepare_dataset(tokenizer):
     """データセットの準備"""
     print("\n=== データセットの準備 ===")
     
-    # データセットの読み込み
-    data = load_dataset(dataset)
-    print(f"データセットサイズ: {len(data['train'])}")
+    # ストリーミングモード（RAMに載らない大規模コーパス向け、シャードを逐次読み込み）
+    if STREAMING_DATA_FILES:
+        train_data = StreamingPromptDataset(
+            STREAMING_DATA_FILES,
+            functools.partial(generate_and_tokenize_prompts, tokenizer=tokenizer),
+            tokenize_batch_size=TOKENIZE_BATCH_SIZE,
+        )
+        print(f"ストリーミングモード: {len(train_data.shards)}シャード")
+        return train_data, None
+    
+    # データセットの読み込みと評価用データの分割（トークンストアを再利用する場合は読み込まない）
+    @functools.lru_cache(maxsize=None)
+    def load_splits():
+        data = load_dataset(dataset, revision=dataset_revision)
+        print(f"データセットサイズ: {len(data['train'])}")
+        # 評価用データは学習には使わない
+        return split_eval_data(data["train"], EVAL_SIZE)
     
     def generate_and_tokenize_prompt(data_point):
         full_prompt = generate_prompt(data_point)
         return tokenize(full_prompt, tokenizer)
     
-    # データセットの変換（並列処理で高速化）
-    train_data = data["train"].map(
-        generate_and_tokenize_prompt,
-        num_proc=4,  # 並列処理
-        remove_columns=data["train"].column_names
-    )
+    def tokenize_dataset(train_split):
+        if BATCHED_TOKENIZE:
+            # データセットの変換（バッチ単位で高速化）
+            return train_split.map(
+                generate_and_tokenize_prompts,
+                fn_kwargs={"tokenizer": tokenizer},
+                batched=True,
+                batch_size=TOKENIZE_BATCH_SIZE,
+                remove_columns=train_split.column_names
+            )
+        # データセットの変換（並列処理で高速化）
+        return train_split.map(
+            generate_and_tokenize_prompt,
+            num_proc=4,  # 並列処理
+            remove_columns=train_split.column_names
+        )
+    
+    def tokenize_eval_split(eval_split):
+        return tokenize_eval_data(eval_split, tokenizer, generate_prompt, CUTOFF_LEN)
+    
+    if USE_TOKEN_STORE:
+        # データセット（名前・リビジョン・評価データの分割）・トークナイザー・テンプレート・CUTOFF_LEN が同じなら前回の結果を再利用
+        key = store_key(tokenizer, PROMPT_TEMPLATE_VERSION, CUTOFF_LEN,
+                        dataset_key(dataset, dataset_revision, "train", eval_size=EVAL_SIZE, eval_seed=EVAL_SEED))
+        train_data = load_or_build_token_store(
+            TOKEN_STORE_DIR,
+            key,
+            lambda: tokenize_dataset(load_splits()[0])["input_ids"],
+            vocab_size=len(tokenizer),
+        )
+        eval_data = None
+        if EVAL_SIZE:
+            eval_data = load_or_build_examples(TOKEN_STORE_DIR, f"{key}-eval",
+                                               lambda: tokenize_eval_split(load_splits()[1]))
+    else:
+        train_split, eval_split = load_splits()
+        train_data = tokenize_dataset(train_split)
+        eval_data = tokenize_eval_split(eval_split) if eval_split is not None else None
+    if eval_data is not None:
+        print(f"学習データ: {len(train_data)}件, 評価データ: {len(eval_data)}件")
+    
+    # シーケンスパッキング（オプション）
+    if PACKING:
+        print("\nシーケンスパッキング中...")
+        before_lengths = [len(ids) for ids in train_data["input_ids"]]
+        rows = pack_examples(train_data["input_ids"], CUTOFF_LEN, tokenizer.eos_token_id)
+        train_data = Dataset.from_list(rows)
+        after_lengths = [len(row["input_ids"]) for row in rows]
+        report_padding(before_lengths, after_lengths, BATCH_SIZE)
     
-    return train_data
+    return train_data, eval_data
 
 def prepare_model():
     """モデルの準備 - A100最適化版"""
@@ -128,7 +254,7 @@ def prepare_model():
     model = AutoModelForCausalLM.from_pretrained(
         model_name,
         quantization_config=bnb_config,
-        device_map="auto",
+        device_map=device_map(),  # データ並列では各プロセスが自分のGPUにモデル全体を置く
         torch_dtype=torch.float16,
     )
     
@@ -145,25 +271,37 @@ def prepare_model():
     # PEFTモデルの適用
     model = get_peft_model(model, peft_config)
     
+    # 勾配チェックポイント（活性化メモリを削減、non-reentrant方式で4bit + LoRAでも勾配が流れる）
+    if GRADIENT_CHECKPOINTING_EVERY_K:
+        layers = enable_gradient_checkpointing(model, GRADIENT_CHECKPOINTING_EVERY_K)
+        print(f"勾配チェックポイント: {len(layers)}/{model.config.num_hidden_layers}層")
+    
     # 学習可能パラメータの確認
     model.print_trainable_parameters()
     
     return model
 
-def train_model(model, tokenizer, train_data):
+class HeldOutEvalTokenBudgetTrainer(AsyncCheckpointMixin, HeldOutEvalMixin, TokenBudgetTrainer):
+    """動的バッチングの Trainer に評価データの loss / perplexity（回答部分のみ）と非同期チェックポイントを追加"""
+
+def train_model(model, tokenizer, train_data, eval_data=None):
     """A100最適化モデルの学習"""
     print("\n=== A100最適化学習 ===")
     
+    streaming = isinstance(train_data, StreamingPromptDataset)
+    
     # A100向け最適化された学習パラメータ
     training_args = TrainingArguments(
         output_dir=output_dir,
         overwrite_output_dir=True,
         num_train_epochs=1,
-        per_device_train_batch_size=16,  # バッチサイズを4倍に増加
+        max_steps=STREAMING_MAX_STEPS if streaming else -1,  # ストリーミング時はステップ数で指定
+        per_device_train_batch_size=BATCH_SIZE,  # バッチサイズを4倍に増加
         gradient_accumulation_steps=2,   # 勾配蓄積でさらに効果的なバッチサイズに
         warmup_steps=100,
         logging_steps=10,  # ログ頻度を上げる
         save_steps=500,
+        eval_strategy="steps" if eval_data is not None else "no",
         eval_steps=500,
         save_total_limit=3,
         learning_rate=2e-4,  # 学習率を上げる
@@ -171,37 +309,90 @@ def train_model(model, tokenizer, train_data):
         dataloader_num_workers=4,  # データローダー並列化
         remove_unused_columns=False,
         report_to="none",
-        gradient_checkpointing=False,  # 勾配エラー回避のため無効化
+        gradient_checkpointing=False,  # prepare_model で層ごとに設定（GRADIENT_CHECKPOINTING_EVERY_K）
         optim="adamw_torch",  # 安定したオプティマイザー
+        ignore_data_skip=streaming,  # ストリーミング時はデータセット側で読み飛ばす
+        ddp_backend=backend() if is_distributed() else None,
+        ddp_find_unused_parameters=False,  # LoRAの重みはすべて勾配を持つ（凍結した重みは all-reduce しない）
     )
     
+    # 書き込み途中で中断したチェックポイントを削除し、"latest" なら最新のチェックポイントから再開
+    remove_incomplete_checkpoints(output_dir)
+    resume_from_checkpoint = RESUME_FROM_CHECKPOINT
+    if resume_from_checkpoint == "latest":
+        resume_from_checkpoint = latest_checkpoint(output_dir)
+        print(f"再開するチェックポイント: {resume_from_checkpoint or 'なし（最初から学習）'}")
+    
+    # ストリーミングモードの再開位置（消費済みバッチ数）を設定
+    if streaming and resume_from_checkpoint:
+        with open(os.path.join(resume_from_checkpoint, "trainer_state.json")) as f:
+            global_step = json.load(f)["global_step"]
+        train_data.set_resume(
+            global_step * training_args.gradient_accumulation_steps,
+            training_args.per_device_train_batch_size,
+        )
+        print(f"ストリーミング再開: {global_step}ステップ目から")
+    
     # データコレクターの準備
-    data_collator = DataCollatorForLanguageModeling(
-        tokenizer=tokenizer,
-        mlm=False,
-    )
+    if "position_ids" in getattr(train_data, "column_names", []):
+        # パッキング済みデータはサンプル境界を考慮したマスクを作成
+        data_collator = PackedDataCollator(
+            pad_token_id=tokenizer.pad_token_id,
+            mask_dtype=torch.float16,
+        )
+    else:
+        data_collator = DataCollatorForLanguageModeling(
+            tokenizer=tokenizer,
+            mlm=False,
+        )
+    
+    # トークン数ベースの動的バッチング（オプション）
+    batch_sampler = None
+    if MAX_BATCH_TOKENS and not streaming:
+        lengths = [len(ids) for ids in train_data["input_ids"]]
+        batch_sampler = TokenBudgetBatchSampler(
+            lengths,
+            max_tokens=MAX_BATCH_TOKENS,
+            seed=training_args.seed,
+        )
+        print(f"動的バッチング: 最大{MAX_BATCH_TOKENS}トークン/バッチ, {len(batch_sampler)}バッチ/エポック")
     
-    # トレーナーの準備
-    trainer = Trainer(
+    # トレーナーの準備（tokens/step をログに記録）
+    trainer = HeldOutEvalTokenBudgetTrainer(
         model=model,
         args=training_args,
         train_dataset=train_data,
+        eval_dataset=eval_data,
         data_collator=data_collator,
+        batch_sampler=batch_sampler,
+        pad_token_id=tokenizer.pad_token_id,
+        processing_class=tokenizer,
     )
+    trainer.async_checkpoint = ASYNC_CHECKPOINT
+    if THROUGHPUT_METRICS:
+        trainer.add_callback(ThroughputCallback(tokenizer.pad_token_id, os.path.join(output_dir, METRICS_FILE)))
     
     # 学習実行
     print("🚀 A100最適化学習開始...")
     model.config.use_cache = False
-    trainer.train()
+    trainer.train(resume_from_checkpoint=resume_from_checkpoint)
     model.config.use_cache = True
     
-    # LoRAモデルの保存
-    trainer.model.save_pretrained(peft_name)
+    # LoRAモデルの保存（データ並列ではランク0のみ）
+    if trainer.is_world_process_zero():
+        trainer.model.save_pretrained(peft_name)
     
     print(f"✅ A100最適化LoRAモデルを {peft_name} に保存しました")
 
 def main():
     """メイン処理"""
+    # データ並列: NUM_PROCESSES 個のプロセスを起動し、各プロセスで main() を実行
+    if NUM_PROCESSES > 1 and not is_distributed():
+        launch(NUM_PROCESSES, main)
+        return
+    init_distributed()
+    quiet_non_main_process()
+    
     print("🚀 Rinna-3.6B LoRAファインチューニング - A100最適化版")
     print("参考: https://note.com/npaka/n/nc387b639e50e")
     print("=" * 60)
@@ -217,14 +408,15 @@ def main():
     # トークナイザーの準備
     tokenizer = prepare_tokenizer()
     
-    # データセットの準備
-    train_data = prepare_dataset(tokenizer)
+    # データセットの準備（トークンストアの作成はランク0が先に行い、他のランクは作成済みのストアを読む）
+    with main_process_first():
+        train_data, eval_data = prepare_dataset(tokenizer)
     
     # モデルの準備
     model = prepare_model()
     
     # 学習の実行
-    train_model(model, tokenizer, train_data)
+    train_model(model, tokenizer, train_data, eval_data)
     
     print("\n🎉 A100最適化学習完了 🎉")
     print(f"LoRAモデル: {peft_name}")
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B LoRAアダプターのマージとエクスポート
+LoRAの重みをベースモデルの重みに足し込み、単一のsafetensorsチェックポイントとして保存する。
+推論時にLoRAの追加の行列積とPEFTのラッパーが不要になる。
+
+- マージ前後のロジットが一致することを確認
+- マージ前後の推論レイテンシを比較
+- 保存したチェックポイントを読み込み直して同じロジットになることを確認
+- どちらかが一致しなければ出力先に書き込まずに終了コード1で終了
+
+使い方:
+    python rinna_3_6b_merge_lora.py --adapter lora-rinna-3.6b-optimized --output rinna-3.6b-merged --dtype float16
+    python rinna_3_6b_merge_lora.py --tiny   # 小型モデルで動作確認（CPU）
+
+推論スクリプトでは merged_name に出力先を設定するとマージ済みモデルを読み込む。
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import torch
+from peft import PeftModel
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from rinna_3_6b_inference import generate_prompt, model_name, peft_name
+
+# パラメータ
+merged_name = "rinna-3.6b-merged"  # 出力先
+
+DTYPES = {
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "float32": torch.float32,
+}
+# ロジットの許容誤差（マージによる丸め誤差を考慮）
+PARITY_ATOL = {
+    "float16": 1e-1,
+    "bfloat16": 5e-1,
+    "float32": 1e-3,
+}
+PARITY_PROMPTS = [
+    "日本の首都は？",
+    "自然言語処理とは？",
+    "Pythonの特徴は？",
+]
+
+
+def load_unmerged_model(base_name, adapter_name, dtype, device_map=None):
+    """ベースモデル（8bit量子化なし）にLoRAアダプターを適用して読み込む"""
+    model = AutoModelForCausalLM.from_pretrained(
+        base_name,
+        torch_dtype=dtype,
+        device_map=device_map,
+    )
+    model = PeftModel.from_pretrained(model, adapter_name)
+    model.eval()
+    return model
+
+
+def encode_prompts(tokenizer, prompts, device):
+    """推論用テンプレートでトークナイズ"""
+    # Rinnaのtokenizer()は自動でEOSが追加されるため add_special_tokens=False を指定
+    return [
+        tokenizer(generate_prompt({'instruction': prompt, 'input': None}),
+                  return_tensors="pt",
+                  add_special_tokens=False).input_ids.to(device)
+        for prompt in prompts
+    ]
+
+
+@torch.inference_mode()
+def compute_logits(model, inputs):
+    """各プロンプトのロジット（float32、CPU）"""
+    return [model(input_ids=input_ids).logits.float().cpu() for input_ids in inputs]
+
+
+def check_parity(reference, logits, atol):
+    """ロジットの最大誤差と次トークン予測（argmax）の一致率"""
+    max_abs_diff = max((a - b).abs().max().item() for a, b in zip(reference, logits))
+    matched = sum((a.argmax(-1) == b.argmax(-1)).sum().item() for a, b in zip(reference, logits))
+    total = sum(a.shape[1] for a in reference)
+    return {
+        "max_abs_diff": max_abs_diff,
+        "top1_agreement": matched / total,
+        "ok": max_abs_diff <= atol,
+    }
+
+
+def _synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+@torch.inference_mode()
+def measure_latency(model, inputs, maxTokens=64, repeats=3):
+    """プレフィル時間と生成速度（最大トークン数まで生成させて計測）"""
+    device = inputs[0].device
+    # ウォームアップ
+    model.generate(input_ids=inputs[0], max_new_tokens=4, min_new_tokens=4, do_sample=False)
+
+    prefill, decode = [], []
+    for _ in range(repeats):
+        for input_ids in inputs:
+            _synchronize(device)
+            start = time.perf_counter()
+            model(input_ids=input_ids)
+            _synchronize(device)
+            prefill.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            model.generate(input_ids=input_ids, max_new_tokens=maxTokens, min_new_tokens=maxTokens, do_sample=False)
+            _synchronize(device)
+            decode.append(time.perf_counter() - start)
+
+    return {
+        "prefill_ms": sum(prefill) / len(prefill) * 1000,
+        "tokens_per_sec": maxTokens * len(decode) / sum(decode),
+    }
+
+
+def merge_and_export(base_name, adapter_name, output_dir, dtype_name="float16",
+                     tokenizer_name=None, device_map=None, maxTokens=64):
+    """LoRAをマージしてsafetensorsで保存し、ロジット一致とレイテンシを報告
+
+    保存は一時ディレクトリ（<output_dir>.partial）に行い、マージ後と再読み込み後のロジットが
+    一致した場合だけ output_dir に移す。一致しなければ RuntimeError。
+    """
+    dtype = DTYPES[dtype_name]
+    atol = PARITY_ATOL[dtype_name]
+
+    print("=== マージ前のモデルの読み込み ===")
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name or base_name, use_fast=False)
+    model = load_unmerged_model(base_name, adapter_name, dtype, device_map)
+    device = next(model.parameters()).device
+    inputs = encode_prompts(tokenizer, PARITY_PROMPTS, device)
+
+    reference = compute_logits(model, inputs)
+    unmerged_latency = measure_latency(model, inputs, maxTokens)
+
+    print("=== LoRAのマージ ===")
+    model = model.merge_and_unload()
+    model.eval()
+    merged = check_parity(reference, compute_logits(model, inputs), atol)
+    if not merged["ok"]:
+        raise RuntimeError(f"マージ後のロジットが一致しません（最大誤差 {merged['max_abs_diff']:.2e} > {atol}）。"
+                           "チェックポイントは保存しません")
+    merged_latency = measure_latency(model, inputs, maxTokens)
+
+    print(f"=== 保存: {output_dir} ({dtype_name}) ===")
+    # 確認が終わるまでは一時ディレクトリに置き、1ファイルにまとめて保存
+    partial_dir = output_dir.rstrip(os.sep) + ".partial"
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    model.save_pretrained(partial_dir, safe_serialization=True, max_shard_size="100GB")
+    tokenizer.save_pretrained(partial_dir)
+
+    print("=== 保存したチェックポイントの確認 ===")
+    del model
+    model = AutoModelForCausalLM.from_pretrained(partial_dir, torch_dtype=dtype, device_map=device_map)
+    model.eval()
+    reloaded = check_parity(reference, compute_logits(model, inputs), atol)
+    if not reloaded["ok"]:
+        shutil.rmtree(partial_dir)
+        raise RuntimeError(f"再読み込み後のロジットが一致しません（最大誤差 {reloaded['max_abs_diff']:.2e} > {atol}）。"
+                           "チェックポイントは保存しません")
+    os.makedirs(output_dir, exist_ok=True)
+    for name in os.listdir(partial_dir):
+        os.replace(os.path.join(partial_dir, name), os.path.join(output_dir, name))
+    os.rmdir(partial_dir)
+    files = sorted(name for name in os.listdir(output_dir) if name.endswith(".safetensors"))
+    print(f"保存したファイル: {files}")
+
+    print("\n=== 結果 ===")
+    print(f"ロジット一致（マージ後）: 最大誤差 {merged['max_abs_diff']:.2e}, "
+          f"argmax一致率 {merged['top1_agreement']:.3f} {'✅' if merged['ok'] else '❌'}")
+    print(f"ロジット一致（再読み込み後）: 最大誤差 {reloaded['max_abs_diff']:.2e}, "
+          f"argmax一致率 {reloaded['top1_agreement']:.3f} {'✅' if reloaded['ok'] else '❌'}")
+    print(f"{'':12} {'プレフィル':>10} {'生成速度':>14}")
+    for label, latency in (("マージ前", unmerged_latency), ("マージ後", merged_latency)):
+        print(f"{label:12} {latency['prefill_ms']:>8.1f}ms {latency['tokens_per_sec']:>8.1f} tokens/sec")
+    speedup = merged_latency["tokens_per_sec"] / unmerged_latency["tokens_per_sec"]
+    print(f"生成速度の比: {speedup:.2f}x")
+
+    return {
+        "parity": merged,
+        "reload_parity": reloaded,
+        "unmerged": unmerged_latency,
+        "merged": merged_latency,
+    }
+
+
+def prepare_tiny_checkpoint(tmp_dir, tokenizer_path, **config_overrides):
+    """小型のベースモデルとランダムなLoRAアダプターを作成して保存"""
+    from peft import LoraConfig, get_peft_model
+    from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer
+
+    base_dir = os.path.join(tmp_dir, "base")
+    adapter_dir = os.path.join(tmp_dir, "adapter")
+    model, tokenizer = prepare_tiny_model_and_tokenizer(tokenizer_path, **config_overrides)
+    model.save_pretrained(base_dir)
+    tokenizer.save_pretrained(base_dir)
+
+    model = get_peft_model(model, LoraConfig(r=8, lora_alpha=16, target_modules=["query_key_value"]))
+    # lora_B は0で初期化されるため、差分が出るように乱数で埋める
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if "lora_B" in name:
+                param.normal_(std=0.05)
+    model.save_pretrained(adapter_dir)
+    return base_dir, adapter_dir
+
+
+def main():
+    """LoRAをマージして保存（ロジットが一致しなければ保存せずに終了コード1）"""
+    parser = argparse.ArgumentParser(description="LoRAアダプターをベースモデルにマージして保存")
+    parser.add_argument("--base", default=model_name, help="ベースモデル")
+    parser.add_argument("--adapter", default=peft_name, help="LoRAアダプター（学習済みのチェックポイントディレクトリ）")
+    parser.add_argument("--output", default=merged_name, help="出力先ディレクトリ")
+    parser.add_argument("--dtype", default="float16", choices=sorted(DTYPES), help="保存する重みのdtype")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="レイテンシ計測で生成するトークン数")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    args = parser.parse_args()
+
+    print("Rinna-3.6B LoRAアダプターのマージ")
+    print("=" * 50)
+
+    try:
+        if args.tiny:
+            from rinna_3_6b_tiny_model import tokenizer_name
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                base_dir, adapter_dir = prepare_tiny_checkpoint(tmp_dir, args.tokenizer or tokenizer_name)
+                merge_and_export(base_dir, adapter_dir, os.path.join(tmp_dir, "merged"),
+                                 args.dtype, maxTokens=args.max_new_tokens)
+            return
+
+        device_map = "auto" if torch.cuda.is_available() else None
+        merge_and_export(args.base, args.adapter, args.output, args.dtype,
+                         device_map=device_map, maxTokens=args.max_new_tokens)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
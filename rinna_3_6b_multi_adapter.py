@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B 推論用 複数LoRAアダプターの切り替え
+ベースモデルを1回だけ読み込み、名前を付けて登録した複数のLoRAアダプターを
+リクエストごとに選択する。アダプターは必要になった時点で読み込み、常駐数の上限を超えたら
+最も長く使われていないものを解放する（LRU）。
+
+    model, tokenizer = prepare_multi_adapter_model()
+    generate(model, tokenizer, "日本の首都は？", adapter="results-200")
+    generate_batch(model, tokenizer, requests, adapters=["optimized", "results-200", ...])
+
+使い方:
+    python rinna_3_6b_multi_adapter.py --tiny   # 小型モデルで単独読み込みとの出力一致と切り替え時間を確認
+"""
+
+import argparse
+import collections
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import torch
+from peft import PeftModel
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+import rinna_3_6b_inference as inference
+
+# パラメータ
+ADAPTERS = {
+    "optimized": "lora-rinna-3.6b-optimized",
+    "results-200": "lora-rinna-3.6b-results/checkpoint-200",
+    "results-optimized-470": "lora-rinna-3.6b-results-optimized/checkpoint-470",
+}
+MAX_RESIDENT_ADAPTERS = 2  # 同時にメモリに置くアダプター数の上限
+BASE_ADAPTER = "__base__"  # アダプターなし（ベースモデルのみ）を表す名前（PEFTの予約名）
+
+
+class AdapterRegistry:
+    """名前付きLoRAアダプターの登録と、常駐数の上限付き（LRU）の読み込み・解放
+
+    作成時に model.adapter_registry に自身を設定し、generate() / generate_batch() の
+    adapter / adapters 引数から参照される。混在バッチは PEFT の adapter_names で
+    行ごとにアダプターを切り替えて1回の生成で処理する。
+    アダプター未指定の呼び出しは、直前のリクエストのアダプターではなく default を使う。
+    """
+
+    def __init__(self, model, adapters, max_resident=MAX_RESIDENT_ADAPTERS):
+        if max_resident < 1:
+            raise ValueError("max_resident は1以上を指定してください")
+        self.model = model
+        self.paths = dict(adapters)
+        self.max_resident = max_resident
+        # PeftModel.from_pretrained で読み込み済みのアダプター
+        self.resident = collections.OrderedDict((name, None) for name in model.peft_config)
+        # アダプター未指定時に使うアダプター（PeftModel.from_pretrained で読み込んだもの）
+        self.default = next(iter(self.resident), BASE_ADAPTER)
+        self.loads = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+        model.adapter_registry = self
+
+    def register(self, name, path):
+        """アダプターを登録（読み込みは初めて使うときに行う）"""
+        self.paths[name] = path
+
+    def resolve(self, name):
+        """アダプター名（未指定なら default）"""
+        return self.default if name is None else name
+
+    def path(self, name):
+        """アダプターのディレクトリ（ベースモデルのみの場合は None）"""
+        if name == BASE_ADAPTER:
+            return None
+        if name not in self.paths:
+            raise KeyError(f"未登録のアダプターです: {name}（登録済み: {sorted(self.paths)}）")
+        return self.paths[name]
+
+    def activate(self, names):
+        """names のアダプターをすべて常駐させ、LRUの順番を更新"""
+        names = list(dict.fromkeys(name for name in names if name != BASE_ADAPTER))
+        if len(names) > self.max_resident:
+            raise ValueError(f"1回のバッチで使えるアダプターは {self.max_resident} 個までです: {names}")
+        for name in names:
+            if name not in self.resident:
+                start = time.perf_counter()
+                self.model.load_adapter(self.path(name), adapter_name=name, low_cpu_mem_usage=True)
+                self.load_seconds += time.perf_counter() - start
+                self.loads += 1
+            self.resident[name] = None
+            self.resident.move_to_end(name)
+
+        if names:
+            self.model.set_adapter(names[-1])
+        # 今回使うアダプター以外を古い順に解放
+        for name in list(self.resident):
+            if len(self.resident) <= self.max_resident:
+                break
+            if name not in names:
+                self.model.delete_adapter(name)
+                del self.resident[name]
+                self.evictions += 1
+        # アダプターを読み込むとPEFTが学習モードに戻す場合があるため評価モードに揃える
+        self.model.eval()
+
+    def generate_kwargs(self, names):
+        """model.generate に渡す引数（全行が同じアダプターなら切り替えのみ、混在なら行ごとに指定）"""
+        self.activate(names)
+        if len(set(names)) == 1 and names[0] != BASE_ADAPTER:
+            return {}
+        return {"adapter_names": list(names)}
+
+    def stats(self):
+        """常駐中のアダプターと読み込み・解放の回数"""
+        return {
+            "resident": list(self.resident),
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "load_seconds": self.load_seconds,
+        }
+
+
+def prepare_multi_adapter_model(adapters=ADAPTERS, max_resident=MAX_RESIDENT_ADAPTERS,
+                                base_name=inference.model_name, **model_kwargs):
+    """ベースモデルを1回だけ読み込み、複数のアダプターを登録"""
+    print("=== ベースモデルと複数アダプターの準備 ===")
+    if not model_kwargs:
+        model_kwargs = dict(load_in_8bit=True, device_map="auto")
+    model = AutoModelForCausalLM.from_pretrained(base_name, **model_kwargs)
+    # Rinnaのトークナイザーでは use_fast=False が必要
+    tokenizer = AutoTokenizer.from_pretrained(base_name, use_fast=False)
+
+    # 最初のアダプターでPEFTのラッパーを作成し、残りは使うときに読み込む
+    first_name, first_path = next(iter(adapters.items()))
+    model = PeftModel.from_pretrained(model, first_path, adapter_name=first_name)
+    model.eval()
+    AdapterRegistry(model, adapters, max_resident)
+
+    print(f"登録したアダプター: {list(adapters)}（常駐上限 {max_resident}）")
+    return model, tokenizer
+
+
+def main():
+    """小型モデルで、アダプターごとに単独で読み込んだ場合との出力一致と切り替え時間を確認（不一致なら終了コード1）"""
+    parser = argparse.ArgumentParser(description="複数LoRAアダプター切り替えの動作確認")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    args = parser.parse_args()
+
+    from peft import LoraConfig, get_peft_model
+    from rinna_3_6b_prefix_cache import PrefixCache
+    from rinna_3_6b_response_cache import ResponseCache
+    from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer, tokenizer_name
+
+    print("=== 複数LoRAアダプター切り替えの動作確認 ===")
+    inference.GENERATION_PARAMS = dict(do_sample=False)
+    questions = ["日本の首都は？", "Pythonの特徴は？", "機械学習について教えて"]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.tiny:
+            tokenizer_path = args.tokenizer or tokenizer_name
+            base, tokenizer = prepare_tiny_model_and_tokenizer(tokenizer_path)
+            base_dir = os.path.join(tmp_dir, "base")
+            base.save_pretrained(base_dir)
+            tokenizer.save_pretrained(base_dir)
+            adapters = {}
+            for seed, name in enumerate(ADAPTERS):
+                model, _ = prepare_tiny_model_and_tokenizer(tokenizer_path)
+                model = get_peft_model(model, LoraConfig(r=8, target_modules=["query_key_value"]))
+                torch.manual_seed(seed)
+                with torch.no_grad():
+                    for param_name, param in model.named_parameters():
+                        if "lora_B" in param_name:
+                            param.normal_(std=0.5)
+                adapters[name] = os.path.join(tmp_dir, name)
+                model.save_pretrained(adapters[name])
+            model, tokenizer = prepare_multi_adapter_model(adapters, base_name=base_dir, torch_dtype=torch.float32)
+        else:
+            base_dir, adapters = inference.model_name, ADAPTERS
+            model, tokenizer = prepare_multi_adapter_model()
+
+        def single_adapter_answers(name):
+            """アダプターを1つだけ読み込んだモデルでの回答（比較用）"""
+            kwargs = dict(torch_dtype=torch.float32) if args.tiny else dict(load_in_8bit=True, device_map="auto")
+            single = AutoModelForCausalLM.from_pretrained(base_dir, **kwargs)
+            if name != BASE_ADAPTER:
+                single = PeftModel.from_pretrained(single, adapters[name])
+            single.eval()
+            return inference.generate_batch(single, tokenizer, [(q, None) for q in questions], maxTokens=16)
+
+        names = list(adapters) + [BASE_ADAPTER]
+        expected = {name: single_adapter_answers(name) for name in names}
+
+        registry = model.adapter_registry
+        matched = 0
+        print(f"{'アダプター':24} {'一致':>4} {'切り替え':>10}")
+        for name in names + names[::-1]:
+            start = time.perf_counter()
+            registry.activate([name])
+            switch_ms = (time.perf_counter() - start) * 1000
+            results = inference.generate_batch(
+                model, tokenizer, [(q, None) for q in questions], maxTokens=16, adapters=[name] * len(questions))
+            same = results == expected[name]
+            matched += same
+            print(f"{name:24} {'✅' if same else '❌':>4} {switch_ms:>8.1f}ms")
+
+        # 混在バッチ（常駐上限の範囲で2つのアダプター + ベースモデル）
+        mixed = [names[0], names[1], BASE_ADAPTER]
+        results = inference.generate_batch(
+            model, tokenizer, [(q, None) for q in questions], maxTokens=16, adapters=mixed)
+        mixed_ok = all(result == expected[name][i] for i, (name, result) in enumerate(zip(mixed, results)))
+        print(f"混在バッチ {mixed}: {'✅' if mixed_ok else '❌'}")
+
+        # 単独の generate() でもアダプターを指定できる
+        inference.generate(model, tokenizer, questions[0], maxTokens=16, adapter=names[-2])
+
+        # 未指定の呼び出しは直前に切り替えたアダプターではなく default で生成する
+        registry.activate([names[1]])
+        results = inference.generate_batch(model, tokenizer, [(q, None) for q in questions], maxTokens=16)
+        default_ok = results == expected[registry.default]
+        print(f"未指定（{registry.default}）: {'✅' if default_ok else '❌'}")
+
+        # レスポンスキャッシュはベースモデルと default を区別し、プレフィックスKVもアダプターごとに分ける
+        response_cache, prefix_cache = ResponseCache(base_dir), PrefixCache()
+        with contextlib.redirect_stdout(io.StringIO()):
+            cache_ok = all(
+                inference.generate(model, tokenizer, question, maxTokens=16, adapter=name,
+                                   response_cache=response_cache, prefix_cache=prefix_cache)
+                == expected[registry.resolve(name)][i]
+                for _ in range(2) for name in (BASE_ADAPTER, None, names[1]) for i, question in enumerate(questions)
+            )
+        print(f"キャッシュ併用: {'✅' if cache_ok else '❌'} {response_cache.stats()['hit_rate']:.2f}")
+
+        print(f"\n一致: {matched}/{len(names) * 2}")
+        print(f"アダプター統計: {registry.stats()}")
+    if not (matched == len(names) * 2 and mixed_ok and default_ok and cache_ok):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
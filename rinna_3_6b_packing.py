@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B LoRA学習用 シーケンスパッキング
+複数の学習サンプルを CUTOFF_LEN 長の行に詰め込み、パディングによる無駄な計算を削減する
+"""
+
+import torch
+
+
+def pack_examples(examples, max_length, eos_token_id):
+    """トークナイズ済みサンプルを max_length 長の行に詰め込む（Best-Fit）
+
+    各サンプルは分割せず、末尾がEOSで区切られた状態で1行に収める。
+    position_ids はサンプルごとに0から振り直す。
+    """
+    # 残り容量ごとに行番号を管理（容量はmax_length以下なのでリストで十分）
+    rows = []
+    bins_by_space = [[] for _ in range(max_length + 1)]
+
+    for input_ids in examples:
+        input_ids = list(input_ids[:max_length])
+        if input_ids and input_ids[-1] != eos_token_id:
+            if len(input_ids) == max_length:
+                input_ids[-1] = eos_token_id
+            else:
+                input_ids.append(eos_token_id)
+        length = len(input_ids)
+        if length == 0:
+            continue
+
+        # 入りきる行のうち残り容量が最小の行を選ぶ
+        row_index = None
+        for space in range(length, max_length + 1):
+            if bins_by_space[space]:
+                row_index = bins_by_space[space].pop()
+                break
+        if row_index is None:
+            row_index = len(rows)
+            rows.append({"input_ids": [], "position_ids": []})
+            space = max_length
+
+        row = rows[row_index]
+        row["input_ids"].extend(input_ids)
+        row["position_ids"].extend(range(length))
+        bins_by_space[space - length].append(row_index)
+
+    return rows
+
+
+def padding_ratio(lengths, batch_size):
+    """連続する batch_size 行ごとに最長行へパディングした場合のパディング率"""
+    padded = 0
+    total = 0
+    for start in range(0, len(lengths), batch_size):
+        batch = lengths[start:start + batch_size]
+        padded += max(batch) * len(batch)
+        total += sum(batch)
+    if padded == 0:
+        return 0.0
+    return 1.0 - total / padded
+
+
+def report_padding(before_lengths, after_lengths, batch_size):
+    """パッキング前後のパディング率を表示"""
+    before = padding_ratio(before_lengths, batch_size)
+    after = padding_ratio(after_lengths, batch_size)
+    print("パッキング結果:")
+    print(f"  行数: {len(before_lengths)} → {len(after_lengths)}")
+    print(f"  トークン数: {sum(before_lengths)} → {sum(after_lengths)}")
+    print(f"  パディング率: {before:.1%} → {after:.1%}")
+    return before, after
+
+
+class PackedDataCollator:
+    """パッキング済みの行をバッチ化するデータコレクター
+
+    position_ids が0に戻る位置をサンプル境界とみなし、サンプルをまたいで
+    attention しないブロック対角の因果マスク（4D、加算形式）を作成する。
+    GPT-NeoX が4Dの加算形式のマスクをそのまま使うのは transformers 4.45 以降
+    （それより前は [batch, seq] の2Dマスクとして view されるため使えない）。
+    """
+
+    def __init__(self, pad_token_id, mask_dtype=torch.float32):
+        self.pad_token_id = pad_token_id
+        self.mask_dtype = mask_dtype
+
+    def __call__(self, features):
+        max_len = max(len(f["input_ids"]) for f in features)
+        batch_size = len(features)
+
+        input_ids = torch.full((batch_size, max_len), self.pad_token_id, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, max_len), dtype=torch.long)
+        labels = torch.full((batch_size, max_len), -100, dtype=torch.long)
+        # パディング位置はセグメントID -1
+        segment_ids = torch.full((batch_size, max_len), -1, dtype=torch.long)
+
+        for i, f in enumerate(features):
+            length = len(f["input_ids"])
+            ids = torch.tensor(f["input_ids"], dtype=torch.long)
+            pos = torch.tensor(f["position_ids"], dtype=torch.long)
+            input_ids[i, :length] = ids
+            position_ids[i, :length] = pos
+            labels[i, :length] = ids
+            # 前のサンプルのEOSから次のサンプル先頭を予測しないようにする
+            labels[i, :length][pos == 0] = -100
+            segment_ids[i, :length] = torch.cumsum(pos == 0, dim=0)
+
+        # 同じサンプル内かつ因果方向のみ attention を許可
+        causal = torch.tril(torch.ones((max_len, max_len), dtype=torch.bool))
+        same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+        allowed = same_segment & causal & (segment_ids[:, :, None] >= 0)
+        # パディング位置は自分自身のみ参照（全マスク行を作らない）
+        allowed |= torch.eye(max_len, dtype=torch.bool)
+
+        attention_mask = torch.zeros((batch_size, 1, max_len, max_len), dtype=self.mask_dtype)
+        attention_mask.masked_fill_(~allowed[:, None], torch.finfo(self.mask_dtype).min)
+
+        return {
+            "input_ids": input_ids,
+            "position_ids": position_ids,
+            "attention_mask": attention_mask,
+            "labels": labels,
+        }
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B 推論用 共有プレフィックスKVキャッシュ
+過去に計算したプロンプトの past_key_values をトークンIDのトライ木で管理し、
+先頭が一致する新しいプロンプトでは一致部分のプレフィルを省略する
+
+使い方:
+    python rinna_3_6b_prefix_cache.py --tiny   # 小型モデルでキャッシュ有無の出力一致を確認
+"""
+
+import argparse
+import collections
+import contextlib
+import io
+import sys
+
+from rinna_3_6b_kv_cache import cache_nbytes, from_legacy, slice_seq, to_legacy
+
+# パラメータ
+PREFIX_CACHE_MB = 512  # キャッシュに保持するKVの上限（MB）
+
+
+class _TrieNode:
+    __slots__ = ("children", "entries")
+
+    def __init__(self):
+        self.children = {}
+        # このノードを通るエントリのキー（どれでも先頭部分のKVとして使える）
+        self.entries = set()
+
+
+class PrefixCache:
+    """トークンIDのトライ木で引くプレフィックスKVキャッシュ（メモリ上限付きLRU）
+
+    エントリはプロンプト全体のKVを保持し、そのエントリが通るトライ木のノードすべてから
+    参照される。検索では一致した最も深いノードのエントリのKVを一致長に切り出して使う。
+    namespace（LoRAアダプター名など）ごとに別のトライ木を使い、KVが異なるモデル間で共有しない。
+    """
+
+    def __init__(self, max_bytes=PREFIX_CACHE_MB * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.roots = {}
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+
+        self.lookups = 0
+        self.hits = 0
+        self.prefill_tokens = 0
+        self.prefill_tokens_saved = 0
+
+    def lookup(self, token_ids, namespace=None):
+        """一致する最長プレフィックスの長さとKVを返す（最後の1トークンは必ず計算する）"""
+        self.lookups += 1
+        self.prefill_tokens += len(token_ids)
+
+        node = self.roots.get(namespace, _TrieNode())
+        length, key = 0, None
+        for depth, token_id in enumerate(token_ids[:-1], 1):
+            node = node.children.get(token_id)
+            if node is None or not node.entries:
+                break
+            length = depth
+            key = next(iter(node.entries))
+
+        if key is None:
+            return 0, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.prefill_tokens_saved += length
+        return length, slice_seq(self.entries[key], 0, length)
+
+    def past_key_values(self, token_ids, namespace=None):
+        """model.generate に渡せる形式で一致部分のKVを返す（一致しなければ None）"""
+        _, layers = self.lookup(token_ids, namespace)
+        return from_legacy(layers)
+
+    def insert(self, token_ids, past_key_values, namespace=None):
+        """プロンプトのKVを登録（生成部分を含むキャッシュはプロンプト長に切り詰める）"""
+        key = (namespace, tuple(token_ids))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        # 生成部分のメモリを解放するため複製して保持
+        layers = tuple(
+            (k.clone(), v.clone())
+            for k, v in slice_seq(to_legacy(past_key_values), 0, len(key[1]))
+        )
+        nbytes = cache_nbytes(layers)
+        if nbytes > self.max_bytes:
+            return
+
+        self.entries[key] = layers
+        self.total_bytes += nbytes
+        node = self.roots.setdefault(namespace, _TrieNode())
+        for token_id in key[1]:
+            node = node.children.setdefault(token_id, _TrieNode())
+            node.entries.add(key)
+
+        while self.total_bytes > self.max_bytes:
+            self._evict(next(iter(self.entries)))
+
+    def _evict(self, key):
+        layers = self.entries.pop(key)
+        self.total_bytes -= cache_nbytes(layers)
+        # エントリが通るノードから参照を外し、空になったノードを削除
+        namespace, token_ids = key
+        path = [self.roots[namespace]]
+        for token_id in token_ids:
+            path.append(path[-1].children[token_id])
+        for depth in range(len(token_ids), 0, -1):
+            node = path[depth]
+            node.entries.discard(key)
+            if not node.entries and not node.children:
+                del path[depth - 1].children[token_ids[depth - 1]]
+
+    def stats(self):
+        """ヒット率と省略できたプレフィルトークン数"""
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "prefill_tokens": self.prefill_tokens,
+            "prefill_tokens_saved": self.prefill_tokens_saved,
+        }
+
+
+def main():
+    """小型モデルでキャッシュあり・なしの生成結果（貪欲生成）が一致することを確認（不一致なら終了コード1）"""
+    parser = argparse.ArgumentParser(description="共有プレフィックスKVキャッシュの動作確認")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    args = parser.parse_args()
+
+    import rinna_3_6b_inference as inference
+    from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer, tokenizer_name
+
+    print("=== 共有プレフィックスKVキャッシュの動作確認 ===")
+    if args.tiny:
+        model, tokenizer = prepare_tiny_model_and_tokenizer(args.tokenizer or tokenizer_name)
+    else:
+        model, tokenizer = inference.prepare_model_and_tokenizer()
+    # 結果を照合できるよう貪欲生成にする
+    inference.GENERATION_PARAMS = dict(inference.GENERATION_PARAMS, do_sample=False)
+
+    context = "自然言語処理は、人間が日常的に使っている言語をコンピュータに処理させる技術です。" * 3
+    requests = [
+        ("日本の首都は？", None),
+        ("この文章を要約してください", context),
+        ("この文章を要約してください", context + "機械翻訳や対話システムに応用されています。"),
+        ("日本の首都は？", None),
+        ("Pythonの特徴は？", None),
+    ]
+
+    prefix_cache = PrefixCache()
+    matched = 0
+    for instruction, input in requests:
+        # generate() が表示する生成全体の文字列で比較
+        expected, actual = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(expected):
+            inference.generate(model, tokenizer, instruction, input, maxTokens=32)
+        with contextlib.redirect_stdout(actual):
+            inference.generate(model, tokenizer, instruction, input, maxTokens=32, prefix_cache=prefix_cache)
+        same = expected.getvalue() == actual.getvalue()
+        matched += same
+        print(f"{'✅' if same else '❌'} {instruction}")
+
+    stats = prefix_cache.stats()
+    print(f"\n一致: {matched}/{len(requests)}")
+    print(f"キャッシュ統計: {stats}")
+    if matched < len(requests) or stats["prefill_tokens_saved"] == 0:
+        print("❌ キャッシュありの生成結果が一致しないか、キャッシュが使われていません")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B 推論用 レスポンスキャッシュ
+同じプロンプト・同じ生成パラメータ・同じアダプターへのリクエストに対して、
+前回生成したトークン列を返す。結果が決まる呼び出し（貪欲生成、またはシード指定）のみが対象。
+メモリ上のLRUと、任意でサイズ上限付きのディスク層を持つ。
+アダプターの重みファイルが変わるとキーが変わるため、古いエントリは自動的に無効になる。
+
+使い方:
+    python rinna_3_6b_response_cache.py --tiny   # 小型モデルでヒット・無効化の動作を確認
+"""
+
+import argparse
+import collections
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unicodedata
+
+# パラメータ
+RESPONSE_CACHE_ENTRIES = 1024  # メモリ層に保持するエントリ数
+RESPONSE_CACHE_DISK_MB = 256  # ディスク層の上限（MB）
+BASE_MODEL_ADAPTER = "__base__"  # adapter_dir に指定するとアダプターなし（ベースモデルのみ）として扱う
+
+
+def adapter_fingerprint(adapter_dir):
+    """アダプターディレクトリ内のファイル名・サイズ・更新時刻から識別子を作成
+
+    ディレクトリでない場合（Hubのリポジトリ名など）は名前をそのまま使う。
+    """
+    if not os.path.isdir(adapter_dir):
+        return adapter_dir
+    digest = hashlib.sha256(os.path.abspath(adapter_dir).encode())
+    for name in sorted(os.listdir(adapter_dir)):
+        path = os.path.join(adapter_dir, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def normalize_text(text):
+    """キャッシュキー用の正規化（Unicode NFC・前後の空白除去）"""
+    if not text:
+        return ""
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def is_cacheable(params, seed=None):
+    """結果が決まる呼び出し（貪欲生成、またはシード指定のサンプリング）かどうか"""
+    return not params.get("do_sample", False) or seed is not None
+
+
+class ResponseCache:
+    """生成トークン列のキャッシュ（メモリLRU + 任意のディスク層）
+
+    キーはモデル名・アダプターの識別子・正規化したプロンプト・生成パラメータ・
+    最大トークン数・シード・停止文字列から作るハッシュ。値は生成されたトークンID列。
+    """
+
+    def __init__(self, model_name, adapter_dir=None, disk_dir=None,
+                 max_entries=RESPONSE_CACHE_ENTRIES, max_disk_bytes=RESPONSE_CACHE_DISK_MB * 1024 ** 2):
+        self.model_name = model_name
+        self.adapter_dir = adapter_dir
+        self.disk_dir = disk_dir
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = collections.OrderedDict()
+        self.fingerprints = {}
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.invalidations = 0
+
+        self.disk_bytes = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.disk_bytes = sum(size for _, _, size in self._disk_entries())
+
+    def _current_fingerprint(self, adapter_dir):
+        if adapter_dir == BASE_MODEL_ADAPTER:
+            return BASE_MODEL_ADAPTER
+        fingerprint = adapter_fingerprint(adapter_dir) if adapter_dir else ""
+        # アダプターが変わったらメモリ層を破棄（ディスク層の古いエントリは参照されずに追い出される）
+        previous = self.fingerprints.get(adapter_dir)
+        if fingerprint != previous:
+            if previous is not None:
+                self.invalidations += 1
+                self.memory.clear()
+            self.fingerprints[adapter_dir] = fingerprint
+        return fingerprint
+
+    def key(self, instruction, input, params, maxTokens, seed=None, stop_strings=(), adapter_dir=None):
+        """リクエストのキャッシュキー
+
+        adapter_dir 指定時は作成時のアダプターの代わりに使う（BASE_MODEL_ADAPTER ならアダプターなし）
+        """
+        payload = {
+            "model": self.model_name,
+            "adapter": self._current_fingerprint(adapter_dir or self.adapter_dir),
+            "instruction": normalize_text(instruction),
+            "input": normalize_text(input),
+            "params": params,
+            "max_new_tokens": maxTokens,
+            "seed": seed,
+            "stop_strings": list(stop_strings),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    def get(self, key):
+        """キャッシュされたトークンID列を返す（なければ None）"""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return list(self.memory[key])
+
+        if self.disk_dir is not None:
+            path = self._disk_path(key)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    token_ids = json.load(f)
+            except (OSError, ValueError):
+                token_ids = None
+            if token_ids is not None:
+                os.utime(path)  # ディスク層のLRU順を更新
+                self._put_memory(key, token_ids)
+                self.disk_hits += 1
+                return list(token_ids)
+
+        self.misses += 1
+        return None
+
+    def put(self, key, token_ids):
+        """生成されたトークンID列を登録"""
+        token_ids = list(token_ids)
+        self._put_memory(key, token_ids)
+        if self.disk_dir is not None:
+            self._put_disk(key, token_ids)
+
+    def bypass(self):
+        """キャッシュ対象外の呼び出しを記録"""
+        self.bypassed += 1
+
+    def _put_memory(self, key, token_ids):
+        self.memory[key] = token_ids
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_entries(self):
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(self.disk_dir, name))
+                entries.append((stat.st_mtime_ns, name, stat.st_size))
+        return entries
+
+    def _put_disk(self, key, token_ids):
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            self.disk_bytes -= os.path.getsize(path)
+        # 書き込み途中のファイルを読まないよう一時ファイルから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(token_ids, f)
+        os.replace(tmp_path, path)
+        self.disk_bytes += os.path.getsize(path)
+
+        if self.disk_bytes > self.max_disk_bytes:
+            # 最終アクセスが古い順に削除
+            for _, name, size in sorted(self._disk_entries()):
+                if self.disk_bytes <= self.max_disk_bytes:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.disk_dir, name))
+                    self.disk_bytes -= size
+
+    def stats(self):
+        """ヒット・ミス数とヒット率"""
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "memory_entries": len(self.memory),
+            "disk_bytes": self.disk_bytes,
+        }
+
+
+def main():
+    """小型モデルでメモリ・ディスク層のヒットとアダプター更新時の無効化を確認（失敗すれば終了コード1）"""
+    parser = argparse.ArgumentParser(description="レスポンスキャッシュの動作確認")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    args = parser.parse_args()
+
+    import torch
+    from peft import LoraConfig, get_peft_model
+
+    import rinna_3_6b_inference as inference
+    from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer, tokenizer_name
+
+    print("=== レスポンスキャッシュの動作確認 ===")
+    if args.tiny:
+        model, tokenizer = prepare_tiny_model_and_tokenizer(args.tokenizer or tokenizer_name)
+        model = get_peft_model(model, LoraConfig(r=8, target_modules=["query_key_value"]))
+    else:
+        model, tokenizer = inference.prepare_model_and_tokenizer()
+    model.eval()
+    inference.GENERATION_PARAMS = dict(do_sample=False, no_repeat_ngram_size=2)
+
+    def run(cache, instruction, seed=None):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            inference.generate(model, tokenizer, instruction, maxTokens=32, response_cache=cache, seed=seed)
+        return output.getvalue()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        adapter_dir = os.path.join(tmp, "adapter")
+        model.save_pretrained(adapter_dir)
+        disk_dir = os.path.join(tmp, "responses")
+        questions = ["日本の首都は？", "Pythonの特徴は？"]
+
+        checks = []
+
+        def check(label, ok, cache):
+            checks.append(ok)
+            print(f"{label}: {'✅' if ok else '❌'} {cache.stats()}")
+
+        cache = ResponseCache(inference.model_name, adapter_dir, disk_dir)
+        expected = [run(None, question) for question in questions]
+        first = [run(cache, question) for question in questions]    # ミス
+        second = [run(cache, question) for question in questions]   # メモリ層ヒット
+        check("メモリ層", first == expected and second == expected and cache.memory_hits == len(questions), cache)
+
+        cache = ResponseCache(inference.model_name, adapter_dir, disk_dir)
+        third = [run(cache, question) for question in questions]    # ディスク層ヒット
+        check("ディスク層", third == expected and cache.disk_hits == len(questions), cache)
+
+        # generate() が登録したエントリを generate_batch() でも使う（同じ形で登録されている）
+        with contextlib.redirect_stdout(io.StringIO()):
+            single = [inference.generate(model, tokenizer, question, maxTokens=32) for question in questions]
+            hits = cache.memory_hits
+            batch = inference.generate_batch(model, tokenizer, [(question, None) for question in questions],
+                                             maxTokens=32, response_cache=cache)
+        check("バッチ生成", batch == single and cache.memory_hits == hits + len(questions), cache)
+
+        # アダプターを更新するとキャッシュは使われない
+        with torch.no_grad():
+            for name, param in model.named_parameters():
+                if "lora_B" in name:
+                    param.normal_(std=0.5)
+        model.save_pretrained(adapter_dir)
+        updated = [run(None, question) for question in questions]
+        fourth = [run(cache, question) for question in questions]
+        check("アダプター更新後", fourth == updated and updated != expected and cache.invalidations == 1, cache)
+
+        # サンプリングでもシードなしなら貪欲生成でキャッシュし、シード指定ならサンプリングのままキャッシュ
+        inference.GENERATION_PARAMS = dict(do_sample=True, top_k=40)
+        hits = cache.memory_hits
+        unseeded = [run(cache, questions[0]) for _ in range(2)]
+        check("シードなし（貪欲生成）", unseeded[0] == unseeded[1] and cache.memory_hits == hits + 1, cache)
+        seeded = [run(cache, questions[0], seed=0) for _ in range(2)]
+        check("シード指定", seeded[0] == seeded[1], cache)
+
+    if not all(checks):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B 推論用 投機的デコーディング（speculative decoding）
+同じトークナイザーを使う小さなドラフトモデルで k トークンを先に生成し、LoRA適用済みの
+ターゲットモデルの1回のフォワードでまとめて検証する。受理・棄却はリジェクションサンプリングで行い、
+出力の分布はターゲットモデルで1トークンずつ生成した場合と同じになる（貪欲生成では出力が一致）。
+
+推論スクリプトの DRAFT_MODEL_NAME にドラフトモデルを設定し、generate() の draft_model に渡して使う。
+
+使い方:
+    python rinna_3_6b_speculative.py --draft <ドラフトモデル>   # 3.6Bモデルで k ごとの受理率と速度を計測
+    python rinna_3_6b_speculative.py --tiny   # 小型モデルで受理・棄却の正しさと k ごとの速度を確認
+"""
+
+import argparse
+import copy
+import sys
+import time
+
+import torch
+
+import rinna_3_6b_inference as inference
+from rinna_3_6b_kv_cache import from_legacy, seq_length, slice_seq, to_legacy
+
+def processed_probs(logits_processor, input_ids, logits, do_sample, vocab_size=None):
+    """ロジット処理を適用した次トークンの確率分布（貪欲生成では argmax の one-hot）"""
+    if vocab_size is not None:
+        logits = logits[..., :vocab_size]
+    scores = logits_processor(input_ids, logits.float())
+    if do_sample:
+        return torch.softmax(scores, dim=-1)
+    return torch.nn.functional.one_hot(scores.argmax(dim=-1), scores.shape[-1]).float()
+
+
+def verify_draft(draft_tokens, draft_probs, target_probs, generator=None):
+    """ドラフトのトークンを先頭から受理・棄却し、確定したトークンのリストを返す
+
+    draft_probs[i] はドラフトモデル、target_probs[i] はターゲットモデルの i 番目の位置の分布。
+    target_probs はドラフトより1つ多く、すべて受理した場合は最後の分布から1トークン追加する。
+    トークン x は確率 min(1, p(x) / q(x)) で受理し、棄却した場合は max(0, p - q) を正規化した
+    分布から選び直す。これにより各位置の出力はターゲットの分布 p に従う。
+    """
+    tokens = []
+    for i, token in enumerate(draft_tokens):
+        p = target_probs[i, token]
+        q = draft_probs[i, token]
+        if torch.rand((), generator=generator, device=target_probs.device) * q < p:
+            tokens.append(token)
+            continue
+        residual = torch.clamp(target_probs[i] - draft_probs[i], min=0)
+        if residual.sum() <= 0:
+            residual = target_probs[i]
+        tokens.append(torch.multinomial(residual / residual.sum(), 1, generator=generator).item())
+        return tokens
+    tokens.append(torch.multinomial(target_probs[len(draft_tokens)], 1, generator=generator).item())
+    return tokens
+
+
+def _forward(model, input_ids, past):
+    """キャッシュ付きフォワード（past はレイヤーごとの (key, value) タプル）"""
+    outputs = model(input_ids=input_ids, past_key_values=from_legacy(past), use_cache=True)
+    return outputs.logits, to_legacy(outputs.past_key_values)
+
+
+@torch.inference_mode()
+def speculative_generate(model, draft_model, input_ids, max_new_tokens, k=inference.SPECULATIVE_K, params=None,
+                         eos_token_id=None, stop_criteria=None, generator=None):
+    """投機的デコーディングで生成し、(プロンプトを含むトークンID列, 統計) を返す（バッチサイズ1）"""
+    params = inference.GENERATION_PARAMS if params is None else params
+    do_sample = params.get("do_sample", False)
+    logits_processor = inference.build_logits_processor(params)
+    # 語彙サイズ（埋め込みのパディング）が異なる場合は共通部分で比較する
+    vocab_size = None
+    if model.config.vocab_size != draft_model.config.vocab_size:
+        vocab_size = min(model.config.vocab_size, draft_model.config.vocab_size)
+
+    seq = input_ids
+    prompt_len = input_ids.shape[1]
+    target_past = draft_past = None
+    stats = {"proposed": 0, "accepted": 0, "target_forwards": 0, "draft_forwards": 0}
+
+    while seq.shape[1] - prompt_len < max_new_tokens:
+        # 最後の1トークンはターゲットの分布から追加されるため、ドラフトは残り-1まで
+        num_draft = min(k, max_new_tokens - (seq.shape[1] - prompt_len) - 1)
+
+        # ドラフトモデルで num_draft トークンを生成
+        work = seq
+        draft_tokens, draft_probs = [], []
+        for _ in range(num_draft):
+            cached = seq_length(draft_past) if draft_past is not None else 0
+            logits, draft_past = _forward(draft_model, work[:, cached:], draft_past)
+            probs = processed_probs(logits_processor, work, logits[:, -1], do_sample, vocab_size)
+            token = torch.multinomial(probs, 1, generator=generator) if do_sample else probs.argmax(-1, keepdim=True)
+            draft_tokens.append(token.item())
+            draft_probs.append(probs[0])
+            work = torch.cat([work, token], dim=1)
+            stats["draft_forwards"] += 1
+
+        # ターゲットモデルの1回のフォワードで num_draft + 1 か所の分布を計算
+        cached = seq_length(target_past) if target_past is not None else 0
+        logits, target_past = _forward(model, work[:, cached:], target_past)
+        stats["target_forwards"] += 1
+        start = seq.shape[1] - 1 - cached
+        target_probs = torch.stack([
+            processed_probs(logits_processor, work[:, :seq.shape[1] + i], logits[:, start + i],
+                            do_sample, vocab_size)[0]
+            for i in range(num_draft + 1)
+        ])
+        draft_probs = torch.stack(draft_probs) if draft_probs else target_probs[:0]
+
+        new_tokens = verify_draft(draft_tokens, draft_probs, target_probs, generator)
+        stats["proposed"] += num_draft
+        stats["accepted"] += len(new_tokens) - 1
+        seq = torch.cat([seq, torch.tensor([new_tokens], device=seq.device)], dim=1)
+
+        # キャッシュは最後のトークンの手前まで（棄却したドラフトの分を捨てる）
+        keep = seq.shape[1] - 1
+        target_past = slice_seq(target_past, 0, keep)
+        if draft_past is not None:
+            draft_past = slice_seq(draft_past, 0, min(keep, seq_length(draft_past)))
+
+        # EOS・停止文字列で終了
+        generated = seq[0, prompt_len:].tolist()
+        if eos_token_id is not None and eos_token_id in generated:
+            seq = seq[:, :prompt_len + generated.index(eos_token_id) + 1]
+            break
+        if stop_criteria is not None and stop_criteria.find_stop(generated) is not None:
+            break
+
+    seq = seq[:, :prompt_len + max_new_tokens]
+    stats["acceptance_rate"] = stats["accepted"] / stats["proposed"] if stats["proposed"] else 0.0
+    stats["tokens_per_target_forward"] = (seq.shape[1] - prompt_len) / max(stats["target_forwards"], 1)
+    return seq, stats
+
+
+def prepare_draft_model(draft_name=inference.DRAFT_MODEL_NAME, device=None):
+    """ドラフトモデルの読み込み"""
+    from transformers import AutoModelForCausalLM
+
+    draft_model = AutoModelForCausalLM.from_pretrained(
+        draft_name,
+        torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+    )
+    if device is not None:
+        draft_model.to(device)
+    draft_model.eval()
+    return draft_model
+
+
+def early_exit_draft(model, num_layers):
+    """ターゲットの先頭 num_layers 層と出力層を共有するドラフトモデル（小型モデルでの検証用）
+
+    重みは複製せずに共有し、子モジュールの辞書だけを複製する（copy.copy のままだと辞書を共有し、
+    層の差し替えでターゲットの層まで減ってしまう）。ターゲットは変更しない。
+    """
+    draft_model = copy.copy(model)
+    draft_model._modules = copy.copy(model._modules)
+    draft_model.gpt_neox = copy.copy(model.gpt_neox)
+    draft_model.gpt_neox._modules = copy.copy(model.gpt_neox._modules)
+    draft_model.gpt_neox.layers = model.gpt_neox.layers[:num_layers]
+    draft_model.config = copy.deepcopy(model.config)
+    draft_model.config.num_hidden_layers = num_layers
+    draft_model.gpt_neox.config = draft_model.config
+    return draft_model
+
+
+def total_variation(counts, probs):
+    """サンプルの頻度と確率分布の全変動距離"""
+    freq = counts / counts.sum()
+    return 0.5 * (freq - probs).abs().sum().item()
+
+
+def main():
+    """受理・棄却と貪欲生成の一致を確認し、k ごとの速度を表示（確認に失敗すれば終了コード1）"""
+    parser = argparse.ArgumentParser(description="投機的デコーディングの動作確認")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    parser.add_argument("--draft", default=inference.DRAFT_MODEL_NAME, help="ドラフトモデル（--tiny 以外）")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="生成トークン数")
+    parser.add_argument("--samples", type=int, default=2000, help="分布の確認に使うサンプル数")
+    args = parser.parse_args()
+
+    from transformers import StoppingCriteriaList
+
+    print("=== 投機的デコーディングの動作確認 ===")
+    checks = []
+    if args.tiny:
+        from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer, tokenizer_name
+
+        model, tokenizer = prepare_tiny_model_and_tokenizer(
+            args.tokenizer or tokenizer_name,
+            hidden_size=1024, num_hidden_layers=8, num_attention_heads=8, intermediate_size=4096)
+        # ドラフトにはターゲットの先頭の層を共有するモデルを使い、分布の確認には棄却が起きるよう出力層に雑音を加える。
+        # ランダム初期化では先頭の層だけの予測はほとんど一致しないため、受理率と速度比は最も不利な場合の参考値
+        num_layers = len(model.gpt_neox.layers)
+        draft_model = early_exit_draft(model, 1)
+        unchanged = len(model.gpt_neox.layers) == num_layers and len(draft_model.gpt_neox.layers) == 1
+        checks.append(unchanged)
+        print(f"ドラフト作成後のターゲットの層数: {len(model.gpt_neox.layers)}/{num_layers} {'✅' if unchanged else '❌'}")
+        mismatched_draft = copy.deepcopy(draft_model)
+        with torch.no_grad():
+            weight = mismatched_draft.get_output_embeddings().weight
+            weight.add_(torch.randn_like(weight) * weight.std())
+    else:
+        model, tokenizer = inference.prepare_model_and_tokenizer()
+        draft_model = prepare_draft_model(args.draft, model.device)
+        mismatched_draft = draft_model
+
+    # 1. 受理・棄却の確認（合成した分布）: 出力の最初のトークンがターゲットの分布に従う
+    print("\n--- 受理・棄却の確認（合成分布） ---")
+    generator = torch.Generator().manual_seed(0)
+    vocab, k = 8, 3
+    target_probs = torch.softmax(torch.randn(k + 1, vocab, generator=generator) * 2, dim=-1)
+    draft_probs = torch.softmax(torch.randn(k, vocab, generator=generator) * 2, dim=-1)
+    counts = torch.zeros(vocab)
+    for _ in range(args.samples * 10):
+        draft_tokens = [torch.multinomial(draft_probs[i], 1, generator=generator).item() for i in range(k)]
+        counts[verify_draft(draft_tokens, draft_probs, target_probs, generator)[0]] += 1
+    baseline = torch.bincount(torch.multinomial(target_probs[0], args.samples * 10, replacement=True,
+                                                generator=generator), minlength=vocab).float()
+    distance, direct = total_variation(counts, target_probs[0]), total_variation(baseline, target_probs[0])
+    # 乱数は固定しているため結果は毎回同じ（直接サンプリングと同程度の誤差なら一致とみなす）
+    checks.append(distance < 2 * direct + 0.01)
+    print(f"全変動距離: 投機的 {distance:.4f}, 直接サンプリング {direct:.4f} {'✅' if checks[-1] else '❌'}")
+
+    prompt = inference.generate_prompt({'instruction': "日本の首都は？", 'input': None})
+    input_ids = tokenizer(prompt, return_tensors="pt", add_special_tokens=False).input_ids.to(model.device)
+
+    # 2. 貪欲生成ではターゲットモデル単独の生成と一致
+    print("\n--- 貪欲生成の一致 ---")
+    greedy = dict(do_sample=False, no_repeat_ngram_size=2)
+    with torch.inference_mode():
+        expected = model.generate(input_ids=input_ids, max_new_tokens=args.max_new_tokens,
+                                  min_new_tokens=args.max_new_tokens, pad_token_id=tokenizer.pad_token_id,
+                                  **greedy)
+    for label, draft in (("ドラフト", draft_model), ("雑音入りドラフト", mismatched_draft)):
+        for k in (1, 2, 4, 8):
+            outputs, stats = speculative_generate(model, draft, input_ids, args.max_new_tokens, k, greedy)
+            same = outputs.tolist() == expected.tolist()
+            checks.append(same)
+            print(f"{label} k={k}: {'✅' if same else '❌'} 受理率 {stats['acceptance_rate']:.2f}")
+
+    # 3. サンプリング: 最初のトークンの分布がターゲットモデルの分布と一致
+    print("\n--- サンプリング時の分布 ---")
+    params = dict(inference.GENERATION_PARAMS)
+    logits_processor = inference.build_logits_processor(params)
+    with torch.inference_mode():
+        logits = model(input_ids=input_ids).logits[:, -1]
+    exact = processed_probs(logits_processor, input_ids, logits, True)[0].cpu()
+    counts = torch.zeros_like(exact)
+    accepted = 0
+    for _ in range(args.samples):
+        outputs, stats = speculative_generate(model, mismatched_draft, input_ids, 2, 1, params, generator=generator)
+        counts[outputs[0, input_ids.shape[1]].item()] += 1
+        accepted += stats["accepted"]
+    baseline = torch.bincount(torch.multinomial(exact, args.samples, replacement=True, generator=generator),
+                              minlength=exact.shape[0]).float()
+    distance, direct = total_variation(counts, exact), total_variation(baseline, exact)
+    checks.append(distance < 2 * direct + 0.01)
+    print(f"全変動距離（{args.samples}サンプル、受理率 {accepted / args.samples:.2f}）: "
+          f"投機的 {distance:.4f}, 直接サンプリング {direct:.4f} {'✅' if checks[-1] else '❌'}")
+
+    # 4. k ごとの受理率と速度
+    print("\n--- k ごとの受理率と速度（サンプリング） ---")
+    stop_criteria = inference.StopSequenceCriteria(tokenizer)
+    torch.manual_seed(0)
+    start = time.perf_counter()
+    with torch.inference_mode():
+        outputs = model.generate(input_ids=input_ids, max_new_tokens=args.max_new_tokens,
+                                 min_new_tokens=args.max_new_tokens, pad_token_id=tokenizer.pad_token_id,
+                                 stopping_criteria=StoppingCriteriaList([stop_criteria]), **params)
+    baseline_tps = (outputs.shape[1] - input_ids.shape[1]) / (time.perf_counter() - start)
+    print(f"{'k':>3} {'受理率':>8} {'トークン/検証':>12} {'tokens/sec':>12} {'速度比':>8}")
+    print(f"{'-':>3} {'-':>8} {'1.00':>12} {baseline_tps:>12.1f} {'1.00x':>8}")
+    for k in (1, 2, 4, 8):
+        start = time.perf_counter()
+        outputs, stats = speculative_generate(model, draft_model, input_ids, args.max_new_tokens, k, params)
+        tps = (outputs.shape[1] - input_ids.shape[1]) / (time.perf_counter() - start)
+        print(f"{k:>3} {stats['acceptance_rate']:>8.2f} {stats['tokens_per_target_forward']:>12.2f} "
+              f"{tps:>12.1f} {tps / baseline_tps:>7.2f}x")
+    # GPUの3.6Bモデルでは1トークンの生成は重みの読み出しが律速で、k+1 トークンの検証も1トークンとほぼ同じ時間になる。
+    # CPUの小型モデルは演算律速のため検証の時間がトークン数に比例し、速度比は上限（トークン/検証）より大きく下がる
+    print("※ 速度比の上限は「トークン/検証」（ドラフトの時間を除く）。CPUでは検証の時間がトークン数に比例するため速度比は下がる")
+    if not all(checks):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B 推論スクリプトの起動高速化
+- torch / transformers / peft の読み込みを必要になるまで遅らせる
+- 重みは low_cpu_mem_usage で safetensors をメモリマップしたまま読み込む（ランダム初期化とコピーを省略）
+- トークナイザーは重みの読み込みと並行して別スレッドで読み込む
+- 読み込み全体をバックグラウンドで行い、その間に最初の質問を受け付ける
+- フェーズごとの起動時間（imports / tokenizer / weights / adapter / first token）を表示
+
+使い方:
+    python rinna_3_6b_startup.py --tiny   # 小型モデルで従来の起動と最初のプロンプトまでの時間を比較（CPU）
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# 起動直後のウォームアップに使うプロンプト
+WARMUP_PROMPT = "### 指示:<NL>こんにちは<NL><NL>### 回答:<NL>"
+
+
+class StartupProfiler:
+    """起動のフェーズごとの所要時間を記録"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.phases.append((name, seconds))
+
+    def elapsed(self):
+        """プロファイラー作成からの経過時間"""
+        return time.perf_counter() - self.start
+
+    def report(self):
+        """フェーズごとの内訳を表示"""
+        print("\n=== 起動時間の内訳 ===")
+        with self.lock:
+            phases = list(self.phases)
+        for name, seconds in phases:
+            print(f"  {name:24} {seconds * 1000:>9.1f}ms")
+
+
+def load_model_and_tokenizer(base_name, adapter_name=None, merged_name=None, load_in_8bit=True,
+                             profiler=None, warmup=True, device="auto", cpu_quantize=None):
+    """モデルとトークナイザーを読み込む（表示は行わないのでバックグラウンドでも使える）
+
+    merged_name を指定した場合はマージ済みチェックポイントを読み込み、アダプターは適用しない。
+    device は "auto"（GPUがなければCPU）/ "cuda" / "cpu"。CPUではfloat32で読み込んでLoRAをマージし、
+    cpu_quantize（省略時は rinna_3_6b_cpu_backend.CPU_INT8）なら動的int8量子化する。
+    """
+    profiler = profiler or StartupProfiler()
+    with profiler.phase("imports"):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        if adapter_name and not merged_name:
+            from peft import PeftModel
+
+    if device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    weights_name = merged_name or base_name
+    if device == "cpu":
+        model_kwargs = dict(torch_dtype=torch.float32)
+    elif load_in_8bit:
+        model_kwargs = dict(load_in_8bit=True, device_map="auto")
+    else:
+        # 8bit量子化しない場合もGPUに載せる（float16）
+        model_kwargs = dict(torch_dtype=torch.float16, device_map="auto")
+
+    def load_tokenizer():
+        start = time.perf_counter()
+        # Rinnaのトークナイザーでは use_fast=False が必要
+        tokenizer = AutoTokenizer.from_pretrained(weights_name, use_fast=False)
+        profiler.record("tokenizer（並行）", time.perf_counter() - start)
+        return tokenizer
+
+    # トークナイザーは重みの読み込みと並行して読み込む
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        tokenizer_future = executor.submit(load_tokenizer)
+        with profiler.phase("weights"):
+            model = AutoModelForCausalLM.from_pretrained(
+                weights_name,
+                low_cpu_mem_usage=True,
+                **model_kwargs,
+            )
+        with profiler.phase("tokenizer（待ち）"):
+            tokenizer = tokenizer_future.result()
+
+    if adapter_name and not merged_name:
+        with profiler.phase("adapter"):
+            model = PeftModel.from_pretrained(model, adapter_name)
+    model.eval()
+
+    if device == "cpu":
+        from rinna_3_6b_cpu_backend import CPU_INT8, prepare_cpu_model
+
+        with profiler.phase("cpu (merge/int8)"):
+            model = prepare_cpu_model(model, CPU_INT8 if cpu_quantize is None else cpu_quantize)
+
+    if warmup:
+        # 最初のリクエストで初期化のコストがかからないよう1トークン生成しておく
+        with profiler.phase("first token"):
+            input_ids = tokenizer(WARMUP_PROMPT, return_tensors="pt", add_special_tokens=False).input_ids
+            with torch.inference_mode():
+                model.generate(input_ids=input_ids.to(model.device), max_new_tokens=1, do_sample=False,
+                               pad_token_id=tokenizer.pad_token_id)
+    return model, tokenizer
+
+
+class BackgroundStartup:
+    """モデルの読み込みをバックグラウンドスレッドで行う"""
+
+    def __init__(self, load_fn, *args, **kwargs):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(load_fn, args, kwargs), daemon=True)
+        self.thread.start()
+
+    def _run(self, load_fn, args, kwargs):
+        try:
+            self.result = load_fn(*args, **kwargs)
+        except BaseException as e:  # 例外は wait() で再送出
+            self.error = e
+        finally:
+            self.done.set()
+
+    def ready(self):
+        """読み込みが完了したかどうか"""
+        return self.done.is_set()
+
+    def wait(self):
+        """読み込みの完了を待って結果を返す"""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def _read_until(process, marker, output, count=1):
+    """子プロセスの標準出力を marker が count 回現れるまで読み込む"""
+    while output.count(marker.encode()) < count:
+        chunk = os.read(process.stdout.fileno(), 4096)
+        if not chunk:
+            raise RuntimeError(f"'{marker}' が出力される前に終了しました:\n{output.decode(errors='replace')}")
+        output.extend(chunk)
+
+
+def measure_cold_start(script_args, think_time=0.0, question="日本の首都は？"):
+    """新しいプロセスで対話スクリプトを起動し、最初のプロンプトまでの時間と、
+    think_time 秒後（質問を入力する時間）に送信した最初の質問の回答完了までの時間を計測"""
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-u", "rinna_3_6b_inference_interactive.py", *script_args],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    output = bytearray()
+    try:
+        _read_until(process, "質問: ", output)
+        first_prompt = time.perf_counter() - start
+        time.sleep(think_time)
+        sent = time.perf_counter()
+        process.stdin.write(f"{question}\n".encode())
+        process.stdin.flush()
+        # 回答が終わると次のプロンプトが表示される
+        _read_until(process, "質問: ", output, count=2)
+        first_answer = time.perf_counter() - sent
+        process.stdin.write(b"quit\n")
+        process.stdin.flush()
+        process.communicate(timeout=600)
+    finally:
+        if process.poll() is None:
+            process.kill()
+    return {"first_prompt": first_prompt, "first_answer": first_answer}
+
+
+def main():
+    """小型モデルのチェックポイントで、従来の起動と高速起動を別プロセスで比較"""
+    parser = argparse.ArgumentParser(description="推論スクリプトの起動時間の比較")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    parser.add_argument("--repeats", type=int, default=3, help="計測回数")
+    parser.add_argument("--think-time", type=float, default=3.0, help="プロンプト表示から質問を送信するまでの秒数")
+    args = parser.parse_args()
+
+    print("=== 推論スクリプトの起動時間の比較 ===")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.tiny:
+            from rinna_3_6b_merge_lora import prepare_tiny_checkpoint
+            from rinna_3_6b_tiny_model import tokenizer_name
+
+            base_dir, adapter_dir = prepare_tiny_checkpoint(tmp_dir, args.tokenizer or tokenizer_name)
+            script_args = ["--base", base_dir, "--adapter", adapter_dir, "--no-8bit"]
+        else:
+            script_args = []
+
+        results = {}
+        for label, extra in (("従来（全て読み込んでから入力）", ["--eager"]), ("高速起動", [])):
+            runs = [measure_cold_start(script_args + extra, args.think_time) for _ in range(args.repeats)]
+            results[label] = {key: min(run[key] for run in runs) for key in runs[0]}
+
+    print(f"（質問は最初のプロンプトの {args.think_time:.1f} 秒後に送信）")
+    print(f"{'':32} {'最初のプロンプト':>16} {'送信から回答完了':>16}")
+    for label, result in results.items():
+        print(f"{label:32} {result['first_prompt'] * 1000:>14.0f}ms {result['first_answer'] * 1000:>14.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
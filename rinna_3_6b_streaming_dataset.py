@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B LoRA学習用 ストリーミングデータセット
+ローカルの JSONL / Parquet シャードを逐次読み込み、プロンプト生成とトークナイズを
+ジェネレーターのパイプラインで行う。メモリ使用量はコーパスサイズに依存しない。
+"""
+
+import glob
+import itertools
+import json
+import queue
+import random
+import threading
+
+from torch.utils.data import IterableDataset, get_worker_info
+
+COLUMNS = ("instruction", "input", "output")
+
+
+def list_shards(data_files):
+    """ファイルパスまたはglobパターンのリストからシャード一覧を取得（ソート済み）"""
+    if isinstance(data_files, str):
+        data_files = [data_files]
+    shards = []
+    for pattern in data_files:
+        shards.extend(sorted(glob.glob(pattern)))
+    if not shards:
+        raise FileNotFoundError(f"シャードが見つかりません: {data_files}")
+    return shards
+
+
+def read_shard(path):
+    """シャードを1行ずつ読み込む（JSONL / Parquet）"""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        for record_batch in parquet_file.iter_batches(batch_size=1024):
+            yield from record_batch.to_pylist()
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def shuffle_buffer(rows, buffer_size, rng):
+    """固定サイズのバッファで近似シャッフル"""
+    buffer = []
+    for row in rows:
+        if len(buffer) < buffer_size:
+            buffer.append(row)
+            continue
+        index = rng.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = row
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def prefetch(iterator, max_size):
+    """バックグラウンドスレッドで先読みする（キューの大きさで上限を設ける）"""
+    buffer = queue.Queue(maxsize=max_size)
+    stop = threading.Event()
+    done = object()
+
+    def producer():
+        try:
+            for item in iterator:
+                while not stop.is_set():
+                    try:
+                        buffer.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            buffer.put(done)
+        except Exception as e:  # 例外は消費側で再送出
+            buffer.put(e)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+class StreamingPromptDataset(IterableDataset):
+    """シャードを逐次読み込み、トークナイズ済みのサンプルを返す IterableDataset
+
+    - シャードの順序はエポックごとに seed + epoch で決定的にシャッフル
+    - データローダーのワーカーごとに担当シャード（シャード数が足りなければ行）を分割
+    - 読み込んだ行は shuffle_buffer 行のバッファでシャッフル
+    - set_resume() で消費済みバッチ数を指定すると、トークナイズ前の段階で読み飛ばして再開
+      （ワーカーが複数の場合、再開後のワーカー間のバッチの並びは変わるが、
+      サンプルの重複や欠落は起きない）
+    """
+
+    def __init__(self, data_files, tokenize_fn, seed=42, num_epochs=None,
+                 shuffle_buffer_size=10000, tokenize_batch_size=1000, prefetch_size=4):
+        self.shards = list_shards(data_files)
+        self.tokenize_fn = tokenize_fn
+        self.seed = seed
+        self.num_epochs = num_epochs
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.tokenize_batch_size = tokenize_batch_size
+        self.prefetch_size = prefetch_size
+        self.batches_consumed = 0
+        self.batch_size = 1
+
+    def set_resume(self, batches_consumed, batch_size):
+        """消費済みのバッチ数から再開位置を設定"""
+        self.batches_consumed = batches_consumed
+        self.batch_size = batch_size
+
+    def _skip_count(self, worker_id, num_workers):
+        # DataLoader はワーカーから順番にバッチを取り出すため、ワーカーごとの消費数は決定的
+        batches = self.batches_consumed // num_workers
+        if worker_id < self.batches_consumed % num_workers:
+            batches += 1
+        return batches * self.batch_size
+
+    def _epoch_rows(self, epoch, worker_id, num_workers):
+        shards = list(self.shards)
+        random.Random(self.seed + epoch).shuffle(shards)
+
+        if len(shards) >= num_workers:
+            rows = itertools.chain.from_iterable(
+                read_shard(path) for path in shards[worker_id::num_workers]
+            )
+        else:
+            rows = itertools.islice(
+                itertools.chain.from_iterable(read_shard(path) for path in shards),
+                worker_id, None, num_workers,
+            )
+
+        rng = random.Random((self.seed + epoch) * 1000003 + worker_id)
+        return shuffle_buffer(rows, self.shuffle_buffer_size, rng)
+
+    def _rows(self, worker_id, num_workers):
+        epochs = itertools.count() if self.num_epochs is None else range(self.num_epochs)
+        for epoch in epochs:
+            yield from self._epoch_rows(epoch, worker_id, num_workers)
+
+    def _tokenize(self, rows):
+        while True:
+            chunk = list(itertools.islice(rows, self.tokenize_batch_size))
+            if not chunk:
+                return
+            batch = {column: [row.get(column) or "" for row in chunk] for column in COLUMNS}
+            tokenized = self.tokenize_fn(batch)
+            keys = list(tokenized.keys())
+            for values in zip(*(tokenized[key] for key in keys)):
+                yield dict(zip(keys, values))
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+
+        rows = self._rows(worker_id, num_workers)
+        # 再開時はトークナイズ前の行を読み飛ばす
+        rows = itertools.islice(rows, self._skip_count(worker_id, num_workers), None)
+        return prefetch(self._tokenize(rows), self.prefetch_size * self.tokenize_batch_size)
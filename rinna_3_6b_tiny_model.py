@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B 検証用 小型GPT-NeoXモデル
+rinna のトークナイザーと同じ語彙サイズ・特殊トークンを持つランダム初期化の小型モデルを作成し、
+GPUや3.6Bの重みがなくてもCPU上で推論経路を検証できるようにする
+"""
+
+import torch
+from transformers import AutoTokenizer, GPTNeoXConfig, GPTNeoXForCausalLM
+
+# パラメータ
+tokenizer_name = "rinna/japanese-gpt-neox-3.6b"
+
+TINY_CONFIG = dict(
+    hidden_size=64,
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    intermediate_size=256,
+    max_position_embeddings=2048,
+)
+
+
+def prepare_tiny_model_and_tokenizer(tokenizer_path=tokenizer_name, seed=0, **config_overrides):
+    """小型GPT-NeoXモデルとトークナイザーの準備（キャッシュ済みのトークナイザーを使えばオフラインで動作）"""
+    # Rinnaのトークナイザーでは use_fast=False が必要
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_fast=False)
+
+    config = GPTNeoXConfig(
+        vocab_size=len(tokenizer),
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        **{**TINY_CONFIG, **config_overrides},
+    )
+    torch.manual_seed(seed)
+    model = GPTNeoXForCausalLM(config)
+    model.eval()
+    return model, tokenizer
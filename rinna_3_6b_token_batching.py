@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B LoRA学習用 トークン数ベースの動的バッチング
+長さの近いサンプルをまとめ、1バッチあたりのトークン数上限でバッチサイズを決める
+"""
+
+import math
+import random
+import time
+
+from torch.utils.data import DataLoader
+from transformers import Trainer
+
+
+class TokenBudgetBatchSampler:
+    """長さバケット単位でトークン数上限に収まるバッチを作るバッチサンプラー
+
+    バケット内をシャッフルしてからバッチを作り、バッチの順序もシャッフルする。
+    バッチサイズはバケットの上限長から決めるため、エポックごとのバッチ数は一定。
+    """
+
+    def __init__(self, lengths, max_tokens, bucket_width=16, max_batch_size=None,
+                 shuffle=True, seed=42, drop_last=False):
+        self.lengths = list(lengths)
+        self.max_tokens = max_tokens
+        self.bucket_width = bucket_width
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        # 長さごとにバケット分け（キーはバケットの上限長）
+        self.buckets = {}
+        for index, length in enumerate(self.lengths):
+            upper = max(1, math.ceil(length / bucket_width)) * bucket_width
+            self.buckets.setdefault(upper, []).append(index)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batch_size(self, upper):
+        batch_size = max(1, self.max_tokens // upper)
+        if self.max_batch_size is not None:
+            batch_size = min(batch_size, self.max_batch_size)
+        return batch_size
+
+    def _batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        batches = []
+        for upper in sorted(self.buckets):
+            indices = list(self.buckets[upper])
+            if self.shuffle:
+                rng.shuffle(indices)
+            batch_size = self._batch_size(upper)
+            for start in range(0, len(indices), batch_size):
+                batch = indices[start:start + batch_size]
+                if self.drop_last and len(batch) < batch_size:
+                    continue
+                batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        batches = self._batches()
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        count = 0
+        for upper, indices in self.buckets.items():
+            batch_size = self._batch_size(upper)
+            if self.drop_last:
+                count += len(indices) // batch_size
+            else:
+                count += math.ceil(len(indices) / batch_size)
+        return count
+
+
+class TokenBudgetTrainer(Trainer):
+    """TokenBudgetBatchSampler で学習データを読み込み、tokens/step をログに記録する Trainer"""
+
+    def __init__(self, *args, batch_sampler=None, pad_token_id=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_sampler = batch_sampler
+        self.pad_token_id = pad_token_id
+        self._log_tokens = 0
+        self._log_padded_tokens = 0
+        self._log_start_step = 0
+        self._log_start_time = time.perf_counter()
+
+    def get_train_dataloader(self):
+        if self.batch_sampler is None:
+            return super().get_train_dataloader()
+
+        dataloader = DataLoader(
+            self.train_dataset,
+            batch_sampler=self.batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(dataloader)
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        input_ids = inputs["input_ids"]
+        self._log_tokens += int(input_ids.ne(self.pad_token_id).sum())
+        self._log_padded_tokens += input_ids.numel()
+        return super().training_step(model, inputs, *args, **kwargs)
+
+    def log(self, logs, *args, **kwargs):
+        if "loss" in logs:
+            steps = max(1, self.state.global_step - self._log_start_step)
+            elapsed = time.perf_counter() - self._log_start_time
+            logs["tokens_per_step"] = round(self._log_tokens / steps, 1)
+            logs["padded_tokens_per_step"] = round(self._log_padded_tokens / steps, 1)
+            logs["tokens_per_sec"] = round(self._log_tokens / max(elapsed, 1e-9), 1)
+            self._log_tokens = 0
+            self._log_padded_tokens = 0
+            self._log_start_step = self.state.global_step
+            self._log_start_time = time.perf_counter()
+        super().log(logs, *args, **kwargs)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B LoRA学習用 トークナイズ済みコーパスの永続ストア
+トークンIDをメモリマップ配列（uint16/uint32）とオフセット索引として一度だけ書き出し、
+以降の実行ではゼロコピーで再利用する
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from torch.utils.data import Dataset
+
+TOKENS_FILE = "tokens.bin"
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.json"
+
+
+def tokenizer_fingerprint(tokenizer):
+    """トークナイザーのファイル内容からハッシュを計算"""
+    digest = hashlib.sha256()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tokenizer.save_pretrained(tmp_dir)
+        for name in sorted(os.listdir(tmp_dir)):
+            digest.update(name.encode("utf-8"))
+            with open(os.path.join(tmp_dir, name), "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def dataset_key(name, revision, split, **split_options):
+    """データセット名・リビジョン・分割（評価データの分割条件など）から、読み込まずに決まるキー文字列
+
+    revision が None（main）の場合、Hub上のデータセットが更新されてもキーは変わらない。
+    更新を取り込むときはリビジョンを指定するか、ストアを削除する。
+    """
+    options = ",".join(f"{option}={value}" for option, value in sorted(split_options.items()))
+    return f"{name}@{revision or 'main'}:{split}[{options}]"
+
+
+def store_key(tokenizer, template_version, cutoff_len, dataset_key):
+    """トークナイザー・プロンプトテンプレートの版・CUTOFF_LEN・データセットからストアのキーを作成
+
+    テンプレートは関数のソースではなく版（文字列）で区別するため、同じプロンプトを作る
+    generate_prompt（1行ずつ）と generate_prompts（バッチ）は同じストアを共有する。
+    """
+    digest = hashlib.sha256()
+    digest.update(tokenizer_fingerprint(tokenizer).encode("utf-8"))
+    digest.update(str(template_version).encode("utf-8"))
+    digest.update(str(cutoff_len).encode("utf-8"))
+    digest.update(str(dataset_key).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def write_token_store(path, sequences, vocab_size):
+    """トークンID列をストアとして書き出す（一時ディレクトリに書いてからリネーム）
+
+    sequences は長さの集計と書き込みで2回走査するため、再走査可能な列を渡すこと。
+    """
+    lengths = np.fromiter((len(ids) for ids in sequences), dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    dtype = np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        tokens = np.memmap(
+            os.path.join(tmp_path, TOKENS_FILE),
+            dtype=dtype,
+            mode="w+",
+            shape=(max(int(offsets[-1]), 1),),
+        )
+        for start, ids in zip(offsets[:-1], sequences):
+            tokens[start:start + len(ids)] = ids
+        tokens.flush()
+        del tokens
+
+        np.save(os.path.join(tmp_path, OFFSETS_FILE), offsets)
+        with open(os.path.join(tmp_path, META_FILE), "w") as f:
+            json.dump({
+                "dtype": np.dtype(dtype).name,
+                "num_sequences": len(lengths),
+                "num_tokens": int(offsets[-1]),
+            }, f, indent=2)
+
+        # mkdtemp は 0700 で作成されるため、読み取り共有できる権限に戻す
+        os.chmod(tmp_path, 0o755)
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        # 別プロセスが先に書き出した場合はそちらを使う
+        if not os.path.exists(os.path.join(path, META_FILE)):
+            raise
+
+
+class TokenColumn:
+    """ストア内のトークンID列へのゼロコピーな列ビュー"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, index):
+        return self.store.token_ids(index)
+
+    def __iter__(self):
+        for index in range(len(self.store)):
+            yield self.store.token_ids(index)
+
+
+class TokenStoreDataset(Dataset):
+    """メモリマップされたトークンストアを読み取り専用で開く Dataset
+
+    メモリマップはプロセスごとに遅延して開くため、データローダーの
+    ワーカー間でもページキャッシュを共有し、コピーは発生しない。
+    """
+
+    column_names = ["input_ids", "attention_mask"]
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self._offsets = None
+        self._tokens = None
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = np.load(os.path.join(self.path, OFFSETS_FILE), mmap_mode="r")
+        return self._offsets
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = np.memmap(
+                os.path.join(self.path, TOKENS_FILE),
+                dtype=self.meta["dtype"],
+                mode="r",
+            )
+        return self._tokens
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getstate__(self):
+        # ワーカーへ渡す際はメモリマップを持ち越さず、ワーカー側で開き直す
+        state = self.__dict__.copy()
+        state["_offsets"] = None
+        state["_tokens"] = None
+        return state
+
+    def __len__(self):
+        return self.meta["num_sequences"]
+
+    def token_ids(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.tokens[start:end]
+
+    def __getitem__(self, index):
+        if isinstance(index, str) and index == "input_ids":
+            return TokenColumn(self)
+        input_ids = self.token_ids(index).tolist()
+        return {
+            "input_ids": input_ids,
+            "attention_mask": [1] * len(input_ids),
+        }
+
+
+def load_or_build_token_store(store_dir, key, build_fn, vocab_size):
+    """キーに対応するストアがあれば開き、なければ build_fn() の結果から作成"""
+    path = os.path.join(store_dir, key)
+    if os.path.exists(os.path.join(path, META_FILE)):
+        print(f"トークンストアを再利用: {path}")
+    else:
+        print(f"トークンストアを作成: {path}")
+        write_token_store(path, build_fn(), vocab_size)
+    return TokenStoreDataset(path)
+
+
+def load_or_build_examples(store_dir, key, build_fn):
+    """キーに対応する小さなサンプル列（評価データなど）があればJSONから読み、なければ build_fn() の結果を保存"""
+    path = os.path.join(store_dir, f"{key}.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    examples = build_fn()
+    os.makedirs(store_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=store_dir, prefix=".tmp-", suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump(examples, f)
+    # mkstemp は 0600 で作成されるため、読み取り共有できる権限に戻す
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+    return examples
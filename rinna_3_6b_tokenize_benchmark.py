@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B LoRA学習用 プロンプト生成・トークナイズのベンチマーク
+1行ずつ / num_proc=4 / バッチ処理 の各方式で rows/sec を比較する
+"""
+
+import argparse
+import time
+
+from datasets import concatenate_datasets, load_dataset
+from transformers import AutoTokenizer
+
+from rinna_3_6b_lora_training_optimized import (
+    model_name,
+    dataset,
+    TOKENIZE_BATCH_SIZE,
+    generate_prompt,
+    generate_and_tokenize_prompts,
+    tokenize,
+)
+
+
+def load_rows(num_rows):
+    """ベンチマーク用データの読み込み（num_rows 指定時は複製して行数を揃える）"""
+    data = load_dataset(dataset)["train"]
+    if num_rows is None:
+        return data
+    copies = -(-num_rows // len(data))
+    data = concatenate_datasets([data] * copies)
+    return data.select(range(num_rows))
+
+
+def run_variant(name, data, map_kwargs):
+    """1方式を実行して rows/sec を計測"""
+    start = time.perf_counter()
+    result = data.map(
+        remove_columns=data.column_names,
+        load_from_cache_file=False,
+        **map_kwargs,
+    )
+    elapsed = time.perf_counter() - start
+    rows_per_sec = len(data) / elapsed
+    print(f"{name:<12} {elapsed:8.2f}秒 {rows_per_sec:12.1f} rows/sec")
+    return result, rows_per_sec
+
+
+def main():
+    """メイン処理"""
+    parser = argparse.ArgumentParser(description="プロンプト生成・トークナイズのベンチマーク")
+    parser.add_argument("--rows", type=int, default=None, help="計測する行数（データセットを複製して調整）")
+    parser.add_argument("--num-proc", type=int, default=4, help="並列処理版のプロセス数")
+    parser.add_argument("--batch-size", type=int, default=TOKENIZE_BATCH_SIZE, help="バッチ版の1バッチあたりの行数")
+    args = parser.parse_args()
+
+    print("Rinna-3.6B プロンプト生成・トークナイズ ベンチマーク")
+    print("=" * 50)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=False)
+    data = load_rows(args.rows)
+    print(f"行数: {len(data)}")
+
+    def generate_and_tokenize_prompt(data_point):
+        return tokenize(generate_prompt(data_point), tokenizer)
+
+    print(f"\n{'方式':<12} {'時間':>8} {'スループット':>16}")
+    per_row, _ = run_variant("1行ずつ", data, {"function": generate_and_tokenize_prompt})
+    run_variant(f"num_proc={args.num_proc}", data, {
+        "function": generate_and_tokenize_prompt,
+        "num_proc": args.num_proc,
+    })
+    batched, _ = run_variant("バッチ", data, {
+        "function": generate_and_tokenize_prompts,
+        "fn_kwargs": {"tokenizer": tokenizer},
+        "batched": True,
+        "batch_size": args.batch_size,
+    })
+
+    # バッチ版が1行ずつの結果と一致することを確認
+    if list(per_row["input_ids"]) == list(batched["input_ids"]):
+        print("\n✅ バッチ版のトークン列は1行ずつの結果と一致しました")
+    else:
+        print("\n❌ バッチ版のトークン列が1行ずつの結果と一致しません")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Rinna-3.6B LoRA学習用 スループット計測コールバック
+学習ステップごとに実トークン数とパディング込みのトークン数、tokens/sec、データローダーの待ち時間、
+forward / backward / optimizer の時間、ピークメモリを記録する。
+ログ出力のタイミングで前回からの平均を trainer_state.json の log_history に追加し、
+ステップごとの値は別のメトリクスファイル（JSON Lines）に書き出す。
+
+    trainer.add_callback(ThroughputCallback(tokenizer.pad_token_id, metrics_path))
+
+使い方:
+    python rinna_3_6b_training_metrics.py --tiny   # 小型モデルの短い学習（CPU）で記録内容を確認
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import torch
+from transformers import TrainerCallback
+
+# パラメータ
+METRICS_FILE = "throughput_metrics.jsonl"  # 出力ディレクトリに作成するメトリクスファイル
+
+# log_history に追加する項目（前回のログからの平均）
+LOGGED_METRICS = [
+    "real_tokens_per_step",
+    "padded_tokens_per_step",
+    "padding_ratio",
+    "step_tokens_per_sec",
+    "dataloader_wait_ms",
+    "forward_ms",
+    "backward_ms",
+    "optimizer_ms",
+    "step_ms",
+    "peak_memory_mb",
+]
+
+
+def peak_memory_mb(device=None):
+    """ピークメモリ（GPUは割り当て済みメモリ、CPUはプロセスの最大RSS）"""
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated(device) / 1024 ** 2
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOSはバイト単位、Linuxはキロバイト単位
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+class ThroughputCallback(TrainerCallback):
+    """学習ステップの内訳とトークン数を記録する TrainerCallback
+
+    モデルの forward の前後にフックを登録してトークン数と forward の時間を測り、
+    学習対象のパラメータ（LoRA）の勾配がすべて計算された時点を backward の終了とする。
+    optimizer の時間は最後の backward の終了から on_step_end までの時間（勾配クリッピング・
+    スケジューラー・zero_grad を含む。on_optimizer_step は古い transformers にないため使わない）。
+    データローダーの待ち時間は、前のステップ（または backward）の終了から次の forward 開始までの時間
+    （バッチのデバイス転送を含む）。GPUでは正確な時間を測るため各区間の境界で同期する。
+    """
+
+    def __init__(self, pad_token_id, metrics_path=None, synchronize=True):
+        self.pad_token_id = pad_token_id
+        self.metrics_path = metrics_path
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.handles = []
+        self.history = []  # ステップごとの記録
+        self._pending = []  # 前回のログ以降の記録
+        self._reset_step()
+        self._mark = None
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _reset_step(self):
+        self.step = dict(real_tokens=0, padded_tokens=0, dataloader_wait=0.0, forward=0.0, backward=0.0)
+        self._step_start = None
+        self._forward_start = None
+        self._forward_end = None
+        self._backward_end = None
+
+    # --- モデルのフック ---
+
+    def _forward_pre_hook(self, module, args, kwargs):
+        if not module.training:
+            return
+        now = self._now()
+        if self._step_start is None:
+            self._step_start = self._mark if self._mark is not None else now
+        self.step["dataloader_wait"] += now - (self._mark if self._mark is not None else now)
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if input_ids is not None:
+            self.step["real_tokens"] += int(input_ids.ne(self.pad_token_id).sum())
+            self.step["padded_tokens"] += input_ids.numel()
+        self._forward_start = now
+
+    def _forward_hook(self, module, args, kwargs, output):
+        if not module.training or self._forward_start is None:
+            return
+        self._forward_end = self._now()
+        self.step["forward"] += self._forward_end - self._forward_start
+        self._forward_start = None
+
+    def _backward_hook(self, grads):
+        if self._forward_end is None:
+            return
+        self._backward_end = self._now()
+        self.step["backward"] += self._backward_end - self._forward_end
+        self._forward_end = None
+        self._mark = self._backward_end
+
+    # --- コールバック ---
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        if model is None:
+            return
+        self.handles.append(model.register_forward_pre_hook(self._forward_pre_hook, with_kwargs=True))
+        self.handles.append(model.register_forward_hook(self._forward_hook, with_kwargs=True))
+        params = [param for param in model.parameters() if param.requires_grad]
+        if params:
+            self.handles.append(torch.autograd.graph.register_multi_grad_hook(params, self._backward_hook))
+        if self.metrics_path and state.is_world_process_zero:
+            os.makedirs(os.path.dirname(self.metrics_path) or ".", exist_ok=True)
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self._mark = self._now()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = self._now()
+        step_start = self._step_start if self._step_start is not None else now
+        elapsed = now - step_start
+        optimizer = now - self._backward_end if self._backward_end is not None else 0.0
+        record = {
+            "step": state.global_step,
+            "real_tokens": self.step["real_tokens"],
+            "padded_tokens": self.step["padded_tokens"],
+            "padding_ratio": 1 - self.step["real_tokens"] / max(self.step["padded_tokens"], 1),
+            "tokens_per_sec": self.step["real_tokens"] / max(elapsed, 1e-9),
+            "dataloader_wait_ms": self.step["dataloader_wait"] * 1000,
+            "forward_ms": self.step["forward"] * 1000,
+            "backward_ms": self.step["backward"] * 1000,
+            "optimizer_ms": optimizer * 1000,
+            "step_ms": elapsed * 1000,
+            "peak_memory_mb": peak_memory_mb(),
+        }
+        self.history.append(record)
+        self._pending.append(record)
+        if self.metrics_path and state.is_world_process_zero:
+            with open(self.metrics_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+        self._reset_step()
+        self._mark = now
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        # Trainer は logs の複製を log_history に追加済みのため、最後の要素に書き込む
+        if self._pending and state.log_history and "loss" in state.log_history[-1]:
+            state.log_history[-1].update(self.summary(self._pending))
+            self._pending = []
+        self._mark = self._now()
+
+    def on_save(self, args, state, control, **kwargs):
+        self._mark = self._now()
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self._mark = self._now()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    @staticmethod
+    def summary(records):
+        """複数ステップの平均（tokens/sec とパディング率はトークン数の合計から計算）"""
+        count = len(records)
+        real = sum(r["real_tokens"] for r in records)
+        padded = sum(r["padded_tokens"] for r in records)
+        step_seconds = sum(r["step_ms"] for r in records) / 1000
+        return {
+            "real_tokens_per_step": round(real / count, 1),
+            "padded_tokens_per_step": round(padded / count, 1),
+            "padding_ratio": round(1 - real / max(padded, 1), 4),
+            "step_tokens_per_sec": round(real / max(step_seconds, 1e-9), 1),
+            "dataloader_wait_ms": round(sum(r["dataloader_wait_ms"] for r in records) / count, 2),
+            "forward_ms": round(sum(r["forward_ms"] for r in records) / count, 2),
+            "backward_ms": round(sum(r["backward_ms"] for r in records) / count, 2),
+            "optimizer_ms": round(sum(r["optimizer_ms"] for r in records) / count, 2),
+            "step_ms": round(step_seconds * 1000 / count, 2),
+            "peak_memory_mb": round(max(r["peak_memory_mb"] for r in records), 1),
+        }
+
+
+def main():
+    """小型モデルで短い学習を行い、コールバックの記録を表示"""
+    parser = argparse.ArgumentParser(description="学習スループット計測コールバックの動作確認")
+    parser.add_argument("--tiny", action="store_true", help="小型のランダム初期化GPT-NeoXモデルを使用（CPU検証用）")
+    parser.add_argument("--tokenizer", default=None, help="--tiny 時に使うトークナイザーのパス")
+    parser.add_argument("--max-steps", type=int, default=8)
+    args = parser.parse_args()
+
+    import random
+
+    from datasets import Dataset
+    from peft import LoraConfig, TaskType, get_peft_model
+    from transformers import DataCollatorForLanguageModeling, Trainer, TrainingArguments
+    from rinna_3_6b_tiny_model import prepare_tiny_model_and_tokenizer, tokenizer_name
+
+    print("=== 学習スループット計測の動作確認 ===")
+    model, tokenizer = prepare_tiny_model_and_tokenizer(args.tokenizer or tokenizer_name)
+    model = get_peft_model(model, LoraConfig(task_type=TaskType.CAUSAL_LM, r=8, lora_alpha=32,
+                                             target_modules=["query_key_value"]))
+    # 長さがばらばらのサンプル（パディング率を確認するため）
+    rng = random.Random(0)
+    rows = [{"input_ids": [rng.randrange(10, len(tokenizer)) for _ in range(rng.randint(16, 128))]}
+            for _ in range(256)]
+    for row in rows:
+        row["attention_mask"] = [1] * len(row["input_ids"])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        metrics_path = os.path.join(tmp_dir, METRICS_FILE)
+        training_args = TrainingArguments(
+            output_dir=tmp_dir,
+            max_steps=args.max_steps,
+            per_device_train_batch_size=8,
+            gradient_accumulation_steps=2,
+            logging_steps=4,
+            learning_rate=1e-4,
+            save_strategy="no",
+            report_to="none",
+            use_cpu=not torch.cuda.is_available(),
+        )
+        trainer = Trainer(
+            model=model,
+            args=training_args,
+            train_dataset=Dataset.from_list(rows),
+            data_collator=DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False),
+            callbacks=[ThroughputCallback(tokenizer.pad_token_id, metrics_path)],
+        )
+        model.config.use_cache = False
+        trainer.train()
+
+        with open(metrics_path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+
+    print(f"\n--- ステップごとの記録（{METRICS_FILE}） ---")
+    print(f"{'step':>4} {'実トークン':>10} {'パディング込み':>14} {'パディング率':>12} {'tokens/sec':>11} "
+          f"{'待ち':>8} {'forward':>9} {'backward':>9} {'optimizer':>10} {'ステップ':>9}")
+    for r in records:
+        print(f"{r['step']:>4} {r['real_tokens']:>10} {r['padded_tokens']:>14} {r['padding_ratio']:>12.3f} "
+              f"{r['tokens_per_sec']:>11.1f} {r['dataloader_wait_ms']:>6.1f}ms {r['forward_ms']:>7.1f}ms "
+              f"{r['backward_ms']:>7.1f}ms {r['optimizer_ms']:>8.1f}ms {r['step_ms']:>7.1f}ms")
+
+    print("\n--- log_history ---")
+    for logs in trainer.state.log_history:
+        if "loss" in logs:
+            print({key: logs[key] for key in ["step", "loss"] + LOGGED_METRICS if key in logs})
+
+
+if __name__ == "__main__":
+    main()